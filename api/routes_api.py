@@ -1,15 +1,25 @@
 #!/usr/bin/env python3
 """ Module for api routes. """
 
-from flask import jsonify, request
-from flask_login import login_required
+from flask import Response, jsonify, request, stream_with_context
+from flask_login import current_user, login_required
 from itsdangerous import URLSafeTimedSerializer
-from werkzeug.security import generate_password_hash, check_password_hash
-import app
+from app import app, catalog, db
+from app.admin import admin_required
 from app.models import University, User, UserPreference
+from app.conditional import make_etag, not_modified, set_validators
+from app.export import gzip_chunks, iter_rows, ndjson
+from app.pagination import decode_cursor, page_size, paginate_universities
+from app import recommendations
+from app.search_index import ensure_loaded
+from app.serializers import UniversityRecords, compare
 
 
 s = URLSafeTimedSerializer('ThisisasecretToHelpCreateProtectedTokens!')
+university_records = UniversityRecords(
+    app.config['UNIVERSITY_CACHE_MAX_ENTRIES']
+    )
+catalog.subscribe(university_records.apply)
 
 @app.route('/api/signup', methods=['POST'], strict_slashes=False)
 def signup():
@@ -19,15 +29,16 @@ def signup():
     username = data.get('username')
     password = data.get('password')
     firstname = data.get('firstname')
-    lastname = data.get
+    lastname = data.get('lastname')
     user = User(
         email=email,
         username=username,
         firstname=firstname,
         lastname=lastname
         )
-    app.db.session.add(user)
-    app.db.session.commit()
+    user.set_password(password)
+    db.session.add(user)
+    db.session.commit()
     return jsonify({'message': 'User signed up successfully'}), 201
 
 @app.route('/api/login', methods=['POST'], strict_slashes=False)
@@ -40,22 +51,244 @@ def login():
     user = User.query.filter_by(email=email).first()
     if user is None or not user.check_password(password):
         return jsonify({'message': 'Invalid email or password'}), 401
+    db.session.commit()
     return jsonify({'message': 'User logged in successfully'}), 200
 
 @app.route('/api/universities', methods=['GET'], strict_slashes=False)
 def universities():
-    """ Route for getting all universities. """
-    # University.query.all()
-    universities = University.query.all()
-    return jsonify({'universities': [
-        university.to_dict() for university in universities
-        ]}), 200
+    """
+    Route for getting universities, one page at a time.
+
+    Query parameters:
+        cursor: the `next` value of the previous page.
+        limit: the page size, capped by UNIVERSITIES_MAX_PAGE_SIZE.
+        format: `ndjson` to stream every university, one per line.
+
+    Pages carry an ETag and Last-Modified taken from the catalog
+    version, so a client whose copy is current gets a 304 for the cost
+    of one primary key lookup.
+    """
+    if request.args.get('format') == 'ndjson':
+        return stream_universities()
+    cursor = request.args.get('cursor')
+    limit = page_size(request.args.get('limit', type=int))
+    try:
+        decode_cursor(cursor)
+    except ValueError:
+        return jsonify({'message': 'Invalid cursor'}), 400
+    # Read the version before the rows, so the tag is never newer than
+    # the page it is sent with.
+    version, updated_at = catalog.version()
+    etag = make_etag('universities', version, cursor or '', limit)
+    response = not_modified(etag, updated_at)
+    if response is not None:
+        return response
+    universities, next_cursor = paginate_universities(cursor, limit)
+    response = jsonify({
+        'universities': [
+            university.to_dict() for university in universities
+            ],
+        'next': next_cursor
+        })
+    return set_validators(response, etag, updated_at), 200
+
+def stream_universities():
+    """ Stream every university as newline delimited JSON. """
+    return export_response(
+        'universities', app.config['UNIVERSITIES_STREAM_BATCH']
+        )
+
+def export_response(name, batch_size=None):
+    """
+    Stream an export as newline delimited JSON.
+
+    The body is gzip encoded when the client accepts it. Rows are read
+    from the database while the response is sent, so memory use does
+    not grow with the size of the table.
+
+    Args:
+        name (str): A key of `app.export.EXPORTS`.
+        batch_size (int): Rows fetched from the database at a time.
+    """
+    chunks = ndjson(iter_rows(name, batch_size or app.config['EXPORT_BATCH_SIZE']))
+    headers = {'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(
+        stream_with_context(chunks),
+        mimetype='application/x-ndjson',
+        headers=headers
+        )
+
+@app.route('/api/export/universities.ndjson', methods=['GET'], strict_slashes=False)
+def export_universities():
+    """ Route for exporting every university. """
+    return export_response('universities')
+
+@app.route('/api/export/preferences.ndjson', methods=['GET'], strict_slashes=False)
+@admin_required
+def export_preferences():
+    """ Route for exporting every (user, university) like, for admins. """
+    return export_response('preferences')
+
+@app.route('/api/universities/search', methods=['GET'], strict_slashes=False)
+def search_universities():
+    """
+    Route for looking up universities by name, location or website.
+
+    Query parameters:
+        q: the free text to look for, misspellings allowed.
+        limit: the number of results, capped by UNIVERSITIES_MAX_PAGE_SIZE.
+    """
+    query = request.args.get('q', '', type=str)
+    limit = min(
+        request.args.get('limit', 10, type=int),
+        app.config['UNIVERSITIES_MAX_PAGE_SIZE']
+        )
+    results = ensure_loaded().search(query, max(limit, 1))
+    return jsonify({
+        'query': query,
+        'results': [
+            dict(row, score=round(score, 4)) for score, row in results
+            ]
+        }), 200
+
+@app.route('/api/universities/most_liked', methods=['GET'], strict_slashes=False)
+def most_liked_universities():
+    """
+    Route for getting the most liked universities.
+
+    Served from the like counters kept on each university, so it reads
+    `limit` rows of the like_count index whatever the number of likes.
+    """
+    limit = min(
+        max(request.args.get('limit', 10, type=int), 1),
+        app.config['UNIVERSITIES_MAX_PAGE_SIZE']
+        )
+    rows = db.session.execute(
+        db.select(
+            University.id, University.name,
+            University.location, University.like_count
+            )
+        .order_by(University.like_count.desc(), University.id)
+        .limit(limit)
+        )
+    return jsonify({
+        'universities': [row._asdict() for row in rows]
+        }), 200
+
+@app.route('/api/recommendations', methods=['GET'], strict_slashes=False)
+@login_required
+def get_recommendations():
+    """
+    Route for getting university recommendations for the current user.
+
+    Users with likes get the universities most similar to the ones they
+    like; others, and short lists, get the most liked universities of
+    their country.
+    """
+    limit = min(
+        max(request.args.get('limit', 10, type=int), 1),
+        app.config['UNIVERSITIES_MAX_PAGE_SIZE']
+        )
+    engine = recommendations.ensure_loaded(
+        app.config['RECOMMENDER_NEIGHBORS']
+        )
+    scored = engine.recommend(current_user.id, limit)
+    strategy = 'item_item' if scored else 'location'
+    liked = db.session.scalars(db.select(UserPreference.university_id).where(
+        UserPreference.user_id == current_user.id))
+    exclude = set(liked) | {university_id for university_id, _ in scored}
+    scored += [(university_id, None) for university_id in
+               recommendations.location_fallback(
+                   current_user.location, limit - len(scored), exclude)]
+    rows = {
+        university.id: university
+        for university in University.query.filter(
+            University.id.in_([university_id for university_id, _ in scored]))
+        }
+    return jsonify({
+        'strategy': strategy,
+        'recommendations': [
+            dict(rows[university_id].to_dict(), score=score)
+            for university_id, score in scored if university_id in rows
+            ]
+        }), 200
+
+@app.route('/api/universities/compare', methods=['GET'], strict_slashes=False)
+def compare_universities():
+    """
+    Route for comparing several universities side by side.
+
+    Query parameters:
+        ids: comma separated university ids, at most
+            COMPARE_MAX_UNIVERSITIES of them.
+
+    Validated with the updated_at of the universities compared, read
+    with one primary key lookup, so changes to other universities keep
+    cached comparisons, and the cached records, current. There is no
+    Last-Modified: a deleted university would not make it move.
+    """
+    ids = []
+    for university_id in request.args.get('ids', '', type=str).split(','):
+        university_id = university_id.strip()
+        if university_id and university_id not in ids:
+            ids.append(university_id)
+    if not ids:
+        return jsonify({'message': 'No university ids given'}), 400
+    if len(ids) > app.config['COMPARE_MAX_UNIVERSITIES']:
+        return jsonify({
+            'message': 'At most {} universities can be compared'.format(
+                app.config['COMPARE_MAX_UNIVERSITIES'])
+            }), 400
+    versions = university_records.versions(ids)
+    etag = make_etag('compare', ids, [versions.get(university_id)
+                                      for university_id in ids])
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    found, current = university_records.get_many(ids, versions)
+    records = [found[university_id] for university_id in ids
+               if university_id in found]
+    response = jsonify({
+        'ids': [record['id'] for record in records],
+        'fields': compare(records),
+        'universities': records,
+        'missing': [university_id for university_id in ids
+                    if university_id not in found]
+        })
+    if not current:
+        # Built from rows newer than the tag; the next request gets one.
+        response.cache_control.no_cache = True
+        return response, 200
+    return set_validators(response, etag), 200
 
 @app.route('/api/universities/<id>', methods=['GET'], strict_slashes=False)
 def university(id):
-    """ Route for getting a university by id. """
-    University.query.filter_by(id=id).first()
-    return jsonify({'message': 'University returned successfully'}), 200
+    """
+    Route for getting a university by id.
+
+    Validated with the updated_at of the university, read with one
+    primary key lookup, so changes to other universities keep its
+    cached copies current.
+    """
+    updated_at = db.session.scalar(
+        db.select(University.updated_at).where(University.id == id)
+        )
+    if updated_at is None:
+        return jsonify({'message': 'University not found'}), 404
+    etag = make_etag('university', id, updated_at.isoformat())
+    response = not_modified(etag, updated_at)
+    if response is not None:
+        return response
+    updated_at, record = university_records.get(id, updated_at)
+    if record is None:
+        return jsonify({'message': 'University not found'}), 404
+    # Tag the body with the row it was built from, in case it changed
+    # since the lookup above.
+    etag = make_etag('university', id, updated_at.isoformat())
+    return set_validators(jsonify(record), etag, updated_at), 200
 
 @app.route('/api/universities', methods=['POST'], strict_slashes=False)
 def add_university():
@@ -69,8 +302,8 @@ def add_university():
         name=name, location=location,
         website=website, status=status
         )
-    app.db.session.add(university)
-    app.db.session.commit()
+    db.session.add(university)
+    db.session.commit()
     return jsonify({'message': 'University added successfully'}), 201
 
 @app.route('/api/universities/<id>', methods=['PUT'], strict_slashes=False)
@@ -82,22 +315,32 @@ def update_university(id):
     website = data.get('website')
     status = data.get('status')
     university = University.query.filter_by(id=id).first()
+    if university is None:
+        return jsonify({'message': 'University not found'}), 404
     university.name = name
     university.location = location
     university.website = website
     university.status = status
+    db.session.commit()
     return jsonify({'message': 'University updated successfully'}), 200
 
 @app.route('/api/users/<id>', methods=['DELETE'], strict_slashes=False)
-def user(id):
-    """ Route for deleting a user if exists. """
-    if User.query.filter_by(id=id).first() is None:
+def delete_user(id):
+    """
+    Route for deleting a user if exists.
+
+    The user is loaded and deleted through the session, so the caches
+    and email filters listening for deleted users hear of it.
+    """
+    user = db.session.get(User, id)
+    if user is None:
         return jsonify({'message': 'User not found'}), 404
-    User.query.filter_by(id=id).delete()
+    db.session.delete(user)
+    db.session.commit()
     return jsonify({'message': 'User deleted successfully'}), 200
 
 @app.route('/api/user', methods=['GET'], strict_slashes=False)
-def user():
+def get_user():
     """ Route for getting a user by id. """
     User.query.all()
     return jsonify({'message': 'User returned successfully'}), 200
@@ -107,21 +350,31 @@ def user_preferences(id):
     """ Route for getting a user preferences by id. """
     if UserPreference.query.filter_by(id=id).first() is None:
         return jsonify({'message': 'User preferences not found'}), 404
-    UserPreference.query.filter_by(id=id).first()
     return jsonify({'message': 'User preferences returned successfully'}), 200
 
 @app.route('/api/reset_password', methods=['POST'], strict_slashes=False)
-def reset_password():
-    """ Route for resetting a user password. """
+@login_required
+def api_reset_password():
+    """
+    Route for resetting a user password.
+
+    Users may only reset their own password; it is hashed by the
+    password workers, like every other password.
+    """
     data = request.get_json()
     email = data.get('email')
     password = data.get('password')
-    user.password = generate_password_hash(password)
-    app.db.session.commit()
+    if not email or not password:
+        return jsonify({'message': 'Email and password are required'}), 400
+    user = User.query.filter_by(email=email).first()
+    if user is None or user.id != current_user.id:
+        return jsonify({'message': 'User not found'}), 404
+    user.set_password(password)
+    db.session.commit()
     return jsonify({'message': 'Password reset successfully'}), 200
 
 @app.route('/api/reset_password/<token>', methods=['POST'], strict_slashes=False)
-def reset_password(token):
+def api_reset_password_with_token(token):
     """ Route for resetting a user password. """
     data = request.get_json()
     email = data.get('email')
@@ -5,7 +5,16 @@ from flask import Flask
 from flask_login import LoginManager
 from flask_mailman import Mail
 from flask_migrate import Migrate
+from werkzeug.middleware.proxy_fix import ProxyFix
+from .assets import StaticAssets
+from .db_metrics import QueryMonitor
+from .email_filter import email_filter
+from .llm_accounting import llm_calls
+from .metrics import MetricsMiddleware
 from .models import db
+from .outbox import outbox
+from .passwords import hasher
+import json
 import os
 # from . import routes
 
@@ -16,6 +25,207 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
     'SQLALCHEMY_DATABASE_URI'
     )
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Users allowed on the admin routes, by email, separated by commas.
+app.config['ADMIN_EMAILS'] = {
+    email.strip().lower()
+    for email in os.environ.get('ADMIN_EMAILS', '').split(',')
+    if email.strip()
+    }
+app.config['UNIVERSITIES_PAGE_SIZE'] = int(
+    os.environ.get('UNIVERSITIES_PAGE_SIZE', 50)
+    )
+app.config['UNIVERSITIES_MAX_PAGE_SIZE'] = int(
+    os.environ.get('UNIVERSITIES_MAX_PAGE_SIZE', 200)
+    )
+app.config['UNIVERSITIES_STREAM_BATCH'] = int(
+    os.environ.get('UNIVERSITIES_STREAM_BATCH', 500)
+    )
+app.config['SEARCH_MODEL'] = os.environ.get('SEARCH_MODEL', 'gpt-3.5-turbo')
+app.config['SEARCH_MAX_TOKENS'] = int(os.environ.get('SEARCH_MAX_TOKENS', 300))
+app.config['SEARCH_CONTEXT_ROWS'] = int(os.environ.get('SEARCH_CONTEXT_ROWS', 8))
+app.config['SEARCH_CONTEXT_TOKENS'] = int(
+    os.environ.get('SEARCH_CONTEXT_TOKENS', 400)
+    )
+app.config['SEARCH_CACHE_BACKEND'] = os.environ.get(
+    'SEARCH_CACHE_BACKEND', 'database'
+    )
+app.config['SEARCH_CACHE_LOCAL'] = os.environ.get(
+    'SEARCH_CACHE_LOCAL', 'memory'
+    )
+app.config['SEARCH_CACHE_LOCAL_TTL'] = int(
+    os.environ.get('SEARCH_CACHE_LOCAL_TTL', 300)
+    )
+app.config['SEARCH_CACHE_PATH'] = os.environ.get(
+    'SEARCH_CACHE_PATH', os.path.join(app.instance_path, 'search_cache.db')
+    )
+app.config['SEARCH_CACHE_TTL'] = int(
+    os.environ.get('SEARCH_CACHE_TTL', 24 * 3600)
+    )
+app.config['SEARCH_CACHE_MAX_ENTRIES'] = int(
+    os.environ.get('SEARCH_CACHE_MAX_ENTRIES', 2048)
+    )
+app.config['CHAT_PROMPT_TOKENS'] = int(
+    os.environ.get('CHAT_PROMPT_TOKENS', 1500)
+    )
+app.config['CHAT_SUMMARY_TOKENS'] = int(
+    os.environ.get('CHAT_SUMMARY_TOKENS', 150)
+    )
+app.config['LLM_MAX_IN_FLIGHT'] = int(os.environ.get('LLM_MAX_IN_FLIGHT', 8))
+app.config['LLM_MAX_QUEUED'] = int(os.environ.get('LLM_MAX_QUEUED', 32))
+app.config['LLM_QUEUE_TIMEOUT'] = float(
+    os.environ.get('LLM_QUEUE_TIMEOUT', 5)
+    )
+app.config['LLM_WAIT_TIMEOUT'] = float(os.environ.get('LLM_WAIT_TIMEOUT', 60))
+app.config['LLM_MAX_RETRIES'] = int(os.environ.get('LLM_MAX_RETRIES', 3))
+app.config['LLM_RETRY_BASE_DELAY'] = float(
+    os.environ.get('LLM_RETRY_BASE_DELAY', 0.5)
+    )
+app.config['LLM_RETRY_MAX_DELAY'] = float(
+    os.environ.get('LLM_RETRY_MAX_DELAY', 8)
+    )
+app.config['LLM_BREAKER_FAILURES'] = int(
+    os.environ.get('LLM_BREAKER_FAILURES', 5)
+    )
+app.config['LLM_BREAKER_RESET_TIMEOUT'] = float(
+    os.environ.get('LLM_BREAKER_RESET_TIMEOUT', 30)
+    )
+app.config['LLM_RATE_LIMIT_BACKEND'] = os.environ.get(
+    'LLM_RATE_LIMIT_BACKEND', 'database'
+    )
+app.config['LLM_RATE_LIMIT_PATH'] = os.environ.get(
+    'LLM_RATE_LIMIT_PATH', os.path.join(app.instance_path, 'rate_limits.db')
+    )
+app.config['LLM_USER_RATE_PER_MINUTE'] = float(
+    os.environ.get('LLM_USER_RATE_PER_MINUTE', 10)
+    )
+app.config['LLM_USER_BURST'] = float(os.environ.get('LLM_USER_BURST', 5))
+app.config['LLM_GLOBAL_RATE_PER_MINUTE'] = float(
+    os.environ.get('LLM_GLOBAL_RATE_PER_MINUTE', 600)
+    )
+app.config['LLM_GLOBAL_BURST'] = float(os.environ.get('LLM_GLOBAL_BURST', 60))
+app.config['LLM_ASYNC_MAX_IN_FLIGHT'] = int(
+    os.environ.get('LLM_ASYNC_MAX_IN_FLIGHT', 1000)
+    )
+app.config['LLM_ASYNC_MAX_QUEUED'] = int(
+    os.environ.get('LLM_ASYNC_MAX_QUEUED', 2000)
+    )
+app.config['LLM_ASYNC_MAX_CONNECTIONS'] = int(
+    os.environ.get('LLM_ASYNC_MAX_CONNECTIONS', 1000)
+    )
+app.config['LLM_ACCOUNTING'] = os.environ.get(
+    'LLM_ACCOUNTING', '1'
+    ).lower() in ('1', 'true', 'yes')
+app.config['LLM_ACCOUNTING_BATCH'] = int(
+    os.environ.get('LLM_ACCOUNTING_BATCH', 500)
+    )
+app.config['LLM_ACCOUNTING_MAX_QUEUED'] = int(
+    os.environ.get('LLM_ACCOUNTING_MAX_QUEUED', 10000)
+    )
+# Calls read per day and model for the latency percentiles of /llm/report.
+app.config['LLM_REPORT_SAMPLE'] = int(
+    os.environ.get('LLM_REPORT_SAMPLE', 5000)
+    )
+# Dollars per 1000 prompt and completion tokens, by model.
+app.config['LLM_PRICES'] = json.loads(os.environ.get(
+    'LLM_PRICES', '{"gpt-3.5-turbo": [0.0005, 0.0015]}'
+    ))
+app.config['ASGI_THREADS'] = int(os.environ.get('ASGI_THREADS', 32))
+app.config['RECOMMENDER_NEIGHBORS'] = int(
+    os.environ.get('RECOMMENDER_NEIGHBORS', 20)
+    )
+app.config['UNIVERSITY_CACHE_MAX_ENTRIES'] = int(
+    os.environ.get('UNIVERSITY_CACHE_MAX_ENTRIES', 4096)
+    )
+app.config['COMPARE_MAX_UNIVERSITIES'] = int(
+    os.environ.get('COMPARE_MAX_UNIVERSITIES', 20)
+    )
+app.config['IMPORT_BATCH_SIZE'] = int(
+    os.environ.get('IMPORT_BATCH_SIZE', 1000)
+    )
+app.config['EXPORT_BATCH_SIZE'] = int(
+    os.environ.get('EXPORT_BATCH_SIZE', 1000)
+    )
+app.config['USER_CACHE_MAX_ENTRIES'] = int(
+    os.environ.get('USER_CACHE_MAX_ENTRIES', 1024)
+    )
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 60))
+# Query counts and times describe the backend, so they are only sent
+# in debug and testing unless DB_STATS_HEADERS says otherwise.
+app.config['DB_STATS_HEADERS'] = os.environ.get('DB_STATS_HEADERS')
+if app.config['DB_STATS_HEADERS'] is not None:
+    app.config['DB_STATS_HEADERS'] = app.config[
+        'DB_STATS_HEADERS'].lower() in ('1', 'true', 'yes')
+app.config['DB_REPEATED_QUERY_WARNING'] = int(
+    os.environ.get('DB_REPEATED_QUERY_WARNING', 0)
+    )
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get(
+    'PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'
+    )
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2)
+    )
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_PENDING', 16)
+    )
+app.config['PASSWORD_HASH_QUEUE_TIMEOUT'] = float(
+    os.environ.get('PASSWORD_HASH_QUEUE_TIMEOUT', 2)
+    )
+app.config['PASSWORD_HASH_TIMEOUT'] = float(
+    os.environ.get('PASSWORD_HASH_TIMEOUT', 30)
+    )
+app.config['EMAIL_FILTER_CAPACITY'] = int(
+    os.environ.get('EMAIL_FILTER_CAPACITY', 100000)
+    )
+app.config['EMAIL_FILTER_ERROR_RATE'] = float(
+    os.environ.get('EMAIL_FILTER_ERROR_RATE', 0.01)
+    )
+app.config['EMAIL_FILTER_SYNC_INTERVAL'] = float(
+    os.environ.get('EMAIL_FILTER_SYNC_INTERVAL', 1)
+    )
+app.config['EMAIL_FILTER_REBUILD_INTERVAL'] = float(
+    os.environ.get('EMAIL_FILTER_REBUILD_INTERVAL', 3600)
+    )
+app.config['EMAIL_FILTER_LOG_RETENTION'] = float(
+    os.environ.get('EMAIL_FILTER_LOG_RETENTION', 86400)
+    )
+app.config['EMAIL_FILTER_SYNC_WINDOW'] = float(
+    os.environ.get('EMAIL_FILTER_SYNC_WINDOW', 60)
+    )
+app.config['FRAGMENT_CACHE_MAX_ENTRIES'] = int(
+    os.environ.get('FRAGMENT_CACHE_MAX_ENTRIES', 256)
+    )
+app.config['FRAGMENT_CACHE_MAX_BYTES'] = int(
+    os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 8 * 1024 * 1024)
+    )
+app.config['OUTBOX_BATCH_SIZE'] = int(os.environ.get('OUTBOX_BATCH_SIZE', 50))
+app.config['OUTBOX_POLL_INTERVAL'] = float(
+    os.environ.get('OUTBOX_POLL_INTERVAL', 5)
+    )
+app.config['OUTBOX_MAX_ATTEMPTS'] = int(
+    os.environ.get('OUTBOX_MAX_ATTEMPTS', 8)
+    )
+app.config['OUTBOX_RETRY_BASE_DELAY'] = float(
+    os.environ.get('OUTBOX_RETRY_BASE_DELAY', 30)
+    )
+app.config['OUTBOX_RETRY_MAX_DELAY'] = float(
+    os.environ.get('OUTBOX_RETRY_MAX_DELAY', 3600)
+    )
+app.config['OUTBOX_IDLE_TIMEOUT'] = float(
+    os.environ.get('OUTBOX_IDLE_TIMEOUT', 60)
+    )
+# Seconds a worker has to send a claimed batch before another may retry it.
+app.config['OUTBOX_LEASE_TIMEOUT'] = float(
+    os.environ.get('OUTBOX_LEASE_TIMEOUT', 600)
+    )
+# Bearer token Prometheus must send to read /metrics; open when empty,
+# nginx keeping it to internal networks either way.
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# Proxies in front of the app whose X-Forwarded-For is trusted: nginx.
+app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', 1))
+app.config['ASSETS_PREFIX'] = os.environ.get('ASSETS_PREFIX', 'dist')
+app.config['ASSETS_MAX_AGE'] = int(
+    os.environ.get('ASSETS_MAX_AGE', 365 * 24 * 3600)
+    )
 
 CHATGPT_API_KEY = os.environ.get('CHATGPT_API_KEY')
 
@@ -27,6 +237,31 @@ login_manager.init_app(app)
 
 mail = Mail()
 mail.init_app(app)
+outbox.init_app(app, mail)
+# Start the sender in every worker, not only in those that queue emails.
+app.before_request(outbox.start)
+
+query_monitor = QueryMonitor(app)
+static_assets = StaticAssets(app)
+hasher.configure(
+    app.config['PASSWORD_HASH_METHOD'],
+    app.config['PASSWORD_HASH_WORKERS'],
+    app.config['PASSWORD_HASH_MAX_PENDING'],
+    app.config['PASSWORD_HASH_QUEUE_TIMEOUT'],
+    app.config['PASSWORD_HASH_TIMEOUT']
+    )
+email_filter.configure(
+    app.config['EMAIL_FILTER_CAPACITY'],
+    app.config['EMAIL_FILTER_ERROR_RATE'],
+    app.config['EMAIL_FILTER_SYNC_INTERVAL'],
+    app.config['EMAIL_FILTER_REBUILD_INTERVAL'],
+    app.config['EMAIL_FILTER_LOG_RETENTION'],
+    app.config['EMAIL_FILTER_SYNC_WINDOW']
+    )
+llm_calls.init_app(app)
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+app.wsgi_app = MetricsMiddleware(app)
 
 from app import routes
+from api import routes_api
 
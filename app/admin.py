@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+""" Module to restrict routes to the administrators of the app. """
+
+from functools import wraps
+from flask import abort, current_app
+from flask_login import current_user
+
+
+def is_admin(user):
+    """
+    Tell whether a user is an administrator.
+
+    Administrators are the users whose email is listed in ADMIN_EMAILS.
+
+    Args:
+        user: The user, possibly anonymous.
+    """
+    if not user.is_authenticated or not user.email:
+        return False
+    return user.email.lower() in current_app.config['ADMIN_EMAILS']
+
+
+def admin_required(view):
+    """
+    Decorate a view so only administrators reach it.
+
+    Anonymous users are handled like `login_required` does; other users
+    get a 403.
+    """
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return current_app.login_manager.unauthorized()
+        if not is_admin(current_user):
+            abort(403)
+        return view(*args, **kwargs)
+    return decorated
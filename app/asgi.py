@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+""" Module to serve the LLM routes from an asyncio event loop. """
+
+import asyncio
+import io
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import request
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app import llm_calls, routes
+from app.llm_cache import cache_key
+from app.llm_executor import LLMUnavailable
+from app.metrics import IN_FLIGHT, REQUEST_LATENCY, REQUESTS
+from app.outbox import outbox
+from app.retrieval import cited_sources
+
+
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream; charset=utf-8'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),
+    ]
+
+
+def wsgi_environ(scope, body):
+    """
+    Build the WSGI environ of an ASGI HTTP request.
+
+    Args:
+        scope (dict): The ASGI connection scope.
+        body (file): The request body, read from the start.
+
+    Returns:
+        dict: The environ.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    script_name = scope.get('root_path', '').encode('utf-8').decode('latin-1')
+    path_info = scope['path'].encode('utf-8').decode('latin-1')
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+class WSGIBridge:
+    """
+    ASGI app running a WSGI app in a pool of threads.
+
+    Each request holds one thread from its first byte to its last, as
+    under a threaded WSGI server; the body is read before the app is
+    called and the response iterable is always closed, so WSGI
+    middleware such as `MetricsMiddleware` sees every request end.
+
+    Attributes:
+        wsgi_app (callable): The WSGI app.
+        threads (ThreadPoolExecutor): The threads serving requests.
+    """
+
+    def __init__(self, wsgi_app, threads=32):
+        self.wsgi_app = wsgi_app
+        self.threads = ThreadPoolExecutor(threads,
+                                          thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        with tempfile.SpooledTemporaryFile(max_size=65536) as body:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                self.threads, self._run, wsgi_environ(scope, body),
+                send, loop)
+
+    def _run(self, environ, send, loop):
+        """ Call the WSGI app and send its response, in a worker thread. """
+        def sync_send(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        start = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and start.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            start.update(message={
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers]
+                })
+
+        iterable = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in iterable:
+                if not start.get('sent'):
+                    start['sent'] = True
+                    sync_send(start['message'])
+                if chunk:
+                    sync_send({'type': 'http.response.body', 'body': chunk,
+                               'more_body': True})
+            if not start.get('sent'):
+                start['sent'] = True
+                sync_send(start['message'])
+            sync_send({'type': 'http.response.body'})
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+
+class SearchApp:
+    """
+    ASGI app answering /search and /search/stream on the event loop and
+    handing every other request to the Flask app.
+
+    The routes behave as their Flask counterparts in `app.routes`. The
+    quick, blocking steps (reading the session, building the grounded
+    prompt, the answer cache) run in the loop's thread pool within a
+    Flask request context; waiting on the model only holds a coroutine,
+    so one process serves thousands of slow calls at once. A request
+    whose client disconnects is cancelled, which closes its upstream
+    stream and, for merged calls, the call once nobody waits for it.
+
+    Other requests go to a `WSGIBridge` and run in its threads exactly
+    as they would under a threaded WSGI server; the blocking steps of
+    the LLM routes share those threads.
+
+    Attributes:
+        flask_app (Flask): The app serving everything else.
+        gateway (AsyncLLMGateway): The async route to the model.
+        wsgi (WSGIBridge): Serves every other request.
+    """
+
+    def __init__(self, flask_app, gateway, wsgi=None):
+        self.flask_app = flask_app
+        self.gateway = gateway
+        self.wsgi = wsgi or WSGIBridge(flask_app,
+                                       flask_app.config['ASGI_THREADS'])
+        # The LLM routes build their request context without the WSGI
+        # middleware, so trust the same proxies as its ProxyFix does.
+        self._proxy_fix = ProxyFix(lambda environ, start_response: environ,
+                                   x_for=flask_app.config['PROXY_FIX_X_FOR'])
+        self.routes = {
+            '/search': ('search', self.search),
+            '/search/stream': ('search_stream', self.search_stream),
+            }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        route = None
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            route = self.routes.get(scope['path'].rstrip('/'))
+        if route is None:
+            await self.wsgi(scope, receive, send)
+            return
+        endpoint, handler = route
+        started = time.perf_counter()
+        status = ['500']
+
+        async def recording_send(message):
+            if message['type'] == 'http.response.start':
+                status[0] = str(message['status'])
+            await send(message)
+
+        IN_FLIGHT.labels(endpoint).inc()
+        try:
+            await _until_disconnected(handler(scope, recording_send), receive)
+        finally:
+            IN_FLIGHT.labels(endpoint).dec()
+            REQUEST_LATENCY.labels('GET', endpoint).observe(
+                time.perf_counter() - started)
+            REQUESTS.labels('GET', endpoint, status[0]).inc()
+
+    async def lifespan(self, receive, send):
+        """
+        Start the outbox sender with the server, and stop it and close
+        the shared connection pool when the server stops.
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                outbox.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.to_thread(
+                    outbox.stop, self.flask_app.config['OUTBOX_IDLE_TIMEOUT'])
+                await self.gateway.client.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _in_thread(self, function, *args):
+        """ Run a blocking function in the bridge's threads. """
+        return await asyncio.get_running_loop().run_in_executor(
+            self.wsgi.threads, function, *args)
+
+    def _prepare(self, scope):
+        """ The blocking start of both routes, run in a worker thread. """
+        environ = self._proxy_fix(wsgi_environ(scope, io.BytesIO()), None)
+        with self.flask_app.request_context(environ):
+            question = request.args.get('question')
+            model = self.flask_app.config['SEARCH_MODEL']
+            system_prompt, rows = routes.search_prompt(question)
+            cached = routes.search_cache.get(question, system_prompt, model)
+            user = routes.llm_user()
+            return question, model, system_prompt, rows, cached, user
+
+    async def _send_json(self, send, status, payload, headers=()):
+        """ Send a JSON response, formatted as Flask's jsonify does. """
+        body = (self.flask_app.json.dumps(payload) + '\n').encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [
+                        (b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode('latin-1')),
+                        ] + list(headers)})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _send_unavailable(self, send, error):
+        """ Send the response of a refused model call, as `llm_unavailable`. """
+        headers = []
+        if error.retry_after is not None:
+            headers.append((b'retry-after',
+                            str(error.retry_after).encode('latin-1')))
+        await self._send_json(send, error.status,
+                              {'success': False, 'error': str(error)},
+                              headers)
+
+    async def search(self, scope, send):
+        """ Answer /search, as `routes.search`. """
+        started = time.perf_counter()
+        question, model, system_prompt, rows, cached, user = (
+            await self._in_thread(self._prepare, scope))
+        if cached is not None:
+            llm_calls.record('search', model, user, 'hit', 'ok', started,
+                             question=question)
+            await self._send_json(send, 200, {
+                'success': True, 'answer': cached['answer'],
+                'sources': cited_sources(cached['answer'], rows),
+                'cached': True})
+            return
+        try:
+            completion = await self.gateway.complete(
+                routes.search_messages(question, system_prompt), model,
+                user=user, key=cache_key(question, system_prompt, model),
+                endpoint='search', question=question,
+                max_tokens=self.flask_app.config['SEARCH_MAX_TOKENS']
+                )
+        except LLMUnavailable as error:
+            await self._send_unavailable(send, error)
+            return
+        answer = completion.choices[0].message.content.strip()
+        await self._in_thread(routes.search_cache.set, question,
+                              system_prompt, model, {'answer': answer})
+        await self._send_json(send, 200, {
+            'success': True, 'answer': answer,
+            'sources': cited_sources(answer, rows), 'cached': False})
+
+    async def search_stream(self, scope, send):
+        """ Answer /search/stream, as `routes.search_stream`. """
+        started = time.perf_counter()
+        question, model, system_prompt, rows, cached, user = (
+            await self._in_thread(self._prepare, scope))
+        permit = deltas = None
+        if cached is None:
+            try:
+                permit, deltas = await self.gateway.stream(
+                    routes.search_messages(question, system_prompt), model,
+                    user=user, endpoint='search_stream', question=question,
+                    max_tokens=self.flask_app.config['SEARCH_MAX_TOKENS']
+                    )
+            except LLMUnavailable as error:
+                await send({'type': 'http.response.start', 'status': 200,
+                            'headers': SSE_HEADERS})
+                await send({'type': 'http.response.body',
+                            'body': routes.unavailable_event(error)
+                            .encode('utf-8')})
+                return
+        else:
+            llm_calls.record('search_stream', model, user, 'hit', 'ok',
+                             started, question=question)
+
+        async def event(data, event=None, last=False):
+            await send({'type': 'http.response.body',
+                        'body': routes.sse_event(data, event).encode('utf-8'),
+                        'more_body': not last})
+
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': SSE_HEADERS})
+            if cached is not None:
+                await event({'delta': cached['answer']})
+                await event({
+                    'cached': True,
+                    'sources': cited_sources(cached['answer'], rows)
+                    }, 'done', last=True)
+                return
+            parts = []
+            try:
+                async for delta in deltas:
+                    parts.append(delta)
+                    await event({'delta': delta})
+            except LLMUnavailable as error:
+                await event({'error': str(error)}, 'failed', last=True)
+                return
+        finally:
+            if permit is not None:
+                # Give the slot back even if the client left mid stream.
+                permit.release()
+                await deltas.aclose()
+        answer = ''.join(parts).strip()
+        await self._in_thread(routes.search_cache.set, question,
+                              system_prompt, model, {'answer': answer})
+        await event({
+            'cached': False,
+            'sources': cited_sources(answer, rows)
+            }, 'done', last=True)
+
+
+async def _until_disconnected(coroutine, receive):
+    """ Await a coroutine, cancelling it if the client goes away first. """
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    task = asyncio.ensure_future(coroutine)
+    watcher = asyncio.ensure_future(disconnected())
+    try:
+        await asyncio.wait({task, watcher},
+                           return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+            # Let the handler release what it holds before returning.
+            await asyncio.gather(task, return_exceptions=True)
+    if not task.cancelled():
+        task.result()
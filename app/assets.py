@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+""" Module to build and serve fingerprinted, precompressed static files. """
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+import click
+from flask import request, send_from_directory, url_for
+from werkzeug.utils import safe_join
+
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.xml', '.map')
+MIN_COMPRESS_SIZE = 256
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_CSS_TOKENS = re.compile(
+    r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|(/\*.*?\*/)', re.S
+    )
+_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+_JS_TOKENS = re.compile(
+    r'("(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|`(?:\\.|[^`\\])*`)'
+    r'|(/\*.*?\*/|//[^\n]*)'
+    r'|(/(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[a-z]*)'
+    r'|(\s+)', re.S
+    )
+# A slash after one of these starts a regular expression, not a division.
+_REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^')
+
+
+def minify_css(text):
+    """
+    Strip comments and needless whitespace from a stylesheet.
+
+    Strings are left untouched, and spaces that may matter, such as
+    those inside calc() or before a pseudo-class, are kept.
+    """
+    parts = []
+    for index, part in enumerate(_CSS_TOKENS.split(text)):
+        if part is None or index % 3 == 2:
+            continue
+        if index % 3 == 1:
+            parts.append(part)
+            continue
+        part = re.sub(r'\s+', ' ', part)
+        part = re.sub(r'\s*([{};,>])\s*', r'\1', part)
+        part = re.sub(r':\s+', ':', part)
+        parts.append(part.replace(';}', '}'))
+    return ''.join(parts).strip()
+
+
+def minify_js(text):
+    """
+    Strip comments and indentation from a script.
+
+    Line breaks are kept so automatic semicolon insertion still applies;
+    strings, template literals and regular expressions are left
+    untouched.
+    """
+    parts = []
+    position = 0
+    previous = ''
+    for match in _JS_TOKENS.finditer(text):
+        if match.start() > position:
+            code = text[position:match.start()]
+            parts.append(code)
+            previous = code.rstrip()[-1:] or previous
+        string, comment, regex, space = match.groups()
+        if regex is not None and previous not in _REGEX_PRECEDERS | {''}:
+            # A division: emit the slash alone and scan on from there.
+            parts.append('/')
+            previous = '/'
+            position = match.start() + 1
+            continue
+        position = match.end()
+        if comment is not None:
+            parts.append('\n' if comment.startswith('//') or
+                         '\n' in comment else ' ')
+        elif space is not None:
+            parts.append('\n' if '\n' in space else ' ')
+        else:
+            parts.append(match.group())
+            previous = match.group()[-1]
+    parts.append(text[position:])
+    lines = (line.strip() for line in ''.join(parts).split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+
+def fingerprint(path, content):
+    """ Return a path with a hash of the content before its extension. """
+    root, extension = posixpath.splitext(path)
+    return '{}.{}{}'.format(
+        root, hashlib.sha256(content).hexdigest()[:12], extension)
+
+
+def _rewrite_urls(css, path, manifest, prefix):
+    """ Point relative url()s of a stylesheet at fingerprinted files. """
+    directory = posixpath.dirname(path)
+
+    def replace(match):
+        quote, target = match.groups()
+        if re.match(r'^(?:[a-z]+:|/|#)', target, re.I):
+            return match.group()
+        target, _, suffix = target.partition('?')
+        key = posixpath.normpath(posixpath.join(directory, target))
+        if key not in manifest:
+            return match.group()
+        relative = posixpath.relpath(
+            manifest[key], posixpath.join(prefix, directory))
+        return 'url({0}{1}{0})'.format(quote, relative)
+
+    return _CSS_URL.sub(replace, css)
+
+
+def build(static_folder, prefix='dist', gzip_level=9, brotli_quality=11):
+    """
+    Minify, fingerprint and precompress every file of the static folder.
+
+    Files are written under `prefix` with a hash of their content in
+    their name, next to a manifest.json mapping each original path to
+    its fingerprinted one. Text files also get .gz and, when the brotli
+    package is installed, .br variants. Earlier builds are removed.
+
+    Args:
+        static_folder (str): The folder of the app's static files.
+        prefix (str): The subfolder to write into.
+        gzip_level (int): The gzip compression level.
+        brotli_quality (int): The brotli quality.
+
+    Returns:
+        dict: The manifest.
+    """
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    output = os.path.join(static_folder, prefix)
+    shutil.rmtree(output, ignore_errors=True)
+
+    sources = []
+    for directory, folders, files in os.walk(static_folder):
+        if os.path.abspath(directory) == os.path.abspath(static_folder):
+            folders[:] = [folder for folder in folders if folder != prefix]
+        for name in files:
+            if not name.endswith(('.gz', '.br')):
+                sources.append(os.path.relpath(
+                    os.path.join(directory, name), static_folder
+                    ).replace(os.sep, '/'))
+    # Stylesheets go last, so the files they refer to are named already.
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+
+    manifest = {}
+    for path in sources:
+        with open(os.path.join(static_folder, path), 'rb') as file:
+            content = file.read()
+        if path.endswith('.css'):
+            content = minify_css(_rewrite_urls(
+                content.decode('utf-8'), path, manifest, prefix
+                )).encode('utf-8')
+        elif path.endswith('.js'):
+            content = minify_js(content.decode('utf-8')).encode('utf-8')
+        target = posixpath.join(prefix, fingerprint(path, content))
+        manifest[path] = target
+        destination = os.path.join(static_folder, target)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        variants = [('', content)]
+        if path.endswith(COMPRESSIBLE) and len(content) >= MIN_COMPRESS_SIZE:
+            variants.append(('.gz', gzip.compress(
+                content, gzip_level, mtime=0)))
+            if brotli is not None:
+                variants.append(('.br', brotli.compress(
+                    content, quality=brotli_quality)))
+        for suffix, data in variants:
+            if suffix and len(data) >= len(content):
+                continue
+            with open(destination + suffix, 'wb') as file:
+                file.write(data)
+
+    with open(os.path.join(output, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+
+class StaticAssets:
+    """
+    Serve the output of `build` and resolve asset URLs in templates.
+
+    Templates call `asset_url('css/style.css')`, which points at the
+    fingerprinted copy when a build exists and at the original file
+    otherwise. Fingerprinted files never change, so they are sent with
+    an immutable, year long Cache-Control; their .br or .gz variant is
+    sent instead when the client accepts it. ETags and conditional
+    requests come from Flask's send_file.
+
+    Attributes:
+        manifest (dict): Original paths mapped to fingerprinted ones.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.folder = app.static_folder
+        self.prefix = app.config['ASSETS_PREFIX']
+        self.max_age = app.config['ASSETS_MAX_AGE']
+        self.path = os.path.join(self.folder, self.prefix, 'manifest.json')
+        self.manifest = {}
+        self._mtime = None
+        self.load()
+        app.add_template_global(self.url, 'asset_url')
+        app.view_functions['static'] = self.send
+        app.cli.command('build-assets')(self._build_command)
+
+    def load(self):
+        """ Read the manifest again if it changed since the last read. """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self.manifest, self._mtime = {}, None
+            return
+        if mtime != self._mtime:
+            with open(self.path) as file:
+                self.manifest = json.load(file)
+            self._mtime = mtime
+
+    def url(self, filename, **values):
+        """
+        Return the URL of a static file, fingerprinted if it was built.
+
+        Args:
+            filename (str): The path of the file in the static folder.
+        """
+        if self.app.debug:
+            self.load()
+        return url_for('static', filename=self.manifest.get(
+            filename, filename), **values)
+
+    def send(self, filename):
+        """ The static route: precompressed and cached when fingerprinted. """
+        if not filename.startswith(self.prefix + '/'):
+            return self.app.send_static_file(filename)
+        mimetype = mimetypes.guess_type(filename)[0]
+        suffix = ''
+        encoding = None
+        if filename.endswith(COMPRESSIBLE):
+            for name, extension in ENCODINGS:
+                variant = safe_join(self.folder, filename + extension)
+                if (request.accept_encodings[name] and variant
+                        and os.path.isfile(variant)):
+                    suffix, encoding = extension, name
+                    break
+        response = send_from_directory(
+            self.folder, filename + suffix,
+            mimetype=mimetype or 'application/octet-stream',
+            max_age=self.max_age
+            )
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        if filename.endswith(COMPRESSIBLE):
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    def _build_command(self):
+        """ Minify, fingerprint and precompress the static files. """
+        manifest = build(self.folder, self.prefix)
+        self.load()
+        click.echo('Built {} assets into {}'.format(
+            len(manifest), os.path.join(self.folder, self.prefix)))
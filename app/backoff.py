@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+""" Module to space out the retries of calls to other services. """
+
+import random
+
+
+def backoff_delay(attempt, base_delay, max_delay, error=None):
+    """
+    Return how long to wait before retrying, with full jitter.
+
+    A Retry-After header sent by the upstream wins over the computed
+    delay when it is within `max_delay`.
+
+    Args:
+        attempt (int): The number of attempts already made, from 1.
+        base_delay (float): The delay ceiling of the first retry.
+        max_delay (float): The largest delay ever returned.
+        error (Exception): The error that caused the retry.
+    """
+    response = getattr(error, 'response', None)
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get('retry-after'))
+        except (TypeError, ValueError):
+            retry_after = None
+        if retry_after is not None and 0 <= retry_after <= max_delay:
+            return retry_after
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
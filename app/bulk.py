@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+""" Module to bulk load universities from CSV or JSON lines files. """
+
+import csv
+import datetime
+import json
+import time
+import uuid
+from app import catalog
+from app.dialects import insert_ignore, upsert
+from app.models import University, db
+
+
+FIELDS = ('name', 'location', 'website', 'status')
+UPDATE_FIELDS = ('location', 'website', 'status')
+
+
+def read_rows(path):
+    """
+    Stream the rows of a CSV or JSON lines file.
+
+    The format is chosen from the extension: `.csv` files need a header
+    line, anything else is read as one JSON object per line.
+
+    Args:
+        path (str): The file to read.
+
+    Yields:
+        tuple: (line_number, row) where row is a dictionary, or None when
+        the line could not be parsed.
+    """
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        if path.lower().endswith('.csv'):
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row if isinstance(row, dict) else None
+
+
+def validate_row(row):
+    """
+    Check and clean one input row.
+
+    Args:
+        row (dict): The row as read from the file.
+
+    Returns:
+        tuple: (values, error) where values holds the cleaned columns of
+        a valid row and error describes why an invalid one is rejected.
+    """
+    if row is None:
+        return None, 'unreadable line'
+    values = {}
+    for field in FIELDS:
+        value = row.get(field)
+        value = str(value).strip() if value is not None else ''
+        length = University.__table__.c[field].type.length
+        if len(value) > length:
+            return None, '{} longer than {} characters'.format(field, length)
+        values[field] = value or None
+    for field in ('name', 'location'):
+        if values[field] is None:
+            return None, 'missing {}'.format(field)
+    values['status'] = values['status'] or 'closed'
+    return values, None
+
+
+class BulkLoader:
+    """
+    Load universities in batches, one executemany and commit per batch.
+
+    Rows are matched on the unique university name. When inserting, a
+    name already in the database or earlier in the file is rejected;
+    when upserting, it overwrites the location, website and status of
+    the existing row, keeping its id and likes.
+
+    Attributes:
+        upsert (bool): Whether existing names are updated.
+        batch_size (int): Rows sent to the database per statement.
+        read (int): Rows read from the file.
+        inserted (int): New universities.
+        updated (int): Existing universities overwritten.
+        rejected (int): Rows written to the rejects file.
+    """
+
+    def __init__(self, upsert=False, batch_size=1000, rejects_path=None,
+                 progress=None, clock=time.monotonic):
+        self.upsert = upsert
+        self.batch_size = batch_size
+        self.rejects_path = rejects_path
+        self.progress = progress
+        self.read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.rejected = 0
+        self._clock = clock
+        self._started = None
+        self._rejects = None
+        self._seen = set()
+
+    def load(self, path):
+        """
+        Load every row of a file.
+
+        Must be called within an application context. Every batch is
+        committed on its own, so an interrupted load keeps the batches
+        done so far.
+
+        Args:
+            path (str): The CSV or JSON lines file to load.
+
+        Returns:
+            dict: The load statistics, see `stats`.
+        """
+        if self.rejects_path is None:
+            self.rejects_path = path + '.rejected.jsonl'
+        self._started = self._clock()
+        batch = {}
+        try:
+            for line_number, row in read_rows(path):
+                self.read += 1
+                values, error = validate_row(row)
+                if error is None and not self.upsert and (
+                        values['name'] in batch
+                        or values['name'] in self._seen):
+                    error = 'duplicate name in file'
+                if error is not None:
+                    self._reject(line_number, row, error)
+                    continue
+                if values['name'] in batch:
+                    # A later row for the same name wins.
+                    self.updated += 1
+                batch[values['name']] = (line_number, row, values)
+                if len(batch) >= self.batch_size:
+                    self._flush(batch)
+                    batch = {}
+            if batch:
+                self._flush(batch)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            if self._rejects is not None:
+                self._rejects.close()
+            # Rows were written without ORM events; drop derived state.
+            catalog.notify('reset')
+        return self.stats()
+
+    def _flush(self, batch):
+        """ Write one batch and commit it. """
+        names = list(batch)
+        existing = set(db.session.scalars(
+            db.select(University.name).where(University.name.in_(names))
+            ))
+        table = University.__table__
+        dialect_name = db.session.get_bind().dialect.name
+        if self.upsert:
+            statement = upsert(table, dialect_name, ['name'],
+                               UPDATE_FIELDS + ('updated_at',))
+        else:
+            statement = insert_ignore(table, dialect_name)
+        now = datetime.datetime.now(
+            datetime.timezone.utc).replace(tzinfo=None)
+        rows = []
+        for name, (line_number, row, values) in batch.items():
+            if name in existing and not self.upsert:
+                self._reject(line_number, row, 'name already exists')
+                continue
+            rows.append(dict(values, id=str(uuid.uuid4()), updated_at=now))
+        if rows:
+            db.session.execute(statement, rows)
+        db.session.commit()
+        updated = len(existing) if self.upsert else 0
+        self.updated += updated
+        self.inserted += len(rows) - updated
+        self._seen.update(names)
+        if self.progress is not None:
+            self.progress(self.stats())
+
+    def _reject(self, line_number, row, error):
+        """ Append a rejected row to the rejects file. """
+        if self._rejects is None:
+            self._rejects = open(self.rejects_path, 'w', encoding='utf-8')
+        self._rejects.write(json.dumps(
+            {'line': line_number, 'error': error, 'row': row}) + '\n')
+        self.rejected += 1
+
+    def stats(self):
+        """ Return the load counters and throughput as a dictionary. """
+        elapsed = max(self._clock() - self._started, 1e-9)
+        return {
+            'read': self.read,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'rejected': self.rejected,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(self.read / elapsed, 1),
+            'rejects_path': self.rejects_path if self.rejected else None
+            }
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+""" Module to define a thread safe, size bounded LRU cache with expiry. """
+
+import threading
+import time
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Least recently used cache with an optional time to live.
+
+    Attributes:
+        max_entries (int): Entries kept before the least recently used one
+            is evicted.
+        ttl (float): Seconds an entry stays valid, or None to never expire.
+        max_bytes (int): Total size of the values kept before the least
+            recently used ones are evicted, or None for no such bound.
+        size (int): Total size of the values kept, as given by `sizeof`.
+        hits (int): Number of lookups that found a valid entry.
+        misses (int): Number of lookups that did not.
+        evictions (int): Number of entries dropped to respect max_entries.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None, clock=time.monotonic,
+                 max_bytes=None, sizeof=len):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._sizeof = sizeof
+        self._sizes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def get(self, key, default=None, count=True):
+        """
+        Return the value stored for a key and mark it as recently used.
+
+        Args:
+            key: The cache key.
+            default: Returned when the key is missing or expired.
+            count (bool): Whether to count the lookup in hits and misses.
+        """
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires_at = entry
+                if expires_at is None or expires_at > self._clock():
+                    self._data.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return value
+                self._remove(key)
+            if count:
+                self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=_MISSING):
+        """
+        Store a value, evicting the least recently used entries if needed.
+
+        Args:
+            key: The cache key.
+            value: The value to store.
+            ttl (float): Overrides the cache wide time to live.
+        """
+        ttl = self.ttl if ttl is _MISSING else ttl
+        expires_at = None if ttl is None else self._clock() + ttl
+        with self._lock:
+            self._remove(key)
+            if self.max_bytes is not None:
+                size = self._sizeof(value)
+                if size > self.max_bytes:
+                    return
+                self._sizes[key] = size
+                self.size += size
+            self._data[key] = (value, expires_at)
+            while (len(self._data) > self.max_entries or
+                   self.max_bytes is not None and self.size > self.max_bytes):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        if self._data.pop(key, _MISSING) is not _MISSING:
+            self.size -= self._sizes.pop(key, 0)
+
+    def delete(self, key):
+        """ Remove a key from the cache if present. """
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """ Remove every entry, keeping the counters. """
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Return the cache counters as a dictionary. """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._data),
+            'size': self.size
+        }
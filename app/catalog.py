@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+""" Module to version the university catalog and notify subscribers of changes. """
+
+import datetime
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+from app.models import CatalogVersion, University, db
+
+
+# Columns whose changes are not catalog changes, so do not bump the version.
+COUNTER_COLUMNS = ('like_count',)
+
+_subscribers = []
+
+
+def subscribe(callback):
+    """
+    Register a callback for committed catalog changes.
+
+    The callback is called as `callback(action, row, version)` where
+    action is one of 'insert', 'update', 'delete' or 'reset', row is the
+    dictionary form of the university (None for 'reset', which means the
+    catalog changed in a way that was not tracked row by row) and version
+    is the catalog version the committed transaction moved to, or None
+    when it is not known.
+
+    Args:
+        callback (callable): The function to call on every change.
+
+    Returns:
+        callable: The callback, so this can be used as a decorator.
+    """
+    _subscribers.append(callback)
+    return callback
+
+
+def notify(action, row=None, version=None):
+    """
+    Send a catalog change to every subscriber.
+
+    Args:
+        action (str): 'insert', 'update', 'delete' or 'reset'.
+        row (dict): The university as returned by `University.to_dict`.
+        version (int): The catalog version the change was committed at.
+    """
+    for callback in _subscribers:
+        callback(action, row, version)
+
+
+def version():
+    """
+    Return the catalog version and the time it last went up.
+
+    The version goes up once per committed transaction that inserts,
+    updates or deletes universities, from any process: ORM flushes and
+    bulk statements run through the session both bump it. Statements
+    that only move counters opt out with the execution option
+    `bump_catalog_version=False`. Costs one primary key lookup; must be
+    called within an application context.
+
+    Returns:
+        tuple: The version number and a naive UTC datetime.
+    """
+    row = db.session.execute(
+        db.select(CatalogVersion.version, CatalogVersion.updated_at)
+        .where(CatalogVersion.id == 1)
+        ).first()
+    return (row.version, row.updated_at) if row is not None else (0, None)
+
+
+def _utcnow():
+    """ Return the current time as a naive UTC datetime. """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _bump(session, connection):
+    """
+    Bump the version, once per transaction, within that transaction.
+
+    The new number is kept on the session so subscribers learn which
+    version the changes they are sent bring them to; the update holds
+    the row lock until commit, so no other writer can come in between.
+    """
+    if session is None or 'catalog_version' in session.info:
+        return
+    table = CatalogVersion.__table__
+    connection.execute(
+        table.update().where(table.c.id == 1).values(
+            version=table.c.version + 1,
+            updated_at=_utcnow()
+            )
+        )
+    session.info['catalog_version'] = connection.execute(
+        db.select(table.c.version).where(table.c.id == 1)
+        ).scalar()
+
+
+def _content_changed(target):
+    """ Tell whether a flushed update changed more than counters. """
+    state = inspect(target)
+    return any(
+        state.attrs[column.key].history.has_changes()
+        for column in University.__mapper__.column_attrs
+        if column.key not in COUNTER_COLUMNS
+        )
+
+
+def _record(action, target):
+    """ Queue a change on the session until it is committed. """
+    session = object_session(target)
+    if session is None:
+        return
+    session.info.setdefault('catalog_changes', []).append(
+        (action, target.to_dict())
+        )
+
+
+@event.listens_for(University, 'before_update')
+def _before_update(mapper, connection, target):
+    if _content_changed(target):
+        target.updated_at = _utcnow()
+
+
+@event.listens_for(University, 'after_insert')
+def _after_insert(mapper, connection, target):
+    _record('insert', target)
+    _bump(object_session(target), connection)
+
+
+@event.listens_for(University, 'after_update')
+def _after_update(mapper, connection, target):
+    _record('update', target)
+    if _content_changed(target):
+        _bump(object_session(target), connection)
+
+
+@event.listens_for(University, 'after_delete')
+def _after_delete(mapper, connection, target):
+    _record('delete', target)
+    _bump(object_session(target), connection)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _bulk_change(orm_execute_state):
+    statement = orm_execute_state.statement
+    table = getattr(statement, 'table', None)
+    if ((orm_execute_state.is_insert or orm_execute_state.is_update
+            or orm_execute_state.is_delete)
+            and getattr(table, 'name', None) == University.__tablename__
+            and orm_execute_state.execution_options.get(
+                'bump_catalog_version', True)):
+        if orm_execute_state.is_update:
+            orm_execute_state.statement = statement.values(
+                updated_at=_utcnow())
+        session = orm_execute_state.session
+        _bump(session, session.connection())
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    version = session.info.pop('catalog_version', None)
+    for action, row in session.info.pop('catalog_changes', []):
+        notify(action, row, version)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('catalog_version', None)
+    session.info.pop('catalog_changes', None)
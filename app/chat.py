@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+""" Module to keep conversations with the model within a token budget. """
+
+import datetime
+from app.models import ChatMessage, ChatSession, db
+from app.tokens import MESSAGE_TOKENS, count_message_tokens, count_tokens
+
+
+SUMMARY_PROMPT = (
+    'Summarize the conversation below in a few sentences for the '
+    'assistant that continues it. Keep what the user said about '
+    'themselves and what they are looking for, and the universities '
+    'discussed with their ids in square brackets.'
+    )
+SUMMARY_HEADER = 'Summary of the conversation so far:'
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def get_session(session_id, user_id):
+    """
+    Return a chat session of a user.
+
+    Args:
+        session_id (str): The id of the session.
+        user_id (str): The id of the user owning it.
+
+    Returns:
+        ChatSession: The session, or None if the user has no such session.
+    """
+    return db.session.execute(db.select(ChatSession).where(
+        ChatSession.id == session_id, ChatSession.user_id == user_id
+        )).scalar_one_or_none()
+
+
+def add_message(session, role, content):
+    """
+    Append a message to a session; the caller commits.
+
+    Args:
+        session (ChatSession): The session.
+        role (str): 'user' or 'assistant'.
+        content (str): The text of the message.
+
+    Returns:
+        ChatMessage: The new message.
+    """
+    message = ChatMessage(session_id=session.id, role=role, content=content,
+                          tokens=count_tokens(content))
+    db.session.add(message)
+    session.updated_at = _utcnow()
+    return message
+
+
+def unsummarized(session):
+    """
+    Return the messages of a session not condensed in its summary.
+
+    Args:
+        session (ChatSession): The session.
+
+    Returns:
+        list: ChatMessage rows, oldest first.
+    """
+    return db.session.execute(db.select(ChatMessage).where(
+        ChatMessage.session_id == session.id,
+        ChatMessage.id > session.summarized_through
+        ).order_by(ChatMessage.id)).scalars().all()
+
+
+def split_history(turns, budget):
+    """
+    Keep the most recent turns whose messages fit in a token budget.
+
+    Args:
+        turns (list): ChatMessage rows, oldest first.
+        budget (int): The tokens left for the history.
+
+    Returns:
+        tuple: The older turns left out and the turns kept, both oldest
+        first.
+    """
+    used = 0
+    start = len(turns)
+    while start > 0:
+        cost = turns[start - 1].tokens + MESSAGE_TOKENS
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    return turns[:start], turns[start:]
+
+
+def system_message(system_prompt, summary):
+    """ Return the system message, carrying the summary if there is one. """
+    if summary:
+        system_prompt = '{}\n\n{}\n{}'.format(system_prompt, SUMMARY_HEADER,
+                                               summary)
+    return {'role': 'system', 'content': system_prompt}
+
+
+def summary_messages(summary, turns):
+    """
+    Build the chat messages asking the model to fold turns into a summary.
+
+    Args:
+        summary (str): The current summary, or None.
+        turns (list): ChatMessage rows to add to it, oldest first.
+
+    Returns:
+        list: The messages of the summarization call.
+    """
+    lines = []
+    if summary:
+        lines.append('Summary so far: ' + summary)
+    lines.extend('{}: {}'.format(turn.role, turn.content) for turn in turns)
+    return [
+        {'role': 'system', 'content': SUMMARY_PROMPT},
+        {'role': 'user', 'content': '\n'.join(lines)}
+    ]
+
+
+def build_messages(session, system_prompt, question, budget, summarize=None,
+                   summary_tokens=0):
+    """
+    Build the chat messages for a new question of a session.
+
+    The system prompt, the running summary and the question always go
+    out; the most recent turns fill what is left of the budget. Turns
+    that no longer fit are folded into the summary with `summarize`,
+    once, and never loaded again; room is kept for the summary to grow
+    to `summary_tokens`. Without `summarize` they are dropped; if
+    `summarize` returns None they are only left out of this prompt and
+    summarized on a later question. The caller commits the session.
+
+    Args:
+        session (ChatSession): The session.
+        system_prompt (str): The system prompt of the question.
+        question (str): The new user message, not yet stored.
+        budget (int): The maximum prompt tokens.
+        summarize (callable): Takes the current summary and the turns
+            left out, and returns the new summary or None.
+        summary_tokens (int): The maximum tokens of a new summary.
+
+    Returns:
+        list: The messages to send to the model.
+    """
+    question_message = {'role': 'user', 'content': question}
+    fixed = [system_message(system_prompt, session.summary), question_message]
+    turns = unsummarized(session)
+    left_out, kept = split_history(turns,
+                                   budget - count_message_tokens(fixed))
+    if left_out and summarize is not None:
+        # Leave out enough turns for the new summary to fit as well.
+        room = (budget - summary_tokens - count_tokens(SUMMARY_HEADER)
+                - count_message_tokens([system_message(system_prompt, None),
+                                        question_message]))
+        left_out, kept = split_history(turns, room)
+    if left_out:
+        summary = session.summary
+        if summarize is not None:
+            summary = summarize(session.summary, left_out)
+        if summarize is None or summary is not None:
+            session.summary = summary
+            session.summarized_through = left_out[-1].id
+            fixed[0] = system_message(system_prompt, summary)
+        # The summary is only estimated to fit; recent turns that do
+        # not stay unsummarized for now.
+        _, kept = split_history(kept, budget - count_message_tokens(fixed))
+    return ([fixed[0]]
+            + [{'role': turn.role, 'content': turn.content} for turn in kept]
+            + [question_message])
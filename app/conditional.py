@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+""" Module to answer conditional GET requests before building the body. """
+
+import hashlib
+import json
+from flask import Response, request
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(*parts):
+    """
+    Return a strong entity tag for a response described by its inputs.
+
+    The parts must change whenever the body would, e.g. the endpoint,
+    its parameters and a version of the data it reads, so the tag can
+    be computed without rendering the body.
+
+    Args:
+        *parts: JSON serializable values identifying the response.
+
+    Returns:
+        str: The unquoted entity tag.
+    """
+    raw = json.dumps(parts, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+
+def set_validators(response, etag, last_modified=None):
+    """
+    Add the validators of a response and ask caches to revalidate it.
+
+    Args:
+        response (Response): The response to update.
+        etag (str): The tag returned by `make_etag`.
+        last_modified (datetime): When the data last changed, naive UTC.
+
+    Returns:
+        Response: The same response.
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    """
+    Return a 304 response if the client's copy is still current.
+
+    If-None-Match is checked first; If-Modified-Since only when the
+    request has no If-None-Match, at the one second resolution of HTTP
+    dates.
+
+    Args:
+        etag (str): The tag the response would have.
+        last_modified (datetime): When the data last changed, naive UTC.
+
+    Returns:
+        Response: A 304 response, or None when the body must be sent.
+    """
+    if is_resource_modified(request.environ, etag,
+                            last_modified=last_modified):
+        return None
+    return set_validators(Response(status=304), etag, last_modified)
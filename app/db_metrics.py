@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+""" Module to measure the database work done by each request. """
+
+import re
+import time
+from collections import Counter
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+PLACEHOLDER_LIST_RE = re.compile(
+    r'\(\s*(\?|%s|%\(\w+\)s|:\w+)(\s*,\s*(\?|%s|%\(\w+\)s|:\w+))*\s*\)'
+    )
+NUMBER_RE = re.compile(r'\b\d+\b')
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+SPACE_RE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """
+    Reduce a SQL statement to its shape.
+
+    Literals become `?` and placeholder lists such as the ones of an
+    expanded `IN` collapse to `(?)`, so the statements of an N+1 loop
+    share one shape whatever their parameters.
+
+    Args:
+        statement (str): The SQL sent to the database.
+
+    Returns:
+        str: The normalized statement.
+    """
+    shape = STRING_RE.sub('?', statement)
+    shape = NUMBER_RE.sub('?', shape)
+    shape = PLACEHOLDER_LIST_RE.sub('(?)', shape)
+    return SPACE_RE.sub(' ', shape).strip()
+
+
+class QueryStats:
+    """
+    Database statements run during one request.
+
+    Attributes:
+        count (int): Number of statements.
+        total (float): Seconds spent executing them.
+        slowest (float): Seconds taken by the slowest one.
+        slowest_statement (str): The SQL of the slowest one.
+        shapes (Counter): Number of statements per shape.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        """ Account for one executed statement. """
+        self.count += 1
+        self.total += duration
+        if duration >= self.slowest:
+            self.slowest = duration
+            self.slowest_statement = statement
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold):
+        """
+        Return the shapes run more than threshold times, most run first.
+
+        Args:
+            threshold (int): The number of runs allowed per shape.
+
+        Returns:
+            list: (shape, count) tuples.
+        """
+        return [(shape, count) for shape, count in self.shapes.most_common()
+                if count > threshold]
+
+
+class QueryMonitor:
+    """
+    Flask extension recording the statements of every request.
+
+    Query count and time are sent back in the `X-DB-Queries`,
+    `X-DB-Time-Ms` and `Server-Timing` headers when DB_STATS_HEADERS is
+    set, or when it is None and the app is in debug or testing mode, and
+    logged when the request ends. A warning is logged when
+    DB_REPEATED_QUERY_WARNING is positive and a request runs a statement
+    shape more often than that. Statements run while a streamed body is
+    sent are only in the log, since the headers are gone by then.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Register the hooks on an application and on every engine. """
+        app.config.setdefault('DB_STATS_HEADERS', None)
+        app.config.setdefault('DB_REPEATED_QUERY_WARNING', 0)
+        self.app = app
+        app.before_request(self._start)
+        app.after_request(self._headers)
+        app.teardown_request(self._log)
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor)
+
+    def _start(self):
+        g.db_stats = QueryStats()
+
+    def _send_headers(self):
+        enabled = self.app.config['DB_STATS_HEADERS']
+        if enabled is None:
+            return self.app.debug or self.app.testing
+        return enabled
+
+    def _headers(self, response):
+        stats = g.get('db_stats')
+        if stats is not None and self._send_headers():
+            milliseconds = stats.total * 1000
+            response.headers['X-DB-Queries'] = str(stats.count)
+            response.headers['X-DB-Time-Ms'] = '{:.2f}'.format(milliseconds)
+            response.headers.add(
+                'Server-Timing',
+                'db;dur={:.2f};desc="{} queries"'.format(
+                    milliseconds, stats.count)
+                )
+        return response
+
+    def _log(self, error=None):
+        stats = g.pop('db_stats', None)
+        if stats is None:
+            return
+        logger = self.app.logger
+        logger.debug(
+            '%s %s: %d queries in %.2fms, slowest %.2fms: %s',
+            request.method, request.path, stats.count, stats.total * 1000,
+            stats.slowest * 1000, stats.slowest_statement
+            )
+        threshold = self.app.config['DB_REPEATED_QUERY_WARNING']
+        if threshold > 0:
+            for shape, count in stats.repeated(threshold):
+                logger.warning(
+                    '%s %s ran the same statement %d times: %s',
+                    request.method, request.path, count, shape
+                    )
+
+
+def _before_cursor(conn, cursor, statement, parameters, context,
+                   executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+
+def _after_cursor(conn, cursor, statement, parameters, context,
+                  executemany):
+    if has_request_context():
+        stats = g.get('db_stats')
+        if stats is not None:
+            stats.record(
+                statement, time.perf_counter() - conn.info['query_started']
+                )
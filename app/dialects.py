@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+""" Module to build statements whose syntax depends on the database. """
+
+from sqlalchemy import insert
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+
+def insert_ignore(table, dialect_name):
+    """
+    Return an INSERT that silently skips rows violating a unique key.
+
+    The statement's rowcount tells whether the row was inserted.
+
+    Args:
+        table (Table): The table to insert into.
+        dialect_name (str): The name of the database dialect in use,
+            e.g. `db.session.get_bind().dialect.name`.
+
+    Returns:
+        Insert: The statement, to be given its values.
+    """
+    if dialect_name == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect_name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return insert(table).prefix_with('IGNORE')
+
+
+def upsert(table, dialect_name, key, columns):
+    """
+    Return an INSERT that updates the existing row on a unique key clash.
+
+    Args:
+        table (Table): The table to insert into.
+        dialect_name (str): The name of the database dialect in use.
+        key (list): The columns of the unique key to match rows on.
+        columns (list): The columns to overwrite on an existing row.
+
+    Returns:
+        Insert: The statement, to be given its values.
+    """
+    if dialect_name in ('sqlite', 'postgresql'):
+        module = sqlite if dialect_name == 'sqlite' else postgresql
+        statement = module.insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=key,
+            set_={column: statement.excluded[column] for column in columns}
+            )
+    statement = mysql.insert(table)
+    return statement.on_duplicate_key_update(
+        {column: statement.inserted[column] for column in columns}
+        )
@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+""" Module to answer "is this email registered?" without a query when it is not. """
+
+import datetime
+import hashlib
+import math
+import threading
+import time
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session, object_session
+from app.metrics import (
+    EMAIL_FILTER_FALSE_POSITIVE_RATE, EMAIL_FILTER_ITEMS,
+    EMAIL_FILTER_LOOKUPS, EMAIL_FILTER_REBUILDS
+    )
+from app.models import EmailFilterLog, User, db
+
+
+def normalize(email):
+    """ Return the key of an email; lookups may only widen, never narrow. """
+    return email.lower()
+
+
+def _utcnow():
+    """ Return the current time as a naive UTC datetime, as the log has it. """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class CountingBloomFilter:
+    """
+    Bloom filter with a small counter per slot, so keys can be removed.
+
+    Counters saturate at 255 and are never decremented from there, so
+    removing keys can only leave extra positives, not lose a key.
+
+    Attributes:
+        capacity (int): Keys the filter is sized for.
+        size (int): Number of counters.
+        hashes (int): Counters set per key.
+        count (int): Keys added and not removed.
+        filled (int): Counters above zero.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = max(capacity, 1)
+        self.size = max(int(math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(
+            self.size / self.capacity * math.log(2))), 1)
+        self.count = 0
+        self.filled = 0
+        self._counters = bytearray(self.size)
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + number * step) % self.size
+                for number in range(self.hashes)]
+
+    def __contains__(self, key):
+        counters = self._counters
+        return all(counters[index] for index in self._indexes(key))
+
+    def add(self, key):
+        """ Add a key. """
+        counters = self._counters
+        for index in self._indexes(key):
+            value = counters[index]
+            if value == 0:
+                self.filled += 1
+            if value < 255:
+                counters[index] = value + 1
+        self.count += 1
+
+    def remove(self, key):
+        """
+        Remove a key added before.
+
+        Returns:
+            bool: False if the key was certainly never added.
+        """
+        indexes = self._indexes(key)
+        counters = self._counters
+        if not all(counters[index] for index in indexes):
+            return False
+        for index in indexes:
+            value = counters[index]
+            if value < 255:
+                counters[index] = value - 1
+                if value == 1:
+                    self.filled -= 1
+        self.count -= 1
+        return True
+
+    def false_positive_rate(self):
+        """ Estimate the chance that an absent key is reported present. """
+        return (self.filled / self.size) ** self.hashes
+
+
+class EmailFilter:
+    """
+    Bloom filter of the emails of every user, in front of the user table.
+
+    Each process builds its filter from the database on first use, then
+    applies the users it commits itself. Users committed by other
+    processes are read every `sync_interval` seconds from the
+    email_filter_log table, which gets a row in the same transaction as
+    every user inserted or renamed through the ORM. Log ids are taken at
+    insert but only seen at commit, so a row can appear below ids read
+    already; every sync therefore reads again the rows of the last
+    `sync_window` seconds, and applies each row once. Inserts and updates
+    that bypass the ORM events write a row without email, which makes
+    every process rebuild. Deleted users are only removed from the
+    filter of the process that deleted them; elsewhere they stay as
+    false positives until the periodic rebuild.
+
+    Attributes:
+        capacity (int): Emails the filter is sized for; it grows to twice
+            the number of users when they outnumber it.
+        error_rate (float): Target false positive rate at capacity.
+        sync_interval (float): Seconds between reads of the log.
+        rebuild_interval (float): Seconds between rebuilds from the users.
+        log_retention (float): Seconds log rows are kept.
+        sync_window (float): Seconds a log row may take to commit and
+            still be read by the next sync.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.01, sync_interval=1.0,
+                 rebuild_interval=3600, log_retention=86400, sync_window=60,
+                 clock=time.monotonic):
+        self._lock = threading.Lock()
+        self._clock = clock
+        self.configure(capacity, error_rate, sync_interval, rebuild_interval,
+                       log_retention, sync_window)
+
+    def configure(self, capacity, error_rate, sync_interval, rebuild_interval,
+                  log_retention, sync_window=60):
+        """ Apply new settings; the filter is rebuilt on its next use. """
+        with self._lock:
+            self.capacity = capacity
+            self.error_rate = error_rate
+            self.sync_interval = sync_interval
+            self.rebuild_interval = rebuild_interval
+            self.log_retention = log_retention
+            self.sync_window = sync_window
+            self._filter = None
+            self._generation = 0
+            self._rebuilding = False
+            self._replay = None
+            self._applied = {}
+            self._last_log_id = 0
+            self._built_at = self._synced_at = 0.0
+            self.lookups = {'absent': 0, 'present': 0, 'false_positive': 0,
+                            'unfiltered': 0}
+            self.rebuilds = {}
+            self.last_rebuild = None
+
+    def invalidate(self):
+        """ Stop trusting the filter until it is rebuilt. """
+        with self._lock:
+            self._filter = None
+            self._generation += 1
+
+    def add(self, email, log_id=None):
+        """
+        Add the email of a user committed by this process.
+
+        Args:
+            email (str): The email.
+            log_id (int): The id of its email_filter_log row, which the
+                next sync then skips.
+        """
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((email, log_id))
+            if self._filter is None:
+                return
+            self._filter.add(normalize(email))
+            if log_id is not None:
+                self._applied[log_id] = _utcnow()
+            self._publish()
+
+    def remove(self, email):
+        """ Remove the email of a user deleted or renamed by this process. """
+        with self._lock:
+            if self._filter is not None:
+                self._filter.remove(normalize(email))
+                self._publish()
+
+    def might_exist(self, email):
+        """
+        Ask the filter about an email, syncing or rebuilding it if due.
+
+        Must be called within an application context.
+
+        Args:
+            email (str): The email.
+
+        Returns:
+            bool: False if no user has this email, True if one may have
+            it, or None while the filter is being built.
+        """
+        now = self._clock()
+        with self._lock:
+            bloom = self._filter
+            reason = None
+            if self._rebuilding:
+                pass
+            elif bloom is None:
+                reason = 'missing'
+            elif bloom.count > bloom.capacity:
+                reason = 'capacity'
+            elif now - self._built_at >= self.rebuild_interval:
+                reason = 'interval'
+            sync = (reason is None and bloom is not None
+                    and now - self._synced_at >= self.sync_interval)
+            if reason is not None:
+                self._rebuilding = True
+                self._replay = []
+            elif sync:
+                self._synced_at = now
+        if sync:
+            bloom = self.sync()
+            if bloom is None:
+                # The log asked for a rebuild.
+                with self._lock:
+                    if not self._rebuilding:
+                        self._rebuilding = True
+                        self._replay = []
+                        reason = 'log'
+        if reason is not None:
+            bloom = self.rebuild(reason)
+        if bloom is None:
+            return None
+        return normalize(email) in bloom
+
+    def exists(self, email):
+        """
+        Tell whether a user has this email, querying only when needed.
+
+        Must be called within an application context.
+
+        Args:
+            email (str): The email.
+
+        Returns:
+            bool: Whether a user has this email.
+        """
+        maybe = self.might_exist(email)
+        if maybe is False:
+            result = 'absent'
+            found = False
+        else:
+            found = db.session.scalar(
+                db.select(User.id).where(User.email == email).limit(1)
+                ) is not None
+            if maybe is None:
+                result = 'unfiltered'
+            else:
+                result = 'present' if found else 'false_positive'
+        with self._lock:
+            self.lookups[result] += 1
+        EMAIL_FILTER_LOOKUPS.labels(result).inc()
+        return found
+
+    def rebuild(self, reason='manual'):
+        """
+        Build a new filter from the user table and swap it in.
+
+        Must be called within an application context.
+
+        Args:
+            reason (str): Why, for the statistics.
+
+        Returns:
+            CountingBloomFilter: The new filter, or None if it was
+            invalidated again while being built.
+        """
+        with self._lock:
+            self._rebuilding = True
+            if self._replay is None:
+                self._replay = []
+            generation = self._generation
+        started = time.perf_counter()
+        try:
+            with db.engine.connect() as connection:
+                # Read the log first: users committed during the scan are
+                # then read again from the log, never missed, and the rows
+                # seen now are those of users the scan already finds.
+                since = _utcnow() - datetime.timedelta(
+                    seconds=self.sync_window)
+                last_log_id = connection.scalar(
+                    db.select(func.max(EmailFilterLog.id))) or 0
+                applied = {
+                    log_id: created_at for log_id, _, created_at
+                    in self._read_log(connection, last_log_id, since)
+                    }
+                users = connection.scalar(
+                    db.select(func.count()).select_from(User))
+                bloom = CountingBloomFilter(
+                    self.capacity if users <= self.capacity else 2 * users,
+                    self.error_rate)
+                emails = connection.execution_options(
+                    stream_results=True, yield_per=1000
+                    ).scalars(db.select(User.email))
+                for email in emails:
+                    bloom.add(normalize(email))
+                rows = self._read_log(connection, last_log_id, since)
+            self._prune()
+        except BaseException:
+            with self._lock:
+                self._rebuilding = False
+                self._replay = None
+            raise
+        seconds = time.perf_counter() - started
+        now = self._clock()
+        with self._lock:
+            self._applied = applied
+            for email, log_id in self._replay:
+                if log_id not in applied:
+                    bloom.add(normalize(email))
+                    if log_id is not None:
+                        applied[log_id] = _utcnow()
+            valid = self._apply_log(bloom, rows)
+            if rows:
+                last_log_id = max(last_log_id, rows[-1][0])
+            self._replay = None
+            self._rebuilding = False
+            # An invalidation during the scan may have missed its rows.
+            valid = valid and generation == self._generation
+            self._filter = bloom if valid else None
+            self._last_log_id = last_log_id
+            self._built_at = self._synced_at = now
+            self.rebuilds[reason] = self.rebuilds.get(reason, 0) + 1
+            self.last_rebuild = {
+                'reason': reason, 'seconds': round(seconds, 6),
+                'items': bloom.count, 'size': bloom.size,
+                'at': datetime.datetime.now(
+                    datetime.timezone.utc).isoformat(timespec='seconds'),
+                }
+            self._publish()
+        EMAIL_FILTER_REBUILDS.labels(reason).observe(seconds)
+        return self._filter
+
+    def sync(self):
+        """
+        Add the emails other processes logged since the last sync.
+
+        Must be called within an application context.
+
+        Returns:
+            CountingBloomFilter: The current filter, or None if the log
+            asked for a rebuild.
+        """
+        with self._lock:
+            bloom = self._filter
+            after = self._last_log_id
+        if bloom is None:
+            return None
+        since = _utcnow() - datetime.timedelta(seconds=self.sync_window)
+        with db.engine.connect() as connection:
+            rows = self._read_log(connection, after, since)
+        with self._lock:
+            if self._filter is not bloom:
+                return self._filter
+            if not self._apply_log(bloom, rows):
+                self._filter = None
+            if rows:
+                self._last_log_id = max(self._last_log_id, rows[-1][0])
+            # Rows past the window are not read again, unless above the
+            # last id read, which only rows of this process can be.
+            self._applied = {
+                log_id: created_at
+                for log_id, created_at in self._applied.items()
+                if created_at >= since or log_id > self._last_log_id
+                }
+            self._publish()
+            return self._filter
+
+    @staticmethod
+    def _read_log(connection, after, since):
+        """ Read the rows above an id or logged since a time, by id. """
+        return connection.execute(
+            db.select(EmailFilterLog.id, EmailFilterLog.email,
+                      EmailFilterLog.created_at)
+            .where((EmailFilterLog.id > after)
+                   | (EmailFilterLog.created_at >= since))
+            .order_by(EmailFilterLog.id)
+            ).all()
+
+    def _apply_log(self, bloom, rows):
+        """
+        Add logged emails not applied yet.
+
+        Returns:
+            bool: False if one of the new rows asks for a rebuild.
+        """
+        valid = True
+        for log_id, email, created_at in rows:
+            if log_id in self._applied:
+                continue
+            self._applied[log_id] = created_at
+            if email is None:
+                valid = False
+            else:
+                bloom.add(normalize(email))
+        return valid
+
+    def _prune(self):
+        """ Delete expired log rows, always keeping the newest one. """
+        cutoff = _utcnow() - datetime.timedelta(seconds=self.log_retention)
+        with db.engine.begin() as connection:
+            # Keeping the newest row stops ids from being reused.
+            newest = connection.scalar(db.select(func.max(EmailFilterLog.id)))
+            if newest is not None:
+                connection.execute(db.delete(EmailFilterLog).where(
+                    EmailFilterLog.created_at < cutoff,
+                    EmailFilterLog.id < newest))
+
+    def _publish(self):
+        bloom = self._filter
+        if bloom is not None:
+            EMAIL_FILTER_ITEMS.set(bloom.count)
+            EMAIL_FILTER_FALSE_POSITIVE_RATE.set(bloom.false_positive_rate())
+
+    def stats(self):
+        """
+        Describe the filter and how well it has answered so far.
+
+        Returns:
+            dict: Filter size and fill, the estimated and observed false
+            positive rates, lookups by result and rebuilds by reason.
+        """
+        with self._lock:
+            bloom = self._filter
+            negatives = self.lookups['absent'] + self.lookups['false_positive']
+            return {
+                'loaded': bloom is not None,
+                'items': bloom.count if bloom else 0,
+                'capacity': bloom.capacity if bloom else self.capacity,
+                'size': bloom.size if bloom else 0,
+                'hashes': bloom.hashes if bloom else 0,
+                'estimated_false_positive_rate': (
+                    bloom.false_positive_rate() if bloom else None),
+                'observed_false_positive_rate': (
+                    self.lookups['false_positive'] / negatives
+                    if negatives else None),
+                'lookups': dict(self.lookups),
+                'rebuilds': dict(self.rebuilds),
+                'last_rebuild': self.last_rebuild,
+                'last_log_id': self._last_log_id,
+                }
+
+
+email_filter = EmailFilter()
+
+
+def _changes(session):
+    return session.info.setdefault('email_filter_changes', [])
+
+
+def _log(connection, email):
+    """ Append an email to the log, returning the id of its row. """
+    result = connection.execute(db.insert(EmailFilterLog).values(email=email))
+    return result.inserted_primary_key[0]
+
+
+@event.listens_for(User, 'after_insert')
+def _after_insert(mapper, connection, target):
+    session = object_session(target)
+    log_id = _log(connection, target.email)
+    if session is not None:
+        _changes(session).append(('add', target.email, log_id))
+
+
+@event.listens_for(User, 'after_update')
+def _after_update(mapper, connection, target):
+    history = inspect(target).attrs.email.history
+    if not history.has_changes():
+        return
+    session = object_session(target)
+    log_id = _log(connection, target.email)
+    if session is not None:
+        changes = _changes(session)
+        for email in history.deleted:
+            if email is not None:
+                changes.append(('remove', email, None))
+        changes.append(('add', target.email, log_id))
+
+
+@event.listens_for(User, 'after_delete')
+def _after_delete(mapper, connection, target):
+    session = object_session(target)
+    email = target.__dict__.get('email')
+    if session is not None and email is not None:
+        _changes(session).append(('remove', email, None))
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _bulk_change(orm_execute_state):
+    # Bulk inserts and updates do not say which emails they write.
+    # Bulk deletes only leave false positives behind, which is fine.
+    table = getattr(orm_execute_state.statement, 'table', None)
+    if ((orm_execute_state.is_insert or orm_execute_state.is_update)
+            and getattr(table, 'name', None) == User.__tablename__):
+        orm_execute_state.session.info['email_filter_reset'] = True
+
+
+@event.listens_for(Session, 'before_commit')
+def _before_commit(session):
+    if session.info.get('email_filter_reset'):
+        session.execute(db.insert(EmailFilterLog).values(email=None))
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    if session.info.pop('email_filter_reset', False):
+        email_filter.invalidate()
+    for action, email, log_id in session.info.pop('email_filter_changes', []):
+        if action == 'add':
+            email_filter.add(email, log_id)
+        else:
+            email_filter.remove(email)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('email_filter_reset', None)
+    session.info.pop('email_filter_changes', None)
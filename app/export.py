@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+""" Module to export tables as newline delimited JSON in constant memory. """
+
+import json
+import zlib
+from app.models import University, UserPreference, db
+
+
+EXPORTS = {
+    'universities': (
+        University.id, University.name, University.location,
+        University.website, University.status, University.like_count
+        ),
+    'preferences': (
+        UserPreference.id, UserPreference.user_id,
+        UserPreference.university_id
+        ),
+    }
+
+
+def iter_rows(name, batch_size=1000):
+    """
+    Iterate over every row of an export as a dictionary.
+
+    Only the exported columns are selected, so no ORM objects are built,
+    and rows are fetched `batch_size` at a time from a server side
+    cursor where the database supports one. Must be called within an
+    application context.
+
+    Args:
+        name (str): A key of EXPORTS.
+        batch_size (int): Rows fetched from the cursor at a time.
+
+    Yields:
+        dict: Each row, ordered on the primary key.
+    """
+    columns = EXPORTS[name]
+    statement = db.select(*columns).order_by(columns[0]).execution_options(
+        yield_per=batch_size
+        )
+    for row in db.session.execute(statement):
+        yield row._asdict()
+
+
+def ndjson(rows, chunk_size=64 * 1024):
+    """
+    Encode rows as newline delimited JSON, in chunks of about chunk_size.
+
+    Args:
+        rows (iterable): The dictionaries to encode.
+        chunk_size (int): Characters gathered before a chunk is yielded.
+
+    Yields:
+        str: Whole lines of JSON.
+    """
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    lines = []
+    size = 0
+    for row in rows:
+        line = encoder.encode(row) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield ''.join(lines)
+
+
+def gzip_chunks(chunks, level=6):
+    """
+    Compress text chunks into a gzip stream as they come.
+
+    Args:
+        chunks (iterable): The text to compress, as str.
+        level (int): The zlib compression level.
+
+    Yields:
+        bytes: Pieces of the gzip stream; together a complete file.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
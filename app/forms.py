@@ -5,7 +5,15 @@ from flask_wtf import FlaskForm
 from wtforms import SelectField, StringField, PasswordField
 from wtforms import SubmitField, ValidationError
 from wtforms.validators import DataRequired, Email
-from app.models import User
+from app.email_filter import email_filter
+
+
+COUNTRY_CHOICES = [
+    ('KE', 'Kenya'),
+    ('TZ', 'Tanzania'),
+    ('UG', 'Uganda'),
+    ('RW', 'Rwanda')
+]
 
 
 class LoginForm(FlaskForm):
@@ -60,12 +68,8 @@ class SignupForm(FlaskForm):
     lastname = StringField('Last Name', validators=[DataRequired()])
     username = StringField('Username', validators=[DataRequired()])
     phonenumber = StringField('Phone Number', validators=[DataRequired()])
-    location = SelectField('Country', choices=[
-    ('KE', 'Kenya'),
-    ('TZ', 'Tanzania'),
-        ('UG', 'Uganda'),
-        ('RW', 'Rwanda')
-    ], validators=[DataRequired()])
+    location = SelectField('Country', choices=COUNTRY_CHOICES,
+                           validators=[DataRequired()])
     gender = SelectField(
         'Gender',
         choices=[('Male'), ('Female'), ('Other')],
@@ -86,7 +90,7 @@ class SignupForm(FlaskForm):
         Returns:
             bool: True if the email exists, False otherwise.
         """
-        if User.query.filter_by(email=field.data).first():
+        if email_filter.exists(field.data):
             raise ValidationError('Email already exists')
 
     email = StringField('Email', validators=[DataRequired(), Email(), email_exists])
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+""" Module to cache rendered template fragments until the catalog changes. """
+
+from app import catalog
+from app.cache import LRUCache
+
+
+def _sizeof(value):
+    """ Approximate the memory held by a fragment by its text length. """
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_sizeof(item) for item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_sizeof(item) for item in value)
+    return 8
+
+
+class FragmentCache:
+    """
+    Cache of rendered fragments keyed on the catalog version.
+
+    Every key includes the current catalog version, read with one
+    primary key lookup, so a change to any university from any process
+    makes every cached fragment unreachable; those entries then age out
+    of the LRU. The cache is bounded both in entries and in the total
+    length of the cached text.
+
+    Attributes:
+        cache (LRUCache): The rendered fragments.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=8 * 1024 * 1024):
+        self.cache = LRUCache(max_entries, max_bytes=max_bytes,
+                              sizeof=_sizeof)
+
+    def get_or_render(self, name, params, render):
+        """
+        Return a cached fragment, rendering and caching it on a miss.
+
+        Must be called within an application context.
+
+        Args:
+            name (str): What is rendered, e.g. 'universities'.
+            params (tuple): The hashable parameters of the rendering.
+            render (callable): Returns the fragment; made of strings,
+                lists, tuples and dictionaries.
+
+        Returns:
+            The fragment.
+        """
+        # Read the version before the rows, so a fragment is never
+        # older than the version it is stored under.
+        key = (name, catalog.version()[0]) + tuple(params)
+        fragment = self.cache.get(key)
+        if fragment is None:
+            fragment = render()
+            self.cache.set(key, fragment)
+        return fragment
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+""" Module to record what every language model call costs, off the request. """
+
+import datetime
+import math
+import os
+import queue
+import threading
+import time
+from app.models import LLMCall, db
+from app.tokens import count_message_tokens, count_tokens
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def usage(response, messages):
+    """
+    Return the tokens of a completion, as billed if the response says.
+
+    Args:
+        response: The chat completion.
+        messages (list): The messages it answered, to estimate from.
+
+    Returns:
+        tuple: The prompt and completion tokens.
+    """
+    if getattr(response, 'usage', None) is not None:
+        return response.usage.prompt_tokens, response.usage.completion_tokens
+    return (count_message_tokens(messages),
+            count_tokens(response.choices[0].message.content))
+
+
+def percentile(values, q):
+    """
+    Return the nearest rank percentile of sorted values.
+
+    Args:
+        values (list): Numbers in ascending order.
+        q (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The value, rounded to the millisecond, or None if empty.
+    """
+    if not values:
+        return None
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return round(values[rank - 1], 1)
+
+
+def percentiles(values):
+    """ Return the p50, p95 and p99 of unsorted values. """
+    values = sorted(values)
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95),
+            'p99': percentile(values, 99)}
+
+
+class LLMCallLog:
+    """
+    Append one `LLMCall` row per model call without blocking the request.
+
+    `record` only puts the row on a bounded queue; a daemon thread,
+    started on the first record of each process, inserts the queued
+    rows in batches. When the queue is full the row is dropped and
+    counted, so a slow database never slows down a request. Under
+    TESTING no thread is started and `flush` writes the queue.
+
+    Attributes:
+        recorded (int): Rows queued.
+        dropped (int): Rows lost because the queue was full.
+        failed (int): Rows lost because their batch could not be written.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.prices = {}
+        self.batch_size = 500
+        self.recorded = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Read the LLM_ACCOUNTING* settings of the app. """
+        self.app = app
+        self.enabled = app.config['LLM_ACCOUNTING']
+        self.prices = app.config['LLM_PRICES']
+        self.batch_size = app.config['LLM_ACCOUNTING_BATCH']
+        self._queue = queue.Queue(app.config['LLM_ACCOUNTING_MAX_QUEUED'])
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        """
+        Return what a call cost, in dollars, from LLM_PRICES.
+
+        Args:
+            model (str): The model name.
+            prompt_tokens (int): The tokens sent.
+            completion_tokens (int): The tokens received.
+
+        Returns:
+            float: The cost, 0 for a model without a price.
+        """
+        prompt_price, completion_price = self.prices.get(model, (0, 0))
+        return (prompt_tokens * prompt_price
+                + completion_tokens * completion_price) / 1000
+
+    def record(self, endpoint, model, user, cache, status, started,
+               question=None, prompt_tokens=0, completion_tokens=0,
+               first_token=None):
+        """
+        Queue the row of one call.
+
+        Args:
+            endpoint (str): What the call was for, e.g. 'search'.
+            model (str): The model name.
+            user (str): The caller, as given to the rate limiter.
+            cache (str): 'hit' when answered from the cache, 'shared'
+                when merged with another request's call, else 'miss'.
+            status (str): 'ok', 'error' (the upstream failed),
+                'rejected' (refused before reaching it) or 'cancelled'
+                (the client left mid stream).
+            started (float): `time.perf_counter()` when the call began.
+            question (str): The question asked, if any.
+            prompt_tokens (int): The tokens sent.
+            completion_tokens (int): The tokens received.
+            first_token (float): `time.perf_counter()` when the first
+                token reached the app; the end of the call if not given.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        row = {
+            'created_at': _utcnow(),
+            'endpoint': endpoint,
+            'model': model,
+            'user': str(user)[:64] if user is not None else None,
+            'question': question[:255] if question else None,
+            'cache': cache,
+            'status': status,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cost': self.cost(model, prompt_tokens, completion_tokens),
+            'latency_ms': round((now - started) * 1000, 1),
+            'first_token_ms': round(((first_token or now) - started) * 1000, 1)
+            if status == 'ok' else None
+            }
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.recorded += 1
+        if not self.app.testing:
+            self._ensure_thread()
+
+    def _ensure_thread(self):
+        """ Start the writer, again in a forked worker. """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid != pid:
+                self._thread = threading.Thread(
+                    target=self._run, name='llm-accounting', daemon=True)
+                self._thread.start()
+                self._pid = pid
+
+    def _take(self, block):
+        """ Return up to `batch_size` queued rows, waiting for one if asked. """
+        rows = []
+        try:
+            rows.append(self._queue.get(block))
+            while len(rows) < self.batch_size:
+                rows.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return rows
+
+    def _write(self, rows):
+        """ Insert a batch of rows in one statement. """
+        try:
+            with self.app.app_context():
+                db.session.execute(db.insert(LLMCall), rows)
+                db.session.commit()
+        except Exception as error:
+            self.failed += len(rows)
+            self.app.logger.warning('Could not record %d LLM calls: %s',
+                                    len(rows), error)
+        finally:
+            for _ in rows:
+                self._queue.task_done()
+
+    def _run(self):
+        while True:
+            self._write(self._take(block=True))
+
+    def flush(self):
+        """ Write every queued row, or wait for the writer to. """
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+            return
+        while True:
+            rows = self._take(block=False)
+            if not rows:
+                return
+            self._write(rows)
+
+    def stats(self):
+        """ Return the writer counters as a dictionary. """
+        return {
+            'recorded': self.recorded,
+            'queued': self._queue.qsize(),
+            'dropped': self.dropped,
+            'failed': self.failed
+        }
+
+
+def _latencies(day, model, timed, sample):
+    """
+    Return the latencies and first token times of one day and model.
+
+    Reads at most `sample` calls: every nth of the timed calls, in id
+    order, when more were timed. The rows are numbered by the database,
+    so the sample is spread evenly over the day whatever ids the other
+    models took, and the same calls are read on every report.
+
+    Args:
+        day (str): The day, as an ISO date.
+        model (str): The model name.
+        timed (int): How many calls of the day and model were timed.
+        sample (int): The most calls to read.
+
+    Returns:
+        tuple: The latencies and the first token times, both lists.
+    """
+    start = datetime.datetime.combine(datetime.date.fromisoformat(day),
+                                      datetime.time())
+    calls = (
+        db.select(LLMCall.id, LLMCall.latency_ms, LLMCall.first_token_ms,
+                  db.func.row_number().over(order_by=LLMCall.id)
+                  .label('position'))
+        .where(LLMCall.created_at >= start,
+               LLMCall.created_at < start + datetime.timedelta(days=1),
+               LLMCall.model == model, LLMCall.cache != 'hit',
+               LLMCall.status == 'ok')
+        .subquery()
+        )
+    query = (
+        db.select(calls.c.latency_ms, calls.c.first_token_ms)
+        .order_by(calls.c.id)
+        .limit(sample)
+        )
+    stride = math.ceil(timed / sample) if sample else 1
+    if stride > 1:
+        query = query.where((calls.c.position - 1) % stride == 0)
+    latencies, first_tokens = [], []
+    for latency, first_token in db.session.execute(query):
+        latencies.append(latency)
+        if first_token is not None:
+            first_tokens.append(first_token)
+    return latencies, first_tokens
+
+
+def report(days=7, top=10, sample=5000):
+    """
+    Aggregate the recorded calls of the last days, per day and model.
+
+    Counts and sums are computed by the database. Latency percentiles
+    only cover calls that reached, or waited on, the model and
+    succeeded, so cache hits and refusals do not hide the time the
+    model takes; they are taken from at most `sample` such calls per
+    day and model.
+
+    Args:
+        days (int): The number of days, today included.
+        top (int): The number of costliest questions to list.
+        sample (int): The most calls read per day and model for the
+            percentiles.
+
+    Returns:
+        dict: 'days', one dictionary per day and model, oldest first,
+        and 'costliest_questions' over the whole period.
+    """
+    since = datetime.datetime.combine(
+        _utcnow().date() - datetime.timedelta(days=max(days, 1) - 1),
+        datetime.time())
+
+    def count(*conditions):
+        return db.func.sum(db.case((db.and_(*conditions), 1), else_=0))
+
+    day = db.func.date(LLMCall.created_at)
+    groups = db.session.execute(
+        db.select(
+            day.label('day'), LLMCall.model,
+            db.func.count().label('calls'),
+            count(LLMCall.cache == 'hit').label('cache_hits'),
+            count(LLMCall.cache == 'shared').label('shared'),
+            count(LLMCall.status == 'error').label('errors'),
+            count(LLMCall.status == 'rejected').label('rejected'),
+            db.func.sum(LLMCall.prompt_tokens).label('prompt_tokens'),
+            db.func.sum(LLMCall.completion_tokens).label('completion_tokens'),
+            db.func.sum(LLMCall.cost).label('cost'),
+            count(LLMCall.cache != 'hit',
+                  LLMCall.status == 'ok').label('timed'))
+        .where(LLMCall.created_at >= since)
+        .group_by(day, LLMCall.model)
+        .order_by(day, LLMCall.model)
+        ).all()
+    result = []
+    for group in groups:
+        # SQLite returns the day as text, other databases as a date.
+        group_day = (group.day if isinstance(group.day, str)
+                     else group.day.isoformat())
+        latencies, first_tokens = _latencies(group_day, group.model,
+                                             group.timed, sample)
+        result.append({
+            'day': group_day, 'model': group.model, 'calls': group.calls,
+            'cache_hits': int(group.cache_hits), 'shared': int(group.shared),
+            'errors': int(group.errors), 'rejected': int(group.rejected),
+            'prompt_tokens': int(group.prompt_tokens),
+            'completion_tokens': int(group.completion_tokens),
+            'cost': round(group.cost, 6),
+            'latency_ms': percentiles(latencies),
+            'first_token_ms': percentiles(first_tokens)
+            })
+
+    cost = db.func.sum(LLMCall.cost)
+    questions = db.session.execute(
+        db.select(LLMCall.question, db.func.count(), cost,
+                  db.func.sum(LLMCall.prompt_tokens),
+                  db.func.sum(LLMCall.completion_tokens))
+        .where(LLMCall.created_at >= since, LLMCall.question.is_not(None))
+        .group_by(LLMCall.question)
+        .order_by(cost.desc())
+        .limit(top)
+        )
+    return {
+        'days': result,
+        'costliest_questions': [{
+            'question': question, 'calls': calls, 'cost': round(total, 6),
+            'prompt_tokens': int(prompt_tokens),
+            'completion_tokens': int(completion_tokens)
+            } for question, calls, total, prompt_tokens, completion_tokens
+            in questions]
+        }
+
+
+llm_calls = LLMCallLog()
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+""" Module to call the language model from an asyncio event loop. """
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+import httpx
+import openai
+from app.llm_accounting import usage
+from app.llm_executor import LLMOverloaded, LLMUnavailable
+from app.llm_gateway import (
+    LLMGateway, LLMRateLimited, LLMUpstreamError, MemoryBucketStore
+    )
+from app.metrics import upstream_timer
+from app.tokens import count_message_tokens, count_tokens
+
+
+class _AsyncCall:
+    """ A call in progress and the number of requests waiting for it. """
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class _AsyncSlot:
+    """ A held permit to run one call; releasing it twice is harmless. """
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._held = True
+
+    def release(self):
+        if not self._held:
+            return
+        self._held = False
+        self._executor.in_flight -= 1
+        self._executor._slots.release()
+
+    async def reacquire(self):
+        """ Same as `_Slot.reacquire`, awaited. """
+        if self._held:
+            return
+        await self._executor._wait()
+        self._held = True
+
+
+class AsyncLLMExecutor:
+    """
+    `LLMExecutor` for coroutines running on one event loop.
+
+    A waiting call costs a suspended coroutine instead of a thread, so
+    the limits can be much higher than those of the threaded executor.
+    Identical calls are merged the same way; a merged call is cancelled
+    once every request waiting for it has gone away.
+
+    Attributes:
+        in_flight (int): Calls currently running.
+        queued (int): Calls waiting for a slot.
+        coalesced (int): Calls answered by another call's result.
+        rejected (int): Calls refused because of load.
+    """
+
+    def __init__(self, max_in_flight=1000, max_queued=2000, queue_timeout=5.0,
+                 wait_timeout=60.0):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.wait_timeout = wait_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._calls = {}
+
+    def _overloaded(self):
+        self.rejected += 1
+        return LLMOverloaded(
+            'The search feature is busy. Please try again shortly.',
+            retry_after=max(1, int(self.queue_timeout))
+            )
+
+    async def acquire(self):
+        """
+        Wait for a free slot, for at most `queue_timeout` seconds.
+
+        Returns:
+            _AsyncSlot: The permit; call its `release` method when done.
+
+        Raises:
+            LLMOverloaded: If the queue is full or the deadline passes.
+        """
+        await self._wait()
+        return _AsyncSlot(self)
+
+    async def _wait(self):
+        """ Take a slot for `acquire`, counting it as in flight. """
+        if self._slots.locked():
+            if self.queued >= self.max_queued:
+                raise self._overloaded()
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(),
+                                       self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise self._overloaded() from None
+            finally:
+                self.queued -= 1
+        else:
+            await self._slots.acquire()
+        self.in_flight += 1
+
+    @asynccontextmanager
+    async def slot(self):
+        """ Hold a slot for the duration of an `async with` block. """
+        permit = await self.acquire()
+        try:
+            yield permit
+        finally:
+            permit.release()
+
+    async def _lead(self, factory):
+        async with self.slot():
+            return await factory()
+
+    def _finished(self, key, call, task):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the error as seen even if every waiter went away.
+            task.exception()
+
+    async def run(self, key, factory):
+        """
+        Await `factory()` in a slot, merging it with a running call of the
+        same key.
+
+        Args:
+            key (str): Identifies identical calls, or None to never merge.
+            factory (callable): Returns the awaitable call to make.
+
+        Returns:
+            The result of the call, possibly made for another request.
+
+        Raises:
+            LLMOverloaded: If no slot frees up in time.
+            Exception: Whatever the call raised, re-raised in every waiter.
+        """
+        return await self.merge(key, lambda: self._lead(factory))
+
+    async def merge(self, key, factory):
+        """ Same as `LLMExecutor.merge`, awaited. """
+        if key is None:
+            return await factory()
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _AsyncCall(
+                asyncio.ensure_future(factory()))
+            call.task.add_done_callback(
+                lambda task: self._finished(key, call, task))
+            timeout = None
+        else:
+            self.coalesced += 1
+            timeout = self.wait_timeout
+        call.waiters += 1
+        try:
+            done, _ = await asyncio.wait({call.task}, timeout=timeout)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                call.task.cancel()
+        if not done:
+            raise self._overloaded()
+        return call.task.result()
+
+    def stats(self):
+        """ Return the executor counters as a dictionary. """
+        return {
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected
+        }
+
+
+class AsyncLLMGateway(LLMGateway):
+    """
+    `LLMGateway` for an asyncio event loop and an `openai.AsyncOpenAI`
+    client.
+
+    `complete` and `stream` are coroutines and `stream` returns an async
+    iterator. Pass the limiter, breaker and call log of the threaded
+    gateway so both serving paths share the rate limits, the view of
+    upstream health and the accounting.
+    """
+
+    def __init__(self, client, limiter, breaker, executor, max_retries=3,
+                 base_delay=0.5, max_delay=8.0, sleep=asyncio.sleep,
+                 calls=None):
+        super().__init__(client, limiter, breaker, executor,
+                         max_retries=max_retries, base_delay=base_delay,
+                         max_delay=max_delay, sleep=sleep, calls=calls)
+
+    async def _check(self, user):
+        """ Take rate limit tokens, off the loop unless kept in memory. """
+        if isinstance(self.limiter.store, MemoryBucketStore):
+            self.limiter.check(user)
+        else:
+            await asyncio.to_thread(self.limiter.check, user)
+
+    async def _create(self, permit=None, **kwargs):
+        """ Same as `LLMGateway._create`, awaited. """
+        attempt = 0
+        while True:
+            attempt += 1
+            trial = self.breaker.before_call()
+            try:
+                with upstream_timer('openai', 'chat.completions'):
+                    response = await self.client.chat.completions.create(
+                        **kwargs)
+            except openai.APIError as error:
+                delay = self._retry_delay(attempt, error)
+            else:
+                self.breaker.record_success()
+                return response
+            finally:
+                self.breaker.after_call(trial)
+            if permit is not None:
+                permit.release()
+            await self._sleep(delay)
+            if permit is not None:
+                await permit.reacquire()
+
+    async def complete(self, messages, model, user=None, key=None,
+                       endpoint='llm', question=None, **kwargs):
+        """ Same as `LLMGateway.complete`, awaited. """
+        started = time.perf_counter()
+        made = []
+
+        async def call():
+            made.append(True)
+            await self._check(user)
+            async with self.executor.slot() as permit:
+                return await self._create(permit, model=model,
+                                          messages=messages, **kwargs)
+
+        try:
+            while True:
+                try:
+                    response = await self.executor.merge(key, call)
+                    break
+                except LLMRateLimited:
+                    if made:
+                        raise
+        except LLMUnavailable as error:
+            self._record_refusal(endpoint, question, model, user, started,
+                                 error)
+            raise
+        if made:
+            self._record(endpoint, question, model, user, started,
+                         tokens=usage(response, messages))
+        else:
+            self._record(endpoint, question, model, user, started,
+                         cache='shared')
+        return response
+
+    async def stream(self, messages, model, user=None, endpoint='llm',
+                     question=None, **kwargs):
+        """
+        Same as `LLMGateway.stream`, awaited.
+
+        Returns:
+            tuple: The executor permit and an async iterator of deltas.
+        """
+        started = time.perf_counter()
+        try:
+            await self._check(user)
+            permit = await self.executor.acquire()
+        except LLMUnavailable as error:
+            self._record_refusal(endpoint, question, model, user, started,
+                                 error)
+            raise
+        try:
+            stream = await self._create(permit, model=model,
+                                        messages=messages, stream=True,
+                                        **kwargs)
+        except BaseException as error:
+            permit.release()
+            if isinstance(error, LLMUnavailable):
+                self._record_refusal(endpoint, question, model, user,
+                                     started, error)
+            raise
+
+        def finished(status, first_token, text):
+            self._record(endpoint, question, model, user, started,
+                         status=status, first_token=first_token,
+                         tokens=(count_message_tokens(messages),
+                                 count_tokens(text)))
+
+        return permit, self._deltas(stream, finished)
+
+    async def _deltas(self, stream, finished=None):
+        """ Same as `LLMGateway._deltas`, for an async stream. """
+        parts = []
+        first_token = None
+        status = 'cancelled'
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+            status = 'ok'
+        except openai.APIError as error:
+            status = 'error'
+            self.breaker.record_failure()
+            raise LLMUpstreamError(
+                'Sorry, the search feature failed. Please try again.'
+                ) from error
+        finally:
+            if finished is not None:
+                finished(status, first_token, ''.join(parts))
+            # Closing early also stops the upstream generating.
+            await stream.close()
+
+
+def make_async_client(config):
+    """
+    Build the async OpenAI client, with one connection pool for the loop.
+
+    Args:
+        config (dict): The Flask config, read for LLM_ASYNC_MAX_CONNECTIONS.
+
+    Returns:
+        openai.AsyncOpenAI: The client; close it when the loop stops.
+    """
+    connections = config['LLM_ASYNC_MAX_CONNECTIONS']
+    return openai.AsyncOpenAI(
+        api_key=os.environ.get('OPENAI_API_KEY'),
+        http_client=openai.DefaultAsyncHttpxClient(limits=httpx.Limits(
+            max_connections=connections,
+            max_keepalive_connections=connections
+            ))
+        )
+
+
+def make_async_gateway(client, gateway, config):
+    """
+    Build the async gateway next to the threaded one.
+
+    Args:
+        client (openai.AsyncOpenAI): The async client.
+        gateway (LLMGateway): The threaded gateway, whose limiter,
+            breaker and call log are shared.
+        config (dict): The Flask config, read for the LLM_* settings.
+
+    Returns:
+        AsyncLLMGateway: The configured gateway.
+    """
+    executor = AsyncLLMExecutor(
+        max_in_flight=config['LLM_ASYNC_MAX_IN_FLIGHT'],
+        max_queued=config['LLM_ASYNC_MAX_QUEUED'],
+        queue_timeout=config['LLM_QUEUE_TIMEOUT'],
+        wait_timeout=config['LLM_WAIT_TIMEOUT']
+        )
+    return AsyncLLMGateway(
+        client, gateway.limiter, gateway.breaker, executor,
+        max_retries=config['LLM_MAX_RETRIES'],
+        base_delay=config['LLM_RETRY_BASE_DELAY'],
+        max_delay=config['LLM_RETRY_MAX_DELAY'],
+        calls=gateway.calls
+        )
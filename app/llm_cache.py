@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+""" Module to cache answers returned by the language model. """
+
+import datetime
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from sqlalchemy.exc import SQLAlchemyError
+from app.cache import LRUCache
+from app.dialects import upsert
+from app.models import LLMCacheEntry, db
+
+
+def normalize_question(question):
+    """
+    Normalize a question so trivially different phrasings share a key.
+
+    Case, Unicode compatibility forms, repeated whitespace and trailing
+    punctuation are ignored, so "Best universities in Kenya?" and
+    "best  universities in kenya" are the same question.
+
+    Args:
+        question (str): The question as typed by the user.
+
+    Returns:
+        str: The normalized question.
+    """
+    question = unicodedata.normalize('NFKC', question or '').casefold()
+    question = re.sub(r'\s+', ' ', question)
+    return question.strip().rstrip('?!.').strip()
+
+
+def cache_key(question, system_prompt, model):
+    """
+    Return the cache key of a question for a given prompt and model.
+
+    Args:
+        question (str): The question as typed by the user.
+        system_prompt (str): The system prompt sent with the question.
+        model (str): The name of the model answering.
+
+    Returns:
+        str: A hex digest identifying the answer.
+    """
+    raw = json.dumps([normalize_question(question), system_prompt, model])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class MemoryBackend:
+    """ Cache backend keeping answers in the memory of this process. """
+
+    name = 'memory'
+
+    def __init__(self, max_entries, ttl):
+        self._cache = LRUCache(max_entries=max_entries, ttl=ttl)
+
+    @property
+    def evictions(self):
+        return self._cache.evictions
+
+    def get(self, key):
+        return self._cache.get(key, count=False)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class SQLiteBackend:
+    """
+    Cache backend keeping answers in a SQLite file.
+
+    Every worker process of the host pointing at the same file shares
+    its entries; the file is local to the host, so use it as the local
+    tier of a `DatabaseBackend` when the app runs on several hosts.
+    Entries expire after `ttl` seconds and the least recently read ones
+    are deleted once the file holds more than `max_entries`.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, max_entries, ttl):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS llm_cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                'expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+                )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed_at '
+                'ON llm_cache (accessed_at)'
+                )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT value FROM llm_cache WHERE key = ? AND expires_at > ?',
+                (key, now)
+                ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                'UPDATE llm_cache SET accessed_at = ? WHERE key = ?',
+                (now, key)
+                )
+        return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO llm_cache '
+                '(key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, value, now + self.ttl, now)
+                )
+            conn.execute('DELETE FROM llm_cache WHERE expires_at <= ?', (now,))
+            extra = conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+            extra -= self.max_entries
+            if extra > 0:
+                conn.execute(
+                    'DELETE FROM llm_cache WHERE key IN (SELECT key FROM '
+                    'llm_cache ORDER BY accessed_at LIMIT ?)', (extra,)
+                    )
+                self.evictions += extra
+
+    def __len__(self):
+        with self._connection() as conn:
+            return conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+
+
+class DatabaseBackend:
+    """
+    Cache backend keeping answers in the llm_cache table of the app
+    database.
+
+    Every backend behind the load balancer uses the same database, so
+    an answer paid for by one serves hits on the others. A read is one
+    primary key lookup; hits are remembered and their last_used_at
+    written in one batch every `touch_every` hits or `touch_interval`
+    seconds. Entries expire after `ttl` seconds, and every `prune_every`
+    writes the expired ones are deleted and, past `max_entries`, the
+    least recently used. Statements run on their own connection, never
+    in the transaction of the request, and a failing database is
+    reported as a miss.
+    """
+
+    name = 'database'
+
+    def __init__(self, app, max_entries, ttl, prune_every=100,
+                 touch_every=100, touch_interval=60):
+        self.app = app
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self.touch_every = touch_every
+        self.touch_interval = touch_interval
+        self.evictions = 0
+        self._writes = 0
+        self._used = {}
+        self._touched = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _engine(self):
+        with self.app.app_context():
+            return db.engine
+
+    def get(self, key):
+        table = LLMCacheEntry.__table__
+        now = _utcnow()
+        try:
+            with self._engine().connect() as conn:
+                value = conn.scalar(db.select(table.c.value).where(
+                    table.c.key == key, table.c.expires_at > now))
+        except SQLAlchemyError as error:
+            self.app.logger.warning('Could not read the answer cache: %s',
+                                    error)
+            return None
+        if value is not None:
+            with self._lock:
+                self._used[key] = now
+                flush = (len(self._used) >= self.touch_every
+                         or time.monotonic() - self._touched
+                         >= self.touch_interval)
+            if flush:
+                self.touch()
+        return value
+
+    def touch(self):
+        """ Write the last_used_at of the entries hit since the last call. """
+        with self._lock:
+            used, self._used = self._used, {}
+            self._touched = time.monotonic()
+        if not used:
+            return
+        table = LLMCacheEntry.__table__
+        try:
+            with self._engine().begin() as conn:
+                conn.execute(
+                    table.update()
+                    .where(table.c.key == db.bindparam('used_key'))
+                    .values(last_used_at=db.bindparam('used_at')),
+                    [{'used_key': key, 'used_at': used_at}
+                     for key, used_at in used.items()])
+        except SQLAlchemyError as error:
+            self.app.logger.warning('Could not write the answer cache: %s',
+                                    error)
+
+    def set(self, key, value):
+        table = LLMCacheEntry.__table__
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.prune_every == 0
+        try:
+            engine = self._engine()
+            with engine.begin() as conn:
+                now = _utcnow()
+                conn.execute(upsert(table, engine.dialect.name, ['key'],
+                                    ['value', 'expires_at', 'last_used_at']), {
+                    'key': key, 'value': value, 'last_used_at': now,
+                    'expires_at': now + datetime.timedelta(seconds=self.ttl)})
+            if prune:
+                self.prune()
+        except SQLAlchemyError as error:
+            self.app.logger.warning('Could not write the answer cache: %s',
+                                    error)
+
+    def prune(self):
+        """
+        Delete the expired entries and the least recently used past
+        max_entries, once the pending hits are written.
+        """
+        self.touch()
+        table = LLMCacheEntry.__table__
+        with self._engine().begin() as conn:
+            conn.execute(table.delete().where(
+                table.c.expires_at <= _utcnow()))
+            cutoff = conn.scalar(
+                db.select(table.c.last_used_at)
+                .order_by(table.c.last_used_at.desc())
+                .offset(self.max_entries).limit(1))
+            if cutoff is not None:
+                self.evictions += conn.execute(table.delete().where(
+                    table.c.last_used_at <= cutoff)).rowcount
+
+    def __len__(self):
+        with self._engine().connect() as conn:
+            return conn.scalar(db.select(db.func.count()).select_from(
+                LLMCacheEntry.__table__))
+
+
+class TieredBackend:
+    """
+    Cache backend reading a local backend before a shared one.
+
+    Answers found in the shared backend are copied to the local one,
+    which keeps them for its own, shorter, time to live.
+    """
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+        self.name = '{}+{}'.format(local.name, shared.name)
+
+    @property
+    def evictions(self):
+        return self.local.evictions + self.shared.evictions
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        self.shared.set(key, value)
+
+    def __len__(self):
+        return len(self.shared)
+
+
+class ResponseCache:
+    """
+    Cache of model answers keyed on the normalized question.
+
+    Attributes:
+        backend: A `MemoryBackend`, `SQLiteBackend`, `DatabaseBackend`
+            or `TieredBackend`.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups that had to call the model.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, question, system_prompt, model):
+        """
+        Return the cached answer for a question, or None.
+
+        Args:
+            question (str): The question as typed by the user.
+            system_prompt (str): The system prompt sent with the question.
+            model (str): The name of the model answering.
+
+        Returns:
+            dict: The cached payload, or None on a miss.
+        """
+        value = self.backend.get(cache_key(question, system_prompt, model))
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, question, system_prompt, model, payload):
+        """
+        Store the answer to a question.
+
+        Args:
+            question (str): The question as typed by the user.
+            system_prompt (str): The system prompt sent with the question.
+            model (str): The name of the model answering.
+            payload (dict): JSON serializable answer to cache.
+        """
+        self.backend.set(
+            cache_key(question, system_prompt, model), json.dumps(payload)
+            )
+
+    def stats(self):
+        """ Return the hit, miss and eviction counters of this process. """
+        return {
+            'backend': self.backend.name,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions,
+            'entries': len(self.backend)
+        }
+
+
+def _local_backend(config, kind, ttl):
+    """ Return the 'sqlite' or 'memory' backend of this host or process. """
+    max_entries = config['SEARCH_CACHE_MAX_ENTRIES']
+    if kind == 'sqlite':
+        return SQLiteBackend(config['SEARCH_CACHE_PATH'], max_entries, ttl)
+    return MemoryBackend(max_entries, ttl)
+
+
+def make_response_cache(app):
+    """
+    Build the response cache described by the app configuration.
+
+    SEARCH_CACHE_BACKEND 'database' shares answers through the app
+    database, behind a local tier chosen by SEARCH_CACHE_LOCAL
+    ('memory', 'sqlite' or 'none') that keeps them for at most
+    SEARCH_CACHE_LOCAL_TTL seconds. 'memory' and 'sqlite' alone only
+    share answers within a process or a host.
+
+    Args:
+        app (Flask): The app, read for SEARCH_CACHE_BACKEND,
+            SEARCH_CACHE_LOCAL, SEARCH_CACHE_LOCAL_TTL, SEARCH_CACHE_PATH,
+            SEARCH_CACHE_TTL and SEARCH_CACHE_MAX_ENTRIES.
+
+    Returns:
+        ResponseCache: The configured cache.
+    """
+    config = app.config
+    ttl = config['SEARCH_CACHE_TTL']
+    if config['SEARCH_CACHE_BACKEND'] != 'database':
+        return ResponseCache(
+            _local_backend(config, config['SEARCH_CACHE_BACKEND'], ttl))
+    shared = DatabaseBackend(app, config['SEARCH_CACHE_MAX_ENTRIES'], ttl)
+    if config['SEARCH_CACHE_LOCAL'] == 'none':
+        return ResponseCache(shared)
+    local = _local_backend(config, config['SEARCH_CACHE_LOCAL'],
+                           min(ttl, config['SEARCH_CACHE_LOCAL_TTL']))
+    return ResponseCache(TieredBackend(local, shared))
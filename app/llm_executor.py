@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+""" Module to bound and coalesce calls to the language model. """
+
+import threading
+from contextlib import contextmanager
+
+
+class LLMUnavailable(Exception):
+    """
+    Raised when a call to the language model cannot be made right now.
+
+    Attributes:
+        status (int): The HTTP status the route should answer with.
+        retry_after (int): Seconds the client should wait, if known.
+    """
+
+    status = 503
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMOverloaded(LLMUnavailable):
+    """ Raised when too many calls are already running or queued. """
+
+
+class _Call:
+    """ A call in progress, shared by every request asking the same thing. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _Slot:
+    """ A held permit to run one call; releasing it twice is harmless. """
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._held = True
+
+    def release(self):
+        executor = self._executor
+        with executor._lock:
+            if not self._held:
+                return
+            self._held = False
+            executor.in_flight -= 1
+        executor._slots.release()
+
+    def reacquire(self):
+        """
+        Wait for a slot again after `release`, like `LLMExecutor.acquire`.
+
+        Raises:
+            LLMOverloaded: If the queue is full or the deadline passes.
+        """
+        if self._held:
+            return
+        self._executor._wait()
+        self._held = True
+
+
+class LLMExecutor:
+    """
+    Cap the number of model calls running at once in this process.
+
+    At most `max_in_flight` calls run together. Up to `max_queued` more
+    wait up to `queue_timeout` seconds for a free slot, and anything
+    beyond that is refused with `LLMOverloaded` so worker threads are
+    given back to other routes instead of piling up behind the model.
+    Calls sharing a key are merged: the first one runs and every
+    concurrent duplicate waits for, and receives, its result.
+
+    Attributes:
+        in_flight (int): Calls currently running.
+        queued (int): Calls waiting for a slot.
+        coalesced (int): Calls answered by another call's result.
+        rejected (int): Calls refused because of load.
+    """
+
+    def __init__(self, max_in_flight=8, max_queued=32, queue_timeout=5.0,
+                 wait_timeout=60.0):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.wait_timeout = wait_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def _overloaded(self):
+        with self._lock:
+            self.rejected += 1
+        return LLMOverloaded(
+            'The search feature is busy. Please try again shortly.',
+            retry_after=max(1, int(self.queue_timeout))
+            )
+
+    def acquire(self):
+        """
+        Wait for a free slot, for at most `queue_timeout` seconds.
+
+        Returns:
+            _Slot: The permit; call its `release` method when done.
+
+        Raises:
+            LLMOverloaded: If the queue is full or the deadline passes.
+        """
+        self._wait()
+        return _Slot(self)
+
+    def _wait(self):
+        """ Take a slot for `acquire`, counting it as in flight. """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.queued >= self.max_queued:
+                    full = True
+                else:
+                    full = False
+                    self.queued += 1
+            if full:
+                raise self._overloaded()
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.queued -= 1
+            if not acquired:
+                raise self._overloaded()
+        with self._lock:
+            self.in_flight += 1
+
+    @contextmanager
+    def slot(self):
+        """ Hold a slot for the duration of a `with` block. """
+        permit = self.acquire()
+        try:
+            yield permit
+        finally:
+            permit.release()
+
+    def run(self, key, fn):
+        """
+        Run `fn` in a slot, merging it with a running call of the same key.
+
+        Args:
+            key (str): Identifies identical calls, or None to never merge.
+            fn (callable): The call to make, taking no arguments.
+
+        Returns:
+            The value returned by `fn`, possibly from another request.
+
+        Raises:
+            LLMOverloaded: If no slot frees up in time.
+            Exception: Whatever `fn` raised, re-raised in every waiter.
+        """
+        def in_slot():
+            with self.slot():
+                return fn()
+
+        return self.merge(key, in_slot)
+
+    def merge(self, key, fn):
+        """
+        Same as `run`, leaving `fn` to take its own slot.
+
+        Lets a call give its slot back while it waits, for instance
+        between retries, and still be shared by identical calls.
+        """
+        if key is None:
+            return fn()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            if not call.done.wait(self.wait_timeout):
+                raise self._overloaded()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """ Return the executor counters as a dictionary. """
+        return {
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected
+        }
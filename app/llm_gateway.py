@@ -0,0 +1,630 @@
+#!/usr/bin/env python3
+""" Module to guard every call made to the language model. """
+
+import os
+import sqlite3
+import threading
+import time
+import openai
+from sqlalchemy import case
+from sqlalchemy.exc import SQLAlchemyError
+from app.backoff import backoff_delay
+from app.dialects import insert_ignore
+from app.llm_accounting import usage
+from app.llm_executor import LLMUnavailable
+from app.metrics import upstream_timer
+from app.models import LLMBucket, db
+from app.tokens import count_message_tokens, count_tokens
+
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError
+)
+
+
+class LLMRateLimited(LLMUnavailable):
+    """ Raised when a caller has used up its share of model calls. """
+
+    status = 429
+
+
+class LLMCircuitOpen(LLMUnavailable):
+    """ Raised without calling the model while the upstream is failing. """
+
+
+class LLMUpstreamError(LLMUnavailable):
+    """ Raised when the model keeps failing after every retry. """
+
+    status = 502
+
+
+class MemoryBucketStore:
+    """
+    Token bucket state kept in the memory of this process.
+
+    A bucket that has filled up again is the same as a missing one, so
+    every `sweep_interval` seconds the full buckets are dropped; one per
+    client address would otherwise be kept forever.
+    """
+
+    def __init__(self, sweep_interval=60.0):
+        self.sweep_interval = sweep_interval
+        self._buckets = {}
+        self._swept = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, rate, capacity, now):
+        """
+        Take one token from a bucket, refilling it first.
+
+        Args:
+            key (str): The bucket name.
+            rate (float): Tokens added per second.
+            capacity (float): The most tokens the bucket holds.
+            now (float): The current time in seconds.
+
+        Returns:
+            float: 0 if a token was taken, else the seconds until one is
+            available.
+        """
+        with self._lock:
+            if self._swept is None or now - self._swept >= self.sweep_interval:
+                self._sweep(now)
+            tokens, updated, _ = self._buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now,
+                                  now + (capacity - tokens) / rate)
+            return wait
+
+    def _sweep(self, now):
+        """ Drop the buckets that are full again. """
+        self._swept = now
+        for key in [key for key, (_, _, full_at) in self._buckets.items()
+                    if full_at <= now]:
+            del self._buckets[key]
+
+
+class SQLiteBucketStore:
+    """
+    Token bucket state kept in a SQLite file.
+
+    Every worker process using the same file draws from the same buckets,
+    so the limits hold for the whole host instead of for each worker.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS llm_buckets ('
+                'key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                'updated REAL NOT NULL)'
+                )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, capacity, now):
+        """ Same as `MemoryBucketStore.take`, atomic across processes. """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT tokens, updated FROM llm_buckets WHERE key = ?',
+                (key,)
+                ).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(0, now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            conn.execute(
+                'INSERT OR REPLACE INTO llm_buckets (key, tokens, updated) '
+                'VALUES (?, ?, ?)', (key, tokens, now)
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class DatabaseBucketStore:
+    """
+    Token bucket state kept in the llm_bucket table of the app database.
+
+    Every worker of every backend behind the load balancer draws from the
+    same buckets, so the limits hold for the whole deployment. A token is
+    taken by one conditional UPDATE, atomic on any database, and full
+    buckets are deleted every `prune_every` takes. Statements run on
+    their own connection; a failing database lets the call through.
+    """
+
+    def __init__(self, app, prune_every=1000):
+        self.app = app
+        self.prune_every = prune_every
+        self._takes = 0
+        self._lock = threading.Lock()
+
+    def _engine(self):
+        with self.app.app_context():
+            return db.engine
+
+    def take(self, key, rate, capacity, now):
+        """ Same as `MemoryBucketStore.take`, shared through the database. """
+        table = LLMBucket.__table__
+        refilled = table.c.tokens + (now - table.c.updated) * rate
+        level = case((refilled > capacity, capacity), else_=refilled)
+        with self._lock:
+            self._takes += 1
+            prune = self._takes % self.prune_every == 0
+        try:
+            engine = self._engine()
+            # full_at first: MySQL assigns left to right.
+            update = (
+                table.update().where(table.c.key == key, level >= 1)
+                .ordered_values(
+                    (table.c.full_at, now + (capacity - level + 1) / rate),
+                    (table.c.tokens, level - 1),
+                    (table.c.updated, now))
+                )
+            with engine.begin() as conn:
+                taken = conn.execute(update).rowcount
+                if not taken and capacity >= 1:
+                    taken = conn.execute(
+                        insert_ignore(table, engine.dialect.name).values(
+                            key=key, tokens=capacity - 1, updated=now,
+                            full_at=now + 1 / rate)
+                        ).rowcount
+                    if not taken:
+                        # Another take created the bucket meanwhile.
+                        taken = conn.execute(update).rowcount
+                row = None if taken else conn.execute(
+                    db.select(table.c.tokens, table.c.updated)
+                    .where(table.c.key == key)
+                    ).first()
+            if prune:
+                self.prune(now)
+        except SQLAlchemyError as error:
+            self.app.logger.warning('Could not read the rate limits: %s',
+                                    error)
+            return 0
+        if row is None:
+            return 0 if taken else 1 / rate
+        tokens = min(capacity, row.tokens + max(0, now - row.updated) * rate)
+        wait = (1 - tokens) / rate
+        # A bucket refilled since the UPDATE still refused this take.
+        return wait if wait > 0 else 1 / rate
+
+    def prune(self, now):
+        """ Delete the buckets that are full again. """
+        table = LLMBucket.__table__
+        with self._engine().begin() as conn:
+            conn.execute(table.delete().where(table.c.full_at <= now))
+
+
+class RateLimiter:
+    """
+    A global token bucket plus one token bucket per user.
+
+    Rates are given per minute; bursts are the bucket capacities.
+    """
+
+    def __init__(self, store, user_rate, user_burst, global_rate,
+                 global_burst, clock=time.time):
+        self.store = store
+        self.user_rate = user_rate / 60.0
+        self.user_burst = user_burst
+        self.global_rate = global_rate / 60.0
+        self.global_burst = global_burst
+        self.rejected = 0
+        self._clock = clock
+
+    def check(self, user):
+        """
+        Take a token for a call made on behalf of a user.
+
+        Args:
+            user (str): Identifies the caller, or None to only apply the
+                global limit.
+
+        Raises:
+            LLMRateLimited: If either bucket is empty.
+        """
+        now = self._clock()
+        if user is not None:
+            wait = self.store.take('user:' + str(user), self.user_rate,
+                                   self.user_burst, now)
+            if wait:
+                self.rejected += 1
+                raise LLMRateLimited(
+                    'You are asking too many questions. Please slow down.',
+                    retry_after=max(1, int(wait + 0.999))
+                    )
+        wait = self.store.take('global', self.global_rate,
+                               self.global_burst, now)
+        if wait:
+            self.rejected += 1
+            raise LLMRateLimited(
+                'The search feature is busy. Please try again shortly.',
+                retry_after=max(1, int(wait + 0.999))
+                )
+
+
+class CircuitBreaker:
+    """
+    Stop calling the model while it keeps failing.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    every call fails at once for `reset_timeout` seconds. Then a single
+    trial call is let through: success closes the breaker, failure opens
+    it again.
+
+    Attributes:
+        state (str): 'closed', 'open' or 'half_open'.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Check that a call may be made.
+
+        Returns:
+            bool: True if the call is the trial of a half open breaker;
+            pass it to `after_call` once the call has ended.
+
+        Raises:
+            LLMCircuitOpen: If the breaker is open.
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return False
+            remaining = self._opened_at + self.reset_timeout - self._clock()
+            if self.state == 'open' and remaining <= 0:
+                self.state = 'half_open'
+                self._trial = False
+            if self.state == 'half_open' and not self._trial:
+                self._trial = True
+                return True
+            raise LLMCircuitOpen(
+                'The search feature is temporarily unavailable.',
+                retry_after=max(1, int(remaining + 0.999))
+                )
+
+    def after_call(self, trial):
+        """
+        End a call let through by `before_call`, however it ended.
+
+        A trial interrupted by something other than an API error records
+        neither outcome; clearing it here lets the next call be the
+        trial instead of keeping the breaker open for good.
+
+        Args:
+            trial (bool): What `before_call` returned for the call.
+        """
+        if trial:
+            with self._lock:
+                self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == 'half_open'
+                    or self.failures >= self.failure_threshold):
+                self.state = 'open'
+                self._opened_at = self._clock()
+
+
+class LLMGateway:
+    """
+    The only way routes reach the model.
+
+    Each call is rate limited per user and globally, waits for a slot in
+    the executor (which also merges identical calls), fails fast while
+    the circuit breaker is open, and is retried with exponential backoff
+    and jitter on errors that are worth retrying. Every call, refused
+    or not, is recorded in `calls` if given.
+
+    Attributes:
+        client: The OpenAI client, with its own retries turned off.
+        limiter (RateLimiter): The per user and global limits.
+        breaker (CircuitBreaker): Tracks upstream health.
+        executor (LLMExecutor): Bounds and coalesces calls.
+        calls (LLMCallLog): Records the tokens and latency of calls.
+    """
+
+    def __init__(self, client, limiter, breaker, executor, max_retries=3,
+                 base_delay=0.5, max_delay=8.0, sleep=time.sleep, calls=None):
+        self.client = client.with_options(max_retries=0)
+        self.limiter = limiter
+        self.breaker = breaker
+        self.executor = executor
+        self.calls = calls
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self._sleep = sleep
+
+    def _retry_delay(self, attempt, error):
+        """
+        Record a failed attempt and return how long to wait before the next.
+
+        Raises:
+            LLMUpstreamError: If the error is not worth retrying, or the
+                retries are used up.
+        """
+        if not isinstance(error, RETRYABLE_ERRORS):
+            # The upstream answered, it just refused this request.
+            self.breaker.record_success()
+            raise LLMUpstreamError(
+                'Sorry, the search feature failed. Please try again.'
+                ) from error
+        self.breaker.record_failure()
+        if attempt > self.max_retries:
+            raise LLMUpstreamError(
+                'Sorry, the search feature is currently unavailable '
+                'due to high demand. Please try again later.',
+                retry_after=int(self.max_delay)
+                ) from error
+        self.retries += 1
+        return backoff_delay(attempt, self.base_delay, self.max_delay, error)
+
+    def _create(self, permit=None, **kwargs):
+        """
+        Call the chat API through the breaker, retrying if worthwhile.
+
+        Args:
+            permit (_Slot): The executor slot the call runs in, given back
+                while waiting to retry so other calls can use it.
+            **kwargs: The arguments of the chat API.
+
+        Raises:
+            LLMOverloaded: If no slot frees up in time for a retry.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            trial = self.breaker.before_call()
+            try:
+                with upstream_timer('openai', 'chat.completions'):
+                    response = self.client.chat.completions.create(**kwargs)
+            except openai.APIError as error:
+                delay = self._retry_delay(attempt, error)
+            else:
+                self.breaker.record_success()
+                return response
+            finally:
+                self.breaker.after_call(trial)
+            if permit is not None:
+                permit.release()
+            self._sleep(delay)
+            if permit is not None:
+                permit.reacquire()
+
+    def _record(self, endpoint, question, model, user, started, cache='miss',
+                status='ok', tokens=(0, 0), first_token=None):
+        """ Record a call in the call log, if there is one. """
+        if self.calls is not None:
+            self.calls.record(endpoint, model, user, cache, status, started,
+                              question=question, prompt_tokens=tokens[0],
+                              completion_tokens=tokens[1],
+                              first_token=first_token)
+
+    def _record_refusal(self, endpoint, question, model, user, started,
+                        error):
+        """ Record a call that failed with `LLMUnavailable`. """
+        status = 'error' if isinstance(error, LLMUpstreamError) else 'rejected'
+        self._record(endpoint, question, model, user, started, status=status)
+
+    def complete(self, messages, model, user=None, key=None, endpoint='llm',
+                 question=None, **kwargs):
+        """
+        Return a chat completion.
+
+        Args:
+            messages (list): The chat messages.
+            model (str): The model name.
+            user (str): Identifies the caller for rate limiting.
+            key (str): Calls sharing a key are merged, None to never merge.
+            endpoint (str): What the call is for, in the call log.
+            question (str): The question asked, in the call log.
+            **kwargs: Extra arguments for the chat API.
+
+        Only the request whose call is not merged is charged a rate limit
+        token. Requests merged into a call refused by the rate limit, the
+        limit of another caller, try again on their own.
+
+        Raises:
+            LLMUnavailable: If the call is refused or keeps failing.
+        """
+        started = time.perf_counter()
+        made = []
+
+        def call():
+            # Only runs for the request whose call is not merged.
+            made.append(True)
+            self.limiter.check(user)
+            with self.executor.slot() as permit:
+                return self._create(permit, model=model, messages=messages,
+                                    **kwargs)
+
+        try:
+            while True:
+                try:
+                    response = self.executor.merge(key, call)
+                    break
+                except LLMRateLimited:
+                    if made:
+                        raise
+        except LLMUnavailable as error:
+            self._record_refusal(endpoint, question, model, user, started,
+                                 error)
+            raise
+        if made:
+            self._record(endpoint, question, model, user, started,
+                         tokens=usage(response, messages))
+        else:
+            self._record(endpoint, question, model, user, started,
+                         cache='shared')
+        return response
+
+    def stream(self, messages, model, user=None, endpoint='llm',
+               question=None, **kwargs):
+        """
+        Start a streamed chat completion.
+
+        The call holds an executor slot, except while waiting to retry,
+        until the returned permit is released, which the caller must do
+        once the stream is consumed.
+        The call is recorded when the stream ends; its tokens are
+        estimated, as streams do not report usage.
+
+        Returns:
+            tuple: The executor permit and an iterator of deltas (str).
+
+        Raises:
+            LLMUnavailable: If the call is refused or cannot be started.
+        """
+        started = time.perf_counter()
+        try:
+            self.limiter.check(user)
+            permit = self.executor.acquire()
+        except LLMUnavailable as error:
+            self._record_refusal(endpoint, question, model, user, started,
+                                 error)
+            raise
+        try:
+            stream = self._create(permit, model=model, messages=messages,
+                                  stream=True, **kwargs)
+        except BaseException as error:
+            permit.release()
+            if isinstance(error, LLMUnavailable):
+                self._record_refusal(endpoint, question, model, user,
+                                     started, error)
+            raise
+
+        def finished(status, first_token, text):
+            self._record(endpoint, question, model, user, started,
+                         status=status, first_token=first_token,
+                         tokens=(count_message_tokens(messages),
+                                 count_tokens(text)))
+
+        return permit, self._deltas(stream, finished)
+
+    def _deltas(self, stream, finished=None):
+        """
+        Yield the text of a stream, counting a broken stream as a failure.
+
+        `finished` is called with the outcome, the time of the first
+        token and the text once the stream ends, fails or is closed.
+        """
+        parts = []
+        first_token = None
+        status = 'cancelled'
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+            status = 'ok'
+        except openai.APIError as error:
+            status = 'error'
+            self.breaker.record_failure()
+            raise LLMUpstreamError(
+                'Sorry, the search feature failed. Please try again.'
+                ) from error
+        finally:
+            if finished is not None:
+                finished(status, first_token, ''.join(parts))
+
+    def stats(self):
+        """ Return the gateway counters as a dictionary. """
+        stats = self.executor.stats()
+        stats.update({
+            'rate_limited': self.limiter.rejected,
+            'retries': self.retries,
+            'breaker': self.breaker.state
+        })
+        return stats
+
+
+def make_gateway(client, executor, app, calls=None):
+    """
+    Build the gateway described by the app configuration.
+
+    LLM_RATE_LIMIT_BACKEND 'database' shares the rate limits through the
+    app database, so they hold for the whole deployment; 'sqlite' and
+    'memory' only share them within a host or a process, each of which
+    then allows the full rates.
+
+    Args:
+        client: The OpenAI client.
+        executor (LLMExecutor): The executor bounding calls.
+        app (Flask): The app, read for the LLM_* settings.
+        calls (LLMCallLog): Where to record calls, if anywhere.
+
+    Returns:
+        LLMGateway: The configured gateway.
+    """
+    config = app.config
+    if config['LLM_RATE_LIMIT_BACKEND'] == 'database':
+        store = DatabaseBucketStore(app)
+    elif config['LLM_RATE_LIMIT_BACKEND'] == 'sqlite':
+        store = SQLiteBucketStore(config['LLM_RATE_LIMIT_PATH'])
+    else:
+        store = MemoryBucketStore()
+    limiter = RateLimiter(
+        store,
+        user_rate=config['LLM_USER_RATE_PER_MINUTE'],
+        user_burst=config['LLM_USER_BURST'],
+        global_rate=config['LLM_GLOBAL_RATE_PER_MINUTE'],
+        global_burst=config['LLM_GLOBAL_BURST']
+        )
+    breaker = CircuitBreaker(
+        failure_threshold=config['LLM_BREAKER_FAILURES'],
+        reset_timeout=config['LLM_BREAKER_RESET_TIMEOUT']
+        )
+    return LLMGateway(
+        client, limiter, breaker, executor,
+        max_retries=config['LLM_MAX_RETRIES'],
+        base_delay=config['LLM_RETRY_BASE_DELAY'],
+        max_delay=config['LLM_RETRY_MAX_DELAY'],
+        calls=calls
+        )
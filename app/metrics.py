@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+""" Module to collect request and upstream metrics in Prometheus format. """
+
+import os
+import time
+from contextlib import contextmanager
+from flask import request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+    REGISTRY, generate_latest
+    )
+from prometheus_client import multiprocess
+
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+    )
+UNMATCHED = '<unmatched>'
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds',
+    'Time from receiving a request to sending the last byte of its body.',
+    ['method', 'endpoint'], buckets=LATENCY_BUCKETS
+    )
+REQUESTS = Counter(
+    'http_requests_total', 'Requests answered, by status code.',
+    ['method', 'endpoint', 'status']
+    )
+IN_FLIGHT = Gauge(
+    'http_requests_in_flight', 'Requests being processed or streamed.',
+    ['endpoint'], multiprocess_mode='livesum'
+    )
+UPSTREAM_LATENCY = Histogram(
+    'upstream_request_duration_seconds',
+    'Time spent waiting on services the app calls.',
+    ['upstream', 'operation', 'outcome'], buckets=LATENCY_BUCKETS
+    )
+EMAIL_FILTER_LOOKUPS = Counter(
+    'email_filter_lookups_total',
+    'Email existence checks: absent (answered by the Bloom filter), '
+    'present, false_positive or unfiltered (filter not built yet).',
+    ['result']
+    )
+EMAIL_FILTER_FALSE_POSITIVE_RATE = Gauge(
+    'email_filter_estimated_false_positive_rate',
+    'False positive rate of the Bloom filter, estimated from its fill.',
+    multiprocess_mode='livemax'
+    )
+EMAIL_FILTER_ITEMS = Gauge(
+    'email_filter_items', 'Emails added to the Bloom filter.',
+    multiprocess_mode='livemax'
+    )
+EMAIL_FILTER_REBUILDS = Histogram(
+    'email_filter_rebuild_duration_seconds',
+    'Time taken to rebuild the Bloom filter from the database, by reason.',
+    ['reason'], buckets=LATENCY_BUCKETS
+    )
+
+
+@contextmanager
+def upstream_timer(upstream, operation):
+    """
+    Time a call to an upstream service.
+
+    Args:
+        upstream (str): The service, e.g. 'openai' or 'smtp'.
+        operation (str): What was asked of it.
+    """
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        UPSTREAM_LATENCY.labels(upstream, operation, outcome).observe(
+            time.perf_counter() - started)
+
+
+class MetricsMiddleware:
+    """
+    WSGI middleware timing every request until its body is fully sent.
+
+    Timing at the WSGI level rather than in Flask hooks covers streamed
+    responses such as /search/stream until their last event. Requests
+    are labelled with their Flask endpoint, not their path, so the
+    number of series stays bounded.
+
+    With several worker processes, PROMETHEUS_MULTIPROC_DIR must point
+    every worker at the same empty directory before the app is imported;
+    `/metrics` then adds up the values of all of them. Scrape each
+    backend directly rather than through the load balancer, so its
+    `instance` label tells the backends apart.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        app.before_request(self._route)
+
+    def _route(self):
+        endpoint = request.endpoint or UNMATCHED
+        request.environ['metrics.endpoint'] = endpoint
+        IN_FLIGHT.labels(endpoint).inc()
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        status = []
+
+        def recording_start_response(code, headers, exc_info=None):
+            status[:] = [code.split(' ', 1)[0]]
+            return start_response(code, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, recording_start_response)
+        except BaseException:
+            self._done(environ, started, '500')
+            raise
+        return _ClosingIterator(body, lambda: self._done(
+            environ, started, status[0] if status else '500'))
+
+    def _done(self, environ, started, status):
+        endpoint = environ.get('metrics.endpoint')
+        if endpoint is not None:
+            IN_FLIGHT.labels(endpoint).dec()
+        endpoint = endpoint or UNMATCHED
+        method = environ.get('REQUEST_METHOD', '')
+        REQUEST_LATENCY.labels(method, endpoint).observe(
+            time.perf_counter() - started)
+        REQUESTS.labels(method, endpoint, status).inc()
+
+
+class _ClosingIterator:
+    """ Response body calling a function once the server closes it. """
+
+    def __init__(self, body, callback):
+        self._body = body
+        self._iterator = iter(body)
+        self._callback = callback
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._callback()
+
+
+def render():
+    """
+    Return the current metrics of this process, or of every worker.
+
+    Returns:
+        tuple: The exposition text and its content type.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
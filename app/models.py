@@ -3,9 +3,11 @@
 
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.dialects import mysql
+import datetime
 import uuid
 from wtforms import ValidationError
+from .passwords import hasher
 
 
 db = SQLAlchemy()
@@ -25,11 +27,20 @@ class User(db.Model, UserMixin):
 
     def set_password(self, password):
         """Set the password for the user."""
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.hash(password)
 
     def check_password(self, password):
-        """Check if the provided password matches the user's password."""
-        return check_password_hash(self.password_hash, password)
+        """
+        Check if the provided password matches the user's password.
+
+        A matching password stored with outdated hashing settings is
+        hashed again; the caller commits the new hash.
+        """
+        if not hasher.verify(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
     
     def validate_username(self, username):
         """Validate the uniqueness of the username."""
@@ -61,6 +72,28 @@ class University(db.Model):
     location = db.Column(db.String(120), nullable=False)
     website = db.Column(db.String(120))
     status = db.Column(db.String(20), default='closed')
+    like_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0', index=True
+        )
+    # When the catalog content of the row last changed; like_count
+    # changes leave it alone. Microseconds are kept so the ETag of the
+    # row changes with every update.
+    updated_at = db.Column(
+        db.DateTime().with_variant(mysql.DATETIME(fsp=6), 'mysql'),
+        nullable=False,
+        default=lambda: datetime.datetime.now(
+            datetime.timezone.utc).replace(tzinfo=None)
+        )
+
+    def to_dict(self):
+        """Return a dictionary representation of the university."""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'location': self.location,
+            'website': self.website,
+            'status': self.status
+        }
 
 class UserPreference(db.Model):
     """Class representing a user's preference in the app."""
@@ -69,3 +102,193 @@ class UserPreference(db.Model):
     # id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'))
     university_id = db.Column(db.String(36), db.ForeignKey('university.id'))
+
+    __table_args__ = (
+        db.UniqueConstraint(
+            'user_id', 'university_id',
+            name='uq_user_preference_user_university'
+            ),
+        )
+
+class EmailFilterLog(db.Model):
+    """
+    Class representing an email registered since the Bloom filters of
+    the app were built; a row without email asks them to rebuild.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    email = db.Column(db.String(60))
+    created_at = db.Column(
+        db.DateTime, nullable=False, index=True,
+        default=lambda: datetime.datetime.now(
+            datetime.timezone.utc).replace(tzinfo=None)
+        )
+
+class CatalogVersion(db.Model):
+    """
+    Class representing the version of the university catalog, a single
+    row whose number goes up with every change to a university.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class PreferenceVersion(db.Model):
+    """
+    Class representing the version of the likes, a single row whose
+    number goes up with every like or unlike.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class ChatSession(db.Model):
+    """
+    Class representing a conversation of a user with the search
+    assistant; `summary` condenses the messages up to and including
+    `summarized_through`, which are no longer sent to the model.
+    """
+
+    id = db.Column(db.String(36), default=lambda: str(uuid.uuid4()), primary_key=True)
+    user_id = db.Column(db.String(36), db.ForeignKey('user.id'),
+                        nullable=False, index=True)
+    summary = db.Column(db.Text)
+    summarized_through = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(
+        db.DateTime, nullable=False,
+        default=lambda: datetime.datetime.now(
+            datetime.timezone.utc).replace(tzinfo=None)
+        )
+    updated_at = db.Column(
+        db.DateTime, nullable=False,
+        default=lambda: datetime.datetime.now(
+            datetime.timezone.utc).replace(tzinfo=None)
+        )
+
+    def to_dict(self):
+        """Return a dictionary representation of the session."""
+        return {
+            'id': self.id,
+            'summary': self.summary,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat()
+        }
+
+class ChatMessage(db.Model):
+    """
+    Class representing one message of a chat session, stored with its
+    token count so the history is budgeted without counting it again.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(36), db.ForeignKey('chat_session.id'),
+                           nullable=False, index=True)
+    role = db.Column(db.String(10), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    tokens = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(
+        db.DateTime, nullable=False,
+        default=lambda: datetime.datetime.now(
+            datetime.timezone.utc).replace(tzinfo=None)
+        )
+
+    def to_dict(self):
+        """Return a dictionary representation of the message."""
+        return {
+            'role': self.role,
+            'content': self.content,
+            'created_at': self.created_at.isoformat()
+        }
+
+class LLMCall(db.Model):
+    """
+    Class representing one request answered with the language model or
+    its cache, appended by `app.llm_accounting` and never updated.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+    endpoint = db.Column(db.String(32), nullable=False)
+    model = db.Column(db.String(64), nullable=False)
+    user = db.Column(db.String(64))
+    question = db.Column(db.String(255))
+    cache = db.Column(db.String(10), nullable=False)
+    status = db.Column(db.String(10), nullable=False)
+    prompt_tokens = db.Column(db.Integer, nullable=False, default=0)
+    completion_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cost = db.Column(db.Float, nullable=False, default=0)
+    latency_ms = db.Column(db.Float, nullable=False)
+    first_token_ms = db.Column(db.Float)
+
+class LLMCacheEntry(db.Model):
+    """
+    Class representing a cached answer of the language model, shared by
+    every backend; `app.llm_cache` ignores it once `expires_at` has
+    passed and deletes it later, or sooner when it is among the least
+    recently used, by `last_used_at`, of a full cache.
+    """
+
+    __tablename__ = 'llm_cache'
+
+    key = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_used_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class LLMBucket(db.Model):
+    """
+    Class representing a token bucket of the language model rate limits,
+    shared by every backend; a bucket is full again at `full_at`, after
+    which `app.llm_gateway` may delete it. Times are Unix seconds.
+    """
+
+    __tablename__ = 'llm_bucket'
+
+    key = db.Column(db.String(100), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated = db.Column(db.Float, nullable=False)
+    full_at = db.Column(db.Float, nullable=False, index=True)
+
+class EmailOutbox(db.Model):
+    """
+    Class representing an email to send, written in the transaction of
+    the request that wants it sent; `app.outbox` sends pending rows
+    once `next_attempt_at` has passed and marks them sent or dead.
+    While a worker sends it the row is 'sending' and `next_attempt_at`
+    is the end of its lease.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(
+        db.DateTime, nullable=False,
+        default=lambda: datetime.datetime.now(
+            datetime.timezone.utc).replace(tzinfo=None)
+        )
+    from_email = db.Column(db.String(120))
+    recipients = db.Column(db.Text, nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(
+        db.DateTime, nullable=False,
+        default=lambda: datetime.datetime.now(
+            datetime.timezone.utc).replace(tzinfo=None)
+        )
+    last_error = db.Column(db.String(255))
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt_at',
+                 'status', 'next_attempt_at'),
+        )
+
+
+db.event.listen(CatalogVersion.__table__, 'after_create', db.DDL(
+    'INSERT INTO catalog_version (id, version, updated_at) '
+    'VALUES (1, 0, CURRENT_TIMESTAMP)'
+    ))
+db.event.listen(PreferenceVersion.__table__, 'after_create', db.DDL(
+    'INSERT INTO preference_version (id, version) VALUES (1, 0)'
+    ))
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+""" Module to send emails from an outbox table, off the request. """
+
+import datetime
+import os
+import smtplib
+import threading
+import time
+from flask_mailman import EmailMessage
+from app.backoff import backoff_delay
+from app.metrics import upstream_timer
+from app.models import EmailOutbox, db
+
+
+class EmailNotSent(Exception):
+    """ Raised when the mail backend accepted a message but sent nothing. """
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def enqueue_email(subject, body, to, from_email=None):
+    """
+    Add an email to the outbox, in the current transaction.
+
+    The email is only sent once the caller commits, and is never sent
+    if the transaction is rolled back. Call `outbox.notify` after the
+    commit so the sender does not wait for its next poll.
+
+    Args:
+        subject (str): The subject.
+        body (str): The plain text body.
+        to (list): The recipient addresses.
+        from_email (str): The sender, MAIL_DEFAULT_SENDER if None.
+
+    Returns:
+        EmailOutbox: The new row.
+    """
+    row = EmailOutbox(subject=subject, body=body, recipients=','.join(to),
+                      from_email=from_email)
+    db.session.add(row)
+    return row
+
+
+def is_permanent(error):
+    """
+    Tell whether an SMTP error will not go away by trying again.
+
+    Args:
+        error (Exception): What sending raised.
+
+    Returns:
+        bool: True for 5xx replies, including every recipient refused.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return isinstance(error, EmailNotSent)
+
+
+class OutboxSender:
+    """
+    Send the pending rows of the outbox from a background thread.
+
+    The thread wakes up when `notify` is called or every
+    `poll_interval` seconds, and sends the due rows in batches of
+    `batch_size` over a single SMTP connection, which stays open until
+    it has been idle for `idle_timeout` seconds. A batch is claimed in a
+    short transaction, locking its rows with SKIP LOCKED so several
+    workers can share the outbox, and marking them 'sending' for
+    `lease_timeout` seconds; no lock or transaction is held while the
+    emails are sent, and each one gets its status in its own commit.
+    Rows of a worker that died while sending are claimed again once
+    their lease has run out. A failed
+    email is tried again after an exponential backoff with jitter, and
+    dead-lettered (status 'dead') after `max_attempts` attempts or on
+    a permanent error. `start` runs before every request, so each
+    worker process sends the outbox whether or not it queued anything.
+    Under TESTING no thread is started; call `drain` to send the due
+    rows.
+
+    Attributes:
+        sent (int): Emails sent by this process.
+        retried (int): Failed attempts that will be tried again.
+        dead (int): Emails given up on.
+        connections (int): SMTP connections opened.
+    """
+
+    def __init__(self, app=None, mail=None):
+        self.app = None
+        self.mail = None
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+        self.connections = 0
+        self._connection = None
+        self._last_used = 0.0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        if app is not None:
+            self.init_app(app, mail)
+
+    def init_app(self, app, mail):
+        """ Read the OUTBOX_* settings of the app. """
+        self.app = app
+        self.mail = mail
+        self.batch_size = app.config['OUTBOX_BATCH_SIZE']
+        self.poll_interval = app.config['OUTBOX_POLL_INTERVAL']
+        self.max_attempts = app.config['OUTBOX_MAX_ATTEMPTS']
+        self.base_delay = app.config['OUTBOX_RETRY_BASE_DELAY']
+        self.max_delay = app.config['OUTBOX_RETRY_MAX_DELAY']
+        self.idle_timeout = app.config['OUTBOX_IDLE_TIMEOUT']
+        self.lease_timeout = app.config['OUTBOX_LEASE_TIMEOUT']
+
+    def start(self):
+        """ Start the sender thread in this process, unless it runs already. """
+        if self.app.testing:
+            return
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._connection = None
+                    self._stopping.clear()
+                    self._thread = threading.Thread(
+                        target=self._run, name='outbox', daemon=True)
+                    self._thread.start()
+                    self._pid = pid
+
+    def stop(self, timeout=None):
+        """
+        Stop the sender thread of this process after a last drain.
+
+        Args:
+            timeout (float): Seconds to wait for the thread, None for as
+                long as it takes.
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._thread = None
+            self._pid = None
+            self._stopping.set()
+        self._wake.set()
+        thread.join(timeout)
+
+    def notify(self):
+        """ Wake the sender up, starting it in this process if needed. """
+        if self.app.testing:
+            return
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    self.drain()
+            except Exception as error:
+                self.app.logger.warning('Could not drain the outbox: %s',
+                                        error)
+            if self._stopping.is_set():
+                self.close()
+                return
+            if (self._connection is not None and time.monotonic()
+                    - self._last_used > self.idle_timeout):
+                self.close()
+
+    def _open(self):
+        """ Return the SMTP connection, opening it if needed. """
+        if self._connection is None:
+            connection = self.mail.get_connection()
+            connection.open()
+            self._connection = connection
+            self.connections += 1
+        return self._connection
+
+    def close(self):
+        """ Close the SMTP connection, if open. """
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+    def _send(self, row):
+        """ Send one row over the shared connection. """
+        connection = self._open()
+        message = EmailMessage(row.subject, row.body, row.from_email,
+                               row.recipients.split(','),
+                               connection=connection)
+        try:
+            with upstream_timer('smtp', 'send'):
+                if not connection.send_messages([message]):
+                    raise EmailNotSent('No recipient accepted the email')
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # Reconnect for the next email.
+            self.close()
+            raise
+        finally:
+            self._last_used = time.monotonic()
+
+    def _failed(self, row, attempts, error):
+        """ Return the values scheduling the row again or dead-lettering it. """
+        values = {'last_error': str(error)[:255]}
+        if is_permanent(error) or attempts >= self.max_attempts:
+            self.dead += 1
+            self.app.logger.warning('Gave up on email %s after %d attempts: %s',
+                                    row.id, attempts, error)
+            values['status'] = 'dead'
+            return values
+        delay = max(self.base_delay, backoff_delay(
+            attempts, self.base_delay, self.max_delay))
+        self.retried += 1
+        values.update(status='pending', next_attempt_at=_utcnow()
+                      + datetime.timedelta(seconds=delay))
+        return values
+
+    def claim(self):
+        """
+        Lease up to `batch_size` due emails to this worker and commit.
+
+        Returns:
+            list: The claimed rows, with the attempts made before this one.
+        """
+        now = _utcnow()
+        table = EmailOutbox.__table__
+        rows = db.session.execute(
+            db.select(table.c.id, table.c.subject, table.c.body,
+                      table.c.from_email, table.c.recipients,
+                      table.c.attempts)
+            .where(table.c.status.in_(('pending', 'sending')),
+                   table.c.next_attempt_at <= now)
+            .order_by(table.c.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+            ).all()
+        if rows:
+            db.session.execute(
+                table.update()
+                .where(table.c.id.in_([row.id for row in rows]))
+                .values(status='sending', attempts=table.c.attempts + 1,
+                        next_attempt_at=now + datetime.timedelta(
+                            seconds=self.lease_timeout))
+                )
+        db.session.commit()
+        return rows
+
+    def send_batch(self):
+        """
+        Send up to `batch_size` due emails, committing each new status.
+
+        Returns:
+            int: The number of rows attempted.
+        """
+        table = EmailOutbox.__table__
+        rows = self.claim()
+        for row in rows:
+            attempts = row.attempts + 1
+            try:
+                self._send(row)
+            except Exception as error:
+                values = self._failed(row, attempts, error)
+            else:
+                values = {'status': 'sent', 'sent_at': _utcnow(),
+                          'last_error': None}
+                self.sent += 1
+            # Only while the lease is ours: it may have run out and the
+            # row been claimed again meanwhile.
+            db.session.execute(table.update().where(
+                table.c.id == row.id, table.c.status == 'sending',
+                table.c.attempts == attempts
+                ).values(**values))
+            db.session.commit()
+        return len(rows)
+
+    def drain(self):
+        """
+        Send batches until no email is due.
+
+        Returns:
+            int: The number of rows attempted.
+        """
+        total = 0
+        while True:
+            count = self.send_batch()
+            total += count
+            if count < self.batch_size:
+                return total
+
+    def stats(self):
+        """ Return the sender counters as a dictionary. """
+        return {
+            'sent': self.sent,
+            'retried': self.retried,
+            'dead': self.dead,
+            'connections': self.connections
+        }
+
+
+outbox = OutboxSender()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+""" Module to paginate and stream the university listing. """
+
+import base64
+import json
+from flask import current_app
+from app.models import University
+
+
+def encode_cursor(university_id):
+    """
+    Encode the id of the last university on a page as an opaque cursor.
+
+    Args:
+        university_id (str): The id of the last university returned.
+
+    Returns:
+        str: A url safe cursor to pass back as `next`.
+    """
+    raw = json.dumps({'after': university_id}).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by `encode_cursor`.
+
+    Args:
+        cursor (str): The opaque cursor sent by the client.
+
+    Returns:
+        str: The id to continue after, or None for the first page.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        after = data['after']
+    except (ValueError, TypeError, KeyError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(after, str):
+        raise ValueError('Invalid cursor')
+    return after
+
+
+def page_size(requested=None):
+    """
+    Clamp a requested page size to the configured bounds.
+
+    Args:
+        requested (int): The page size asked for by the client, if any.
+
+    Returns:
+        int: A page size between 1 and UNIVERSITIES_MAX_PAGE_SIZE.
+    """
+    default = current_app.config['UNIVERSITIES_PAGE_SIZE']
+    maximum = current_app.config['UNIVERSITIES_MAX_PAGE_SIZE']
+    if not requested or requested < 1:
+        return min(default, maximum)
+    return min(requested, maximum)
+
+
+def paginate_universities(cursor=None, limit=None):
+    """
+    Return one page of universities ordered on the primary key.
+
+    The page is selected with `id > after` rather than an OFFSET, so
+    every page costs one index range scan whatever its position.
+
+    Args:
+        cursor (str): The `next` cursor of the previous page, if any.
+        limit (int): The requested page size.
+
+    Returns:
+        tuple: The list of universities and the cursor of the next page,
+        which is None on the last page.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    after = decode_cursor(cursor)
+    limit = page_size(limit)
+    query = University.query.order_by(University.id)
+    if after is not None:
+        query = query.filter(University.id > after)
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+    return rows, next_cursor
+
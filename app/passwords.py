@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+""" Module to hash and check passwords outside the request threads. """
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import (DEFAULT_PBKDF2_ITERATIONS,
+                               check_password_hash, generate_password_hash)
+
+
+def hash_settings(method):
+    """
+    Return the algorithm and costs a werkzeug method stands for.
+
+    Missing costs are filled in with werkzeug's defaults, the way
+    `generate_password_hash` does, so 'pbkdf2' and
+    'pbkdf2:sha256:600000' give the same settings.
+
+    Args:
+        method (str): A werkzeug method, or the part of a stored hash
+            before the first '$'.
+
+    Returns:
+        tuple: The algorithm and its costs, or None if werkzeug cannot
+        make such hashes.
+    """
+    name, *args = (method or '').split(':')
+    try:
+        if name == 'scrypt':
+            n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+            return name, n, r, p
+        if name == 'pbkdf2' and len(args) <= 2:
+            hash_name = args[0] if args else 'sha256'
+            iterations = (int(args[1]) if len(args) == 2
+                          else DEFAULT_PBKDF2_ITERATIONS)
+            return name, hash_name, iterations
+    except ValueError:
+        pass
+    return None
+
+
+class PasswordHashingBusy(Exception):
+    """
+    Raised when too many passwords are already waiting to be hashed.
+
+    Attributes:
+        status (int): The HTTP status the route should answer with.
+        retry_after (int): Seconds the client should wait before retrying.
+    """
+
+    status = 503
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    """
+    Run werkzeug's deliberately slow key derivation in worker processes.
+
+    Each hash keeps a core busy for tens of milliseconds; in a pool of
+    processes it no longer holds up the threads serving other requests.
+    At most `max_pending` hashes run or wait at once; callers beyond
+    that wait up to `queue_timeout` seconds for room, then get
+    `PasswordHashingBusy`. With no workers, hashes run in the caller.
+
+    Attributes:
+        method (str): The werkzeug method of new hashes, with its cost
+            parameters, e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'.
+        workers (int): Processes in the pool, 0 to hash in the caller.
+        max_pending (int): Hashes allowed to run or wait at once.
+        queue_timeout (float): Seconds to wait for room among them.
+        timeout (float): Seconds to wait for a hash to finish.
+    """
+
+    def __init__(self, method='scrypt:32768:8:1', workers=0, max_pending=16,
+                 queue_timeout=2.0, timeout=30.0):
+        self._lock = threading.Lock()
+        self._executor = None
+        self.configure(method, workers, max_pending, queue_timeout, timeout)
+
+    def configure(self, method, workers, max_pending, queue_timeout, timeout):
+        """ Apply new settings, shutting down the current pool if any. """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self.method = method
+            self.workers = workers
+            self.max_pending = max_pending
+            self.queue_timeout = queue_timeout
+            self.timeout = timeout
+            self._pending = threading.BoundedSemaphore(max(max_pending, 1))
+            self._settings = hash_settings(method)
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # Forking a threaded server can copy held locks into the
+                # child; spawned workers only import werkzeug.
+                self._executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                    )
+            return self._executor
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _run(self, function, *args):
+        if self.workers <= 0:
+            return function(*args)
+        pending = self._pending
+        if not pending.acquire(timeout=self.queue_timeout):
+            raise PasswordHashingBusy('Too many password checks in progress')
+        try:
+            for attempt in range(2):
+                executor = self._pool()
+                try:
+                    return executor.submit(function, *args).result(
+                        self.timeout)
+                except BrokenProcessPool:
+                    # A worker died, e.g. killed for memory; start afresh.
+                    self._discard(executor)
+                    if attempt:
+                        raise
+                except FutureTimeoutError:
+                    raise PasswordHashingBusy(
+                        'Password hashing is taking too long')
+        finally:
+            pending.release()
+
+    def hash(self, password):
+        """
+        Hash a password with the configured method.
+
+        Args:
+            password (str): The password in clear.
+
+        Returns:
+            str: The hash to store, in werkzeug's format.
+        """
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        """
+        Check a password against a stored hash.
+
+        Hashes werkzeug can no longer read, such as the plain 'sha256'
+        ones of old releases, never match.
+
+        Args:
+            password_hash (str): The stored hash.
+            password (str): The password in clear.
+
+        Returns:
+            bool: Whether the password matches.
+        """
+        if not password_hash or password is None:
+            return False
+        try:
+            return self._run(check_password_hash, password_hash, password)
+        except ValueError:
+            return False
+
+    def needs_rehash(self, password_hash):
+        """
+        Tell whether a stored hash was made with other settings.
+
+        Args:
+            password_hash (str): The stored hash.
+
+        Returns:
+            bool: True unless it uses the configured method and costs.
+        """
+        settings = hash_settings((password_hash or '').split('$', 1)[0])
+        return settings is None or settings != self._settings
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+""" Module to recommend universities from the likes of similar students. """
+
+import threading
+import numpy as np
+from flask import current_app
+from scipy import sparse
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from app import catalog
+from app.forms import COUNTRY_CHOICES
+from app.models import PreferenceVersion, University, UserPreference, db
+
+
+class ItemItemRecommender:
+    """
+    Item to item collaborative filtering over university likes.
+
+    The co-occurrence matrix C = XᵀX of the binary user × university
+    like matrix X is kept in sparse form, its diagonal holding how often
+    each university is liked. The cosine similarity of two universities
+    is C[i, j] / sqrt(C[i, i] * C[j, j]), and the `k` most similar
+    universities of each one are precomputed, so a recommendation is a
+    few array lookups. A new like or unlike only touches the rows of the
+    universities it changes.
+
+    Attributes:
+        k (int): Neighbors kept per university.
+        loaded (bool): Whether the model has been built from the database.
+        version (int): The likes version the model accounts for, None
+            once it is known to be out of date.
+    """
+
+    def __init__(self, k=20):
+        self.k = k
+        self.loaded = False
+        self.version = None
+        self._lock = threading.RLock()
+        self._refreshing = False
+        self._thread = None
+        self._reset([])
+
+    def _reset(self, university_ids):
+        self._items = list(university_ids)
+        self._item_index = {uid: i for i, uid in enumerate(self._items)}
+        self._user_items = {}
+        n = len(self._items)
+        self._cooc = sparse.lil_matrix((n, n), dtype=np.float64)
+        self._counts = np.zeros(n)
+        self._neighbors = np.full((n, self.k), -1, dtype=np.int64)
+        self._similarities = np.zeros((n, self.k), dtype=np.float64)
+
+    def build(self, likes, university_ids, version=None):
+        """
+        Rebuild the whole model.
+
+        Args:
+            likes (iterable): (user_id, university_id) pairs.
+            university_ids (iterable): The ids of every university.
+            version (int): The likes version they were read at.
+        """
+        with self._lock:
+            self._reset(university_ids)
+            rows, cols, users = [], [], {}
+            for user_id, university_id in likes:
+                col = self._item_index.get(university_id)
+                if col is None:
+                    continue
+                rows.append(users.setdefault(user_id, len(users)))
+                cols.append(col)
+                self._user_items.setdefault(user_id, set()).add(col)
+            n = len(self._items)
+            matrix = sparse.csr_matrix(
+                (np.ones(len(rows)), (rows, cols)), shape=(len(users), n)
+                )
+            matrix.sum_duplicates()
+            matrix.data[:] = 1
+            cooc = (matrix.T @ matrix).tocsr()
+            self._cooc = cooc.tolil()
+            counts = cooc.diagonal()
+            self._counts = counts.astype(np.float64)
+            norms = np.sqrt(np.where(counts > 0, counts, 1))
+            scale = sparse.diags(1 / norms)
+            similarities = (scale @ cooc @ scale).tocsr()
+            similarities = similarities - sparse.diags(
+                similarities.diagonal())
+            similarities = similarities.tocsr()
+            similarities.eliminate_zeros()
+            for i in range(n):
+                start, end = similarities.indptr[i:i + 2]
+                self._store_neighbors(i, similarities.indices[start:end],
+                                      similarities.data[start:end])
+            self.version = version
+            self.loaded = True
+
+    def replace(self, other):
+        """
+        Take over the model of another recommender in one step.
+
+        Args:
+            other (ItemItemRecommender): A recommender built aside.
+        """
+        state = dict(vars(other))
+        for name in ('_lock', '_refreshing', '_thread'):
+            del state[name]
+        with self._lock:
+            self.__dict__.update(state)
+
+    def _store_neighbors(self, i, cols, sims):
+        """ Keep the k most similar universities of row i. """
+        self._neighbors[i] = -1
+        self._similarities[i] = 0
+        if len(cols) > self.k:
+            top = np.argpartition(sims, -self.k)[-self.k:]
+            cols, sims = cols[top], sims[top]
+        order = np.argsort(-sims, kind='stable')
+        self._neighbors[i, :len(order)] = cols[order]
+        self._similarities[i, :len(order)] = sims[order]
+
+    def _refresh(self, i):
+        """ Recompute the neighbors of row i from the co-occurrences. """
+        cols = np.array(self._cooc.rows[i], dtype=np.int64)
+        counts = np.array(self._cooc.data[i], dtype=np.float64)
+        keep = cols != i
+        cols, counts = cols[keep], counts[keep]
+        if self._counts[i] <= 0 or not len(cols):
+            self._store_neighbors(i, cols[:0], counts[:0])
+            return
+        self._store_neighbors(
+            i, cols, counts / np.sqrt(self._counts[i] * self._counts[cols]))
+
+    def _item(self, university_id):
+        """ Return the row of a university, growing the model if needed. """
+        i = self._item_index.get(university_id)
+        if i is None:
+            i = len(self._items)
+            self._items.append(university_id)
+            self._item_index[university_id] = i
+            self._cooc.resize((i + 1, i + 1))
+            self._counts = np.append(self._counts, 0.0)
+            self._neighbors = np.vstack(
+                [self._neighbors, np.full((1, self.k), -1, dtype=np.int64)])
+            self._similarities = np.vstack(
+                [self._similarities, np.zeros((1, self.k))])
+        return i
+
+    def _apply(self, user_id, university_id, delta):
+        i = self._item(university_id)
+        items = self._user_items.setdefault(user_id, set())
+        if (i in items) == (delta > 0):
+            return
+        others = items - {i}
+        if delta > 0:
+            items.add(i)
+        else:
+            items.discard(i)
+        for j in others:
+            self._cooc[i, j] += delta
+            self._cooc[j, i] += delta
+        self._cooc[i, i] += delta
+        self._counts[i] += delta
+        # Every university co-liked with i sees its similarity to i change.
+        for j in set(self._cooc.rows[i]) | others | {i}:
+            self._refresh(j)
+
+    def _advance(self, version):
+        """ Move to the version of a change applied on top of the one before. """
+        if (version is not None and self.version is not None
+                and self.version in (version - 1, version)):
+            self.version = version
+
+    def add_like(self, user_id, university_id, version=None):
+        """
+        Account for a new like without rebuilding the model.
+
+        Args:
+            user_id (str): The user who liked.
+            university_id (str): The university liked.
+            version (int): The likes version the like was committed at.
+        """
+        with self._lock:
+            if self.loaded:
+                self._apply(user_id, university_id, 1)
+                self._advance(version)
+
+    def remove_like(self, user_id, university_id, version=None):
+        """ Account for a removed like without rebuilding the model. """
+        with self._lock:
+            if self.loaded:
+                self._apply(user_id, university_id, -1)
+                self._advance(version)
+
+    def apply(self, action, row=None, version=None):
+        """ Mark the model out of date when universities disappear. """
+        if action in ('delete', 'reset'):
+            with self._lock:
+                self.version = None
+
+    def current(self, version):
+        """
+        Tell whether the model matches the likes in the database.
+
+        Args:
+            version (int): The likes version in the database.
+        """
+        return self.loaded and self.version == version
+
+    def refresh(self, app, k=None):
+        """
+        Rebuild the model from the database in a background thread.
+
+        The current model keeps serving until the new one replaces it.
+        Does nothing while a rebuild is already running.
+
+        Args:
+            app (Flask): The application, for its database.
+            k (int): Neighbors to keep per university.
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self._thread = threading.Thread(
+                target=self._refresh_in_background, args=(app, k),
+                name='recommender', daemon=True)
+        self._thread.start()
+
+    def _refresh_in_background(self, app, k):
+        try:
+            with app.app_context():
+                self.replace(load(k or self.k))
+        except Exception:
+            app.logger.exception('Could not rebuild the recommender')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def recommend(self, user_id, n=10):
+        """
+        Return the universities most similar to those a user likes.
+
+        Args:
+            user_id (str): The user to recommend for.
+            n (int): The maximum number of recommendations.
+
+        Returns:
+            list: (university_id, score) tuples, best first; empty when
+            the user has no likes yet.
+        """
+        with self._lock:
+            liked = self._user_items.get(user_id)
+            if not liked:
+                return []
+            rows = np.fromiter(liked, dtype=np.int64)
+            neighbors = self._neighbors[rows].ravel()
+            similarities = self._similarities[rows].ravel()
+            valid = neighbors >= 0
+            candidates, inverse = np.unique(neighbors[valid],
+                                            return_inverse=True)
+            scores = np.bincount(inverse, weights=similarities[valid])
+            keep = ~np.isin(candidates, rows) & (scores > 0)
+            candidates, scores = candidates[keep], scores[keep]
+            if len(candidates) > n:
+                top = np.argpartition(scores, -n)[-n:]
+                candidates, scores = candidates[top], scores[top]
+            order = np.argsort(-scores, kind='stable')
+            return [(self._items[candidates[i]], float(scores[i]))
+                    for i in order]
+
+
+recommender = ItemItemRecommender()
+catalog.subscribe(recommender.apply)
+
+
+def version():
+    """
+    Return the likes version.
+
+    The version goes up once per committed transaction that likes or
+    unlikes, from any process. Costs one primary key lookup; must be
+    called within an application context.
+
+    Returns:
+        int: The version number.
+    """
+    return db.session.scalar(
+        db.select(PreferenceVersion.version)
+        .where(PreferenceVersion.id == 1)
+        ) or 0
+
+
+def load(k):
+    """
+    Build a recommender from the database.
+
+    Must be called within an application context.
+
+    Args:
+        k (int): Neighbors to keep per university.
+
+    Returns:
+        ItemItemRecommender: A new recommender, not the shared one.
+    """
+    # Read the version first: likes committed meanwhile bump it again.
+    at = version()
+    likes = db.session.execute(db.select(
+        UserPreference.user_id, UserPreference.university_id
+        ))
+    university_ids = db.session.scalars(db.select(University.id))
+    engine = ItemItemRecommender(k)
+    engine.build(likes, list(university_ids), at)
+    return engine
+
+
+def ensure_loaded(k=None):
+    """
+    Return the recommender, rebuilding it if the likes changed.
+
+    Costs a read of the likes version, so the likes of other processes
+    are taken into account. A recommender out of date goes on serving
+    while a background thread rebuilds it; until the first build ends
+    it recommends nothing. Under testing the rebuild is done at once.
+    Must be called within an application context.
+
+    Args:
+        k (int): Neighbors to keep per university on the next build.
+
+    Returns:
+        ItemItemRecommender: The shared recommender.
+    """
+    if recommender.current(version()):
+        return recommender
+    app = current_app._get_current_object()
+    if app.testing:
+        recommender.replace(load(k or recommender.k))
+    else:
+        recommender.refresh(app, k)
+    return recommender
+
+
+def record_like(session, user_id, university_id, delta):
+    """
+    Bump the likes version for a like made in a transaction.
+
+    The like is applied to the recommender of this process once the
+    transaction commits, along with the version it brings, so this
+    process does not rebuild for its own likes. Statements writing the
+    like must opt out of the automatic bump with the execution option
+    `bump_likes_version=False`.
+
+    Args:
+        session (Session): The session of the transaction.
+        user_id (str): The user who liked or unliked.
+        university_id (str): The university.
+        delta (int): 1 for a like, -1 for an unlike.
+    """
+    _bump(session, session.connection())
+    session.info.setdefault('like_changes', []).append(
+        (user_id, university_id, delta)
+        )
+
+
+def _bump(session, connection, tracked=True):
+    """ Bump the version, once per transaction, within that transaction. """
+    if session is None:
+        return
+    if not tracked:
+        session.info['likes_untracked'] = True
+    if 'likes_version' in session.info:
+        return
+    table = PreferenceVersion.__table__
+    connection.execute(table.update().where(table.c.id == 1).values(
+        version=table.c.version + 1))
+    session.info['likes_version'] = connection.execute(
+        db.select(table.c.version).where(table.c.id == 1)
+        ).scalar()
+
+
+@event.listens_for(UserPreference, 'after_insert')
+@event.listens_for(UserPreference, 'after_update')
+@event.listens_for(UserPreference, 'after_delete')
+def _after_write(mapper, connection, target):
+    _bump(object_session(target), connection, tracked=False)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _bulk_change(orm_execute_state):
+    table = getattr(orm_execute_state.statement, 'table', None)
+    if ((orm_execute_state.is_insert or orm_execute_state.is_update
+            or orm_execute_state.is_delete)
+            and getattr(table, 'name', None) == UserPreference.__tablename__
+            and orm_execute_state.execution_options.get(
+                'bump_likes_version', True)):
+        session = orm_execute_state.session
+        _bump(session, session.connection(), tracked=False)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    at = session.info.pop('likes_version', None)
+    if session.info.pop('likes_untracked', False):
+        at = None
+    for user_id, university_id, delta in session.info.pop('like_changes', []):
+        if delta > 0:
+            recommender.add_like(user_id, university_id, at)
+        else:
+            recommender.remove_like(user_id, university_id, at)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('likes_version', None)
+    session.info.pop('likes_untracked', None)
+    session.info.pop('like_changes', None)
+
+
+def location_fallback(location, n, exclude=()):
+    """
+    Recommend the most liked universities in a user's country.
+
+    Used for users without likes, and to fill short recommendation
+    lists. Universities elsewhere fill any remaining places.
+
+    Args:
+        location (str): The country code stored on the user, e.g. 'KE'.
+        n (int): The maximum number of recommendations.
+        exclude (iterable): University ids not to recommend.
+
+    Returns:
+        list: University ids, best first.
+    """
+    exclude = set(exclude)
+    country = dict(COUNTRY_CHOICES).get(location, location)
+    ids = []
+    queries = []
+    if country:
+        queries.append(db.select(University.id).where(
+            University.location.ilike('%{}%'.format(country))))
+    queries.append(db.select(University.id))
+    for query in queries:
+        query = query.order_by(University.like_count.desc(), University.id)
+        query = query.limit(n + len(exclude) + len(ids))
+        for university_id in db.session.scalars(query):
+            if university_id not in exclude and university_id not in ids:
+                ids.append(university_id)
+        if len(ids) >= n:
+            break
+    return ids[:n]
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+""" Module to ground model answers in the university catalog. """
+
+import re
+from app.search_index import ensure_loaded, tokenize
+from app.tokens import count_tokens
+
+
+# Words that describe what is asked rather than which university is meant.
+QUESTION_WORDS = {
+    'a', 'about', 'am', 'an', 'and', 'any', 'are', 'best', 'can', 'college',
+    'colleges', 'do', 'does', 'find', 'for', 'good', 'help', 'i', 'in', 'is',
+    'looking', 'me', 'my', 'of', 'offer', 'offers', 'please', 'recommend',
+    'school', 'schools', 'should', 'study', 'suggest', 'the', 'to', 'top',
+    'universities', 'university', 'want', 'what', 'where', 'which', 'with',
+    'you'
+}
+CITATION_RE = re.compile(r'\[([0-9A-Za-z-]+)\]')
+
+
+def retrieve(question, k):
+    """
+    Return the catalog rows most relevant to a question.
+
+    Args:
+        question (str): The question as typed by the user.
+        k (int): The maximum number of rows to return.
+
+    Returns:
+        list: University dictionaries, most relevant first.
+    """
+    words = [w for w in tokenize(question) if w not in QUESTION_WORDS]
+    if not words or k < 1:
+        return []
+    return [row for _, row in ensure_loaded().search(' '.join(words), k)]
+
+
+def build_context(rows, budget):
+    """
+    Describe catalog rows in as few tokens as possible.
+
+    Rows are added in order until the next one would exceed the budget.
+
+    Args:
+        rows (list): University dictionaries, most relevant first.
+        budget (int): The maximum number of tokens of the block.
+
+    Returns:
+        tuple: The context block (empty if nothing fits) and the rows
+        it describes.
+    """
+    header = 'Universities in our catalog ([id] name - location - website):'
+    used = count_tokens(header)
+    lines = []
+    included = []
+    for row in rows:
+        line = '[{}] {} - {} - {}'.format(
+            row['id'], row['name'], row['location'], row['website'] or '-'
+            )
+        cost = count_tokens(line)
+        if used + cost > budget:
+            break
+        used += cost
+        lines.append(line)
+        included.append(row)
+    if not lines:
+        return '', []
+    return '\n'.join([header] + lines), included
+
+
+def grounded_prompt(base_prompt, question, k, budget):
+    """
+    Extend a system prompt with the catalog rows relevant to a question.
+
+    Args:
+        base_prompt (str): The system prompt without context.
+        question (str): The question as typed by the user.
+        k (int): The maximum number of rows to consider.
+        budget (int): The token budget of the context block.
+
+    Returns:
+        tuple: The system prompt and the rows it cites.
+    """
+    context, rows = build_context(retrieve(question, k), budget)
+    if not context:
+        return base_prompt, []
+    instructions = (
+        'Answer in a few short sentences. Prefer the universities listed '
+        'below and cite each one you mention by its id in square '
+        'brackets, for example [{}].'.format(rows[0]['id'])
+        )
+    return '\n\n'.join([base_prompt, instructions, context]), rows
+
+
+def cited_sources(answer, rows):
+    """
+    Return the catalog rows cited in an answer, in order of citation.
+
+    Args:
+        answer (str): The model's answer.
+        rows (list): The rows that were given to the model.
+
+    Returns:
+        list: Dictionaries with the 'id' and 'name' of each cited row.
+    """
+    by_id = {row['id']: row for row in rows}
+    sources = []
+    for university_id in dict.fromkeys(CITATION_RE.findall(answer or '')):
+        row = by_id.get(university_id)
+        if row is not None:
+            sources.append({'id': row['id'], 'name': row['name']})
+    return sources
@@ -1,23 +1,48 @@
 #!/usr/bin/env python3
 """ Module to define the routes used in the app. """
 
+import hmac
+import json
 import os
-from flask import flash, jsonify, redirect, render_template, request, session, url_for
-from flask_login import current_user, login_required, login_user
+import time
+from flask import Response, abort, flash, jsonify, redirect, render_template, request, session, stream_with_context, url_for
+from flask_login import current_user, login_required, login_user, logout_user
 from itsdangerous import URLSafeTimedSerializer
-from openai import OpenAI, RateLimitError
+from openai import OpenAI
 
 # client = OpenAI()
 from sqlalchemy.exc import IntegrityError
-from app.models import University, User, db
-from . import app, mail, login_manager
+from app.models import ChatMessage, ChatSession, University, User, UserPreference, db
+from . import app, chat, llm_calls, login_manager
+from .admin import admin_required
+from .dialects import insert_ignore
+from .email_filter import email_filter
+from .fragments import FragmentCache
+from .llm_accounting import report as llm_report
 from .forms import LoginForm, SignupForm
-from werkzeug.security import generate_password_hash
-from flask_mailman import EmailMessage
+from .llm_cache import cache_key, make_response_cache
+from .llm_executor import LLMExecutor, LLMUnavailable
+from .llm_gateway import make_gateway
+from .outbox import enqueue_email, outbox
+from .metrics import render
+from .passwords import PasswordHashingBusy
+from .pagination import page_size, paginate_universities
+from .recommendations import record_like
+from .retrieval import cited_sources, grounded_prompt
+from .tokens import count_message_tokens
+from .user_cache import UserCache, track
+from markupsafe import Markup
 from openai import OpenAI
 
 
 client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+user_cache = track(UserCache(
+    app.config['USER_CACHE_MAX_ENTRIES'], app.config['USER_CACHE_TTL']
+    ))
+fragment_cache = FragmentCache(
+    app.config['FRAGMENT_CACHE_MAX_ENTRIES'],
+    app.config['FRAGMENT_CACHE_MAX_BYTES']
+    )
 
 @app.route('/', strict_slashes=False)
 def index():
@@ -38,6 +63,8 @@ def login_route():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
         if user is not None and user.check_password(form.password.data):
+            # Saves the new hash if check_password had to rehash.
+            db.session.commit()
             session['email'] = form.email.data
             login_user(user)
             flash('You are now logged in!')
@@ -49,6 +76,19 @@ def login_route():
             return redirect(url_for('login_route'), code=401)
     return render_template('login.html', form=form)
 
+@app.errorhandler(PasswordHashingBusy)
+def password_hashing_busy(error):
+    """
+    Ask the client to retry when every password worker is busy.
+    """
+    if request.path.startswith('/api/'):
+        response = jsonify(message=str(error))
+    else:
+        response = Response(str(error), mimetype='text/plain')
+    response.status_code = error.status
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
 @app.route('/signup', methods=['GET', 'POST'], strict_slashes=False)
 def signup_route():
     """
@@ -88,17 +128,13 @@ def profile_route():
     """
     Profile route.
     """
-    if 'email' not in session:
-        return redirect(url_for('login_route'))
-
-    user = User.query.filter_by(email=session['email']).first()
     return render_template(
         'profile.html',
-        username=user.username,
-        email=user.email,
-        phone=user.phonenumber,
-        location=user.location,
-        user_logged_in=current_user.is_authenticated
+        username=current_user.username,
+        email=current_user.email,
+        phone=current_user.phonenumber,
+        location=current_user.location,
+        user_logged_in=True
         )
 
 @app.route('/logout', strict_slashes=False)
@@ -107,83 +143,132 @@ def logout():
     Logout route.
     """
     session.pop('email', None)
+    logout_user()
     return redirect(url_for('login_route'))
 
 @app.route('/check_email', methods=['GET'], strict_slashes=False)
 def check_email():
-    """ Check if email being used to login exists in the database. """
+    """
+    Check if email being used to login exists in the database.
+    Unknown emails are answered by the email filter without a query.
+    """
     email = request.args.get('email', '', type=str)
-    user = User.query.filter_by(email=email).first()
-    return jsonify({'exists': user is not None})
+    return jsonify({'exists': email_filter.exists(email)})
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    """
+    Load the user of a session; Flask-Login keeps it for the request.
+    """
+    return user_cache.get(user_id)
 
 @app.route('/universities', methods=['GET'], strict_slashes=False)
 @login_required
 def get_universities():
     """
-    Route to get universities.
+    Route to get universities, one page at a time.
+    The rendered universities are cached until the catalog changes;
+    the like buttons, which depend on the user, are rendered around them.
     """
-    search_results = University.query.all()
+    cursor = request.args.get('cursor')
+    limit = page_size(request.args.get('limit', type=int))
+    try:
+        page = fragment_cache.get_or_render(
+            'universities', (cursor, limit),
+            lambda: render_university_page(cursor, limit)
+            )
+    except ValueError:
+        abort(400)
+    ids = [university_id for university_id, _ in page['items']]
+    liked = set(db.session.scalars(
+        db.select(UserPreference.university_id).where(
+            UserPreference.user_id == current_user.id,
+            UserPreference.university_id.in_(ids)
+            )
+        )) if ids else set()
     return render_template(
         'universities.html',
-        search_results=search_results,
+        items=[(university_id, Markup(html))
+               for university_id, html in page['items']],
+        liked=liked,
+        next_cursor=page['next'],
         user_logged_in=current_user.is_authenticated
         )
 
+def render_university_page(cursor, limit):
+    """
+    Render one page of universities, without anything user specific.
+    Returns the (id, html) pairs of the page and the next cursor.
+    """
+    universities, next_cursor = paginate_universities(cursor, limit)
+    template = app.jinja_env.get_template('university_item.html')
+    return {
+        'items': [(university.id, template.render(result=university))
+                  for university in universities],
+        'next': next_cursor
+        }
+
+def change_like_count(university_id, delta):
+    """
+    Add delta to the like counter of a university, in the current
+    transaction. Returns the number of universities updated.
+    Counters are not part of the catalog version.
+    """
+    table = University.__table__
+    return db.session.execute(
+        table.update()
+        .where(table.c.id == university_id)
+        .values(like_count=table.c.like_count + delta)
+        .execution_options(bump_catalog_version=False)
+        ).rowcount
+
 @app.route('/like', methods=['POST'], strict_slashes=False)
 @login_required
 def like():
     """
     Route to handle liking of a university.
-    This will update the university's rate field, and
-    add a new row in the UserPriferences table.
+    This inserts the (user, university) row unless it already exists,
+    and increments the university's like counter and the likes version
+    in the same transaction. Liking twice does nothing.
     """
-    if request.method == 'POST':
-        university_id = request.form.get('university_id')
-        user_id = current_user.id
-
-        # Check if the user has already liked the university
-        # if they do, do nothing.
-        exists_like = UserPreferences.query.filter_by(
-            user_id=user_id, university_id=university_id).first()
-        if exists_like:
-            return jsonify({'success': False})
-        else:
-            like = UserPreferences(user_id=user_id, university_id=university_id)
-            db.session.add(like)
-            db.session.commit()
-            return jsonify({'success': True})
+    university_id = request.form.get('university_id')
+    if not university_id:
+        return jsonify({'success': False}), 400
+    statement = insert_ignore(
+        UserPreference.__table__, db.session.get_bind().dialect.name
+        ).values(user_id=current_user.id, university_id=university_id
+                 ).execution_options(bump_likes_version=False)
+    inserted = db.session.execute(statement).rowcount
+    if inserted and not change_like_count(university_id, 1):
+        db.session.rollback()
+        return jsonify({'success': False}), 404
+    if inserted:
+        record_like(db.session, current_user.id, university_id, 1)
+    db.session.commit()
+    return jsonify({'success': bool(inserted)})
 
 @app.route('/dislike', methods=['POST'], strict_slashes=False)
 @login_required
 def dislike():
     """
     Route to handle disliking of a university.
-    This will update the university's rate field, and
-    remove a row in the UserPriferences table if exists.
+    This deletes the user's like of the university if it exists, and
+    decrements the university's like counter and bumps the likes
+    version in the same transaction.
     """
-    if request.method == 'POST':
-        university_id = request.form.get('university_id')
-        user_id = current_user.id
-
-        # Check if the user has already dislikes this university
-        # if they do, remove the dislike.
-        exists_dislike = UserPreferences.query.filter_by(
-            user_id=user_id, university_id=university_id).first()
-        if exists_dislike:
-            # Removing the dislike
-            db.session.delete(exists_dislike)
-            db.session.commit()
-            return jsonify({'success': True})
-        else:
-            dislike = UserPreferences(user_id=user_id,
-            university_id=university_id)
-            db.session.add(dislike)
-            db.session.commit()
-            return jsonify({'success': True})
+    university_id = request.form.get('university_id')
+    if not university_id:
+        return jsonify({'success': False}), 400
+    table = UserPreference.__table__
+    deleted = db.session.execute(table.delete().where(
+        table.c.user_id == current_user.id,
+        table.c.university_id == university_id
+        ).execution_options(bump_likes_version=False)).rowcount
+    if deleted:
+        change_like_count(university_id, -1)
+        record_like(db.session, current_user.id, university_id, -1)
+    db.session.commit()
+    return jsonify({'success': True})
 
 # An object to Help create tokens.
 s = URLSafeTimedSerializer('ThisisasecretToHelpCreateProtectedTokens!')
@@ -197,11 +282,16 @@ def reset_password():
         user = User.query.filter_by(email=email).first()
         if user:
             token = s.dumps(email, salt='email-confirm')
-            msg = EmailMessage('Password Reset Request', from_email='noreply@univercityapplicationcopilot.com', to=[email])
             link = url_for('reset_password_with_token', token=token, _external=True)
             print(link)
-            msg.body = f'Please follow the password reset link to change your password: {link}'
-            mail.send_message(msg)
+            # Sent by the outbox sender once committed, off the request.
+            enqueue_email(
+                'Password Reset Request',
+                f'Please follow the password reset link to change your password: {link}',
+                [email], from_email='noreply@univercityapplicationcopilot.com'
+                )
+            db.session.commit()
+            outbox.notify()
             flash('A password reset link has been sent to your email.', 'info')
         else:
             flash('Email address not found.', 'warning')
@@ -222,6 +312,9 @@ def reset_password_with_token(token):
         return redirect(url_for('reset_password'))
     if request.method == 'POST':
         user = User.query.filter_by(email=email).first()
+        if user is None:
+            flash('The password reset link is invalid or has expired.', 'warning')
+            return redirect(url_for('reset_password'))
         new_password = request.form['password']
 
         # Password validations
@@ -238,38 +331,326 @@ def reset_password_with_token(token):
             flash('Password must contain at least one lowercase letter.', 'warning')
             return redirect(url_for('reset_password_with_token', token=token))
 
-        hashed_password = generate_password_hash(new_password, method='sha256')
-        user.password = hashed_password
+        user.set_password(new_password)
         db.session.commit()
         flash('Your password has been updated!', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('login_route'))
     return render_template('reset_password_with_token.html')
 
+SEARCH_SYSTEM_PROMPT = 'I am looking for a university in \
+                the Africa that suits my desires. Can you help me?'
+search_cache = make_response_cache(app)
+llm_gateway = make_gateway(client, LLMExecutor(
+    max_in_flight=app.config['LLM_MAX_IN_FLIGHT'],
+    max_queued=app.config['LLM_MAX_QUEUED'],
+    queue_timeout=app.config['LLM_QUEUE_TIMEOUT'],
+    wait_timeout=app.config['LLM_WAIT_TIMEOUT']
+    ), app, llm_calls)
+
+def llm_user():
+    """
+    Identify the caller for rate limiting: the user id when logged in,
+    else the client address. ProxyFix sets it from the X-Forwarded-For
+    entry added by nginx, so a header sent by the client is ignored.
+    """
+    if current_user.is_authenticated:
+        return current_user.id
+    return request.remote_addr
+
+def search_prompt(question):
+    """
+    Build the system prompt for a question, grounded in the catalog.
+    Returns the prompt and the universities it lists.
+    """
+    return grounded_prompt(
+        SEARCH_SYSTEM_PROMPT, question,
+        app.config['SEARCH_CONTEXT_ROWS'],
+        app.config['SEARCH_CONTEXT_TOKENS']
+        )
+
+def search_messages(question, system_prompt):
+    """
+    Build the chat messages sent to the model for a question.
+    """
+    return [
+        {
+            'role': 'system',
+            'content': system_prompt
+        },
+        {
+            'role': 'user',
+            'content': question
+        }
+    ]
+
+def ask_model(question, system_prompt, model, user):
+    """
+    Ask the model a question and cache its answer.
+    Concurrent identical questions share a single call.
+    """
+    response = llm_gateway.complete(
+        search_messages(question, system_prompt), model, user=user,
+        key=cache_key(question, system_prompt, model), endpoint='search',
+        question=question, max_tokens=app.config['SEARCH_MAX_TOKENS']
+        )
+    answer = response.choices[0].message.content.strip()
+    search_cache.set(question, system_prompt, model, {'answer': answer})
+    return answer
+
+def llm_unavailable(error):
+    """
+    Build the JSON response for a model call refused because of load.
+    """
+    response = jsonify(success=False, error=str(error))
+    response.status_code = error.status
+    if error.retry_after is not None:
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
 @app.route('/search', methods=['GET'], strict_slashes=False)
 def search():
     """
     Route to help search for the perfect university.
+    The prompt lists the most relevant universities of the catalog,
+    and `sources` holds the ones the answer cites. Answers are cached
+    on the normalized question, and concurrent requests for the same
+    question share a single model call.
     """
+    started = time.perf_counter()
     question = request.args.get('question')
-    while True:
+    model = app.config['SEARCH_MODEL']
+    system_prompt, rows = search_prompt(question)
+    cached = search_cache.get(question, system_prompt, model)
+    if cached is not None:
+        llm_calls.record('search', model, llm_user(), 'hit', 'ok', started,
+                         question=question)
+        return jsonify(success=True, answer=cached['answer'],
+                       sources=cited_sources(cached['answer'], rows),
+                       cached=True)
+    try:
+        answer = ask_model(question, system_prompt, model, llm_user())
+    except LLMUnavailable as error:
+        return llm_unavailable(error)
+    return jsonify(success=True, answer=answer,
+                   sources=cited_sources(answer, rows), cached=False)
+
+def sse_event(data, event=None):
+    """
+    Format a dictionary as one Server-Sent Events message.
+    """
+    message = 'data: {}\n\n'.format(json.dumps(data))
+    if event is not None:
+        message = 'event: {}\n{}'.format(event, message)
+    return message
+
+def unavailable_event(error):
+    """
+    Format a model call refused because of load as a `failed` event.
+    EventSource cannot read the body of an error response, so streams
+    report refusals with status 200, like failures in mid stream, and
+    carry the `status` and `retry_after` the JSON routes would send.
+    """
+    data = {'error': str(error), 'status': error.status}
+    if error.retry_after is not None:
+        data['retry_after'] = error.retry_after
+    return sse_event(data, event='failed')
+
+@app.route('/search/stream', methods=['GET'], strict_slashes=False)
+def search_stream():
+    """
+    Route to stream the answer to a question as Server-Sent Events.
+    Every token is sent as a `message` event with a `delta` field as
+    soon as the model produces it, followed by a `done` event carrying
+    the cited `sources`, or a `failed` event carrying an `error` field,
+    also sent when the call is refused before it starts.
+    """
+    started = time.perf_counter()
+    question = request.args.get('question')
+    model = app.config['SEARCH_MODEL']
+    system_prompt, rows = search_prompt(question)
+    cached = search_cache.get(question, system_prompt, model)
+    permit = deltas = None
+    if cached is None:
         try:
-            jls_extract_var = 'I am looking for a university in \
-                the Africa that suits my desires. Can you help me?'
-            response = client.chat.completions.create(model='gpt-3.5-turbo',
-            messages=[
-                {
-                    'role': 'system',
-                    'content': jls_extract_var
-                },
-                {
-                    'role': 'user',
-                    'content': question
-                }
-            ])
-            print('Response got is: ', response)
-            return jsonify(success=True, answer=response.choices[0].text.strip())
-        except RateLimitError:
-            error_message = "Sorry,\
-                the search feature is currently unavailable \
-                due to high demand. Please try again later."
-            return jsonify(success=False, error=error_message)
+            permit, deltas = llm_gateway.stream(
+                search_messages(question, system_prompt), model,
+                user=llm_user(), endpoint='search_stream', question=question,
+                max_tokens=app.config['SEARCH_MAX_TOKENS']
+                )
+        except LLMUnavailable as error:
+            return Response(
+                unavailable_event(error), mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache'}
+                )
+    else:
+        llm_calls.record('search_stream', model, llm_user(), 'hit', 'ok',
+                         started, question=question)
+
+    def generate():
+        if cached is not None:
+            yield sse_event({'delta': cached['answer']})
+            yield sse_event({
+                'cached': True,
+                'sources': cited_sources(cached['answer'], rows)
+                }, event='done')
+            return
+        parts = []
+        try:
+            for delta in deltas:
+                parts.append(delta)
+                yield sse_event({'delta': delta})
+        except LLMUnavailable as error:
+            yield sse_event({'error': str(error)}, event='failed')
+            return
+        finally:
+            permit.release()
+        answer = ''.join(parts).strip()
+        search_cache.set(question, system_prompt, model, {'answer': answer})
+        yield sse_event({
+            'cached': False,
+            'sources': cited_sources(answer, rows)
+            }, event='done')
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+    if permit is not None:
+        # Give the slot back even if the client leaves before streaming.
+        response.call_on_close(permit.release)
+    return response
+
+def summarize_chat(summary, turns):
+    """
+    Fold older chat turns into the running summary of a session.
+    Returns None if the model cannot be reached, so the turns are
+    summarized on a later message instead.
+    """
+    try:
+        response = llm_gateway.complete(
+            chat.summary_messages(summary, turns), app.config['SEARCH_MODEL'],
+            user=llm_user(), endpoint='chat_summary',
+            max_tokens=app.config['CHAT_SUMMARY_TOKENS']
+            )
+    except LLMUnavailable:
+        return None
+    return response.choices[0].message.content.strip()
+
+@app.route('/chat', methods=['GET', 'POST'], strict_slashes=False)
+@login_required
+def chat_sessions():
+    """
+    Route to start a conversation with the search assistant, or to
+    list the conversations of the user, most recent first.
+    """
+    if request.method == 'POST':
+        conversation = ChatSession(user_id=current_user.id)
+        db.session.add(conversation)
+        db.session.commit()
+        return jsonify(success=True,
+                       session=conversation.to_dict()), 201
+    sessions = db.session.execute(
+        db.select(ChatSession)
+        .where(ChatSession.user_id == current_user.id)
+        .order_by(ChatSession.updated_at.desc())
+        ).scalars()
+    return jsonify(success=True,
+                   sessions=[conversation.to_dict()
+                             for conversation in sessions])
+
+@app.route('/chat/<session_id>', methods=['GET', 'POST', 'DELETE'],
+           strict_slashes=False)
+@login_required
+def chat_session(session_id):
+    """
+    Route to read, continue or delete a conversation.
+    A posted `message` is answered with the recent turns of the
+    conversation that fit in CHAT_PROMPT_TOKENS, after a summary of
+    the older ones; both messages are stored once the model answers.
+    """
+    conversation = chat.get_session(session_id, current_user.id)
+    if conversation is None:
+        return jsonify({'success': False}), 404
+    if request.method == 'GET':
+        messages = db.session.execute(
+            db.select(ChatMessage)
+            .where(ChatMessage.session_id == conversation.id)
+            .order_by(ChatMessage.id)
+            ).scalars()
+        return jsonify(success=True, session=conversation.to_dict(),
+                       messages=[message.to_dict() for message in messages])
+    if request.method == 'DELETE':
+        db.session.execute(db.delete(ChatMessage).where(
+            ChatMessage.session_id == conversation.id))
+        db.session.delete(conversation)
+        db.session.commit()
+        return jsonify(success=True)
+    data = request.get_json(silent=True) or request.form
+    question = (data.get('message') or '').strip()
+    if not question:
+        return jsonify({'success': False}), 400
+    system_prompt, rows = search_prompt(question)
+    summarize = summarize_chat if app.config['CHAT_SUMMARY_TOKENS'] else None
+    messages = chat.build_messages(conversation, system_prompt, question,
+                                   app.config['CHAT_PROMPT_TOKENS'],
+                                   summarize,
+                                   app.config['CHAT_SUMMARY_TOKENS'])
+    try:
+        response = llm_gateway.complete(
+            messages, app.config['SEARCH_MODEL'], user=llm_user(),
+            endpoint='chat', question=question,
+            max_tokens=app.config['SEARCH_MAX_TOKENS']
+            )
+    except LLMUnavailable as error:
+        # Keep a summary that was paid for even if the answer was not.
+        db.session.commit()
+        return llm_unavailable(error)
+    answer = response.choices[0].message.content.strip()
+    chat.add_message(conversation, 'user', question)
+    chat.add_message(conversation, 'assistant', answer)
+    db.session.commit()
+    return jsonify(success=True, answer=answer,
+                   sources=cited_sources(answer, rows),
+                   prompt_tokens=count_message_tokens(messages))
+
+@app.route('/search/cache', methods=['GET'], strict_slashes=False)
+def search_cache_stats():
+    """
+    Route to report the hit, miss and eviction counters of the search cache.
+    """
+    return jsonify(search_cache.stats())
+
+@app.route('/llm/report', methods=['GET'], strict_slashes=False)
+@admin_required
+def llm_report_route():
+    """
+    Route to report the tokens, cost and latency percentiles of model
+    calls per day and model, and the costliest questions, over the
+    last `days` days (7 by default). Only for admins, as it lists the
+    questions users asked.
+    """
+    days = request.args.get('days', 7, type=int)
+    if not 1 <= days <= 366:
+        return jsonify({'success': False}), 400
+    result = llm_report(days, sample=app.config['LLM_REPORT_SAMPLE'])
+    result['writer'] = llm_calls.stats()
+    return jsonify(result)
+
+@app.route('/metrics', methods=['GET'], strict_slashes=False)
+def metrics():
+    """
+    Route exposing request and upstream metrics in Prometheus text format.
+
+    When METRICS_TOKEN is set, scrapes must send it as a bearer token,
+    since the backends can be reached without going through nginx.
+    """
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(
+            request.headers.get('Authorization', ''),
+            'Bearer ' + token):
+        return Response('Unauthorized\n', status=401,
+                        content_type='text/plain',
+                        headers={'WWW-Authenticate': 'Bearer'})
+    body, content_type = render()
+    return Response(body, content_type=content_type)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+""" Module to define the in-process search index over universities. """
+
+import heapq
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+from app import catalog
+from app.models import University, db
+
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+FIELD_WEIGHTS = {'name': 3.0, 'location': 2.0, 'website': 1.0}
+STOPWORDS = {'a', 'an', 'and', 'at', 'for', 'in', 'of', 'the'}
+WEBSITE_NOISE = {'http', 'https', 'www'}
+
+
+def tokenize(text):
+    """
+    Split text into lower case, accent free tokens.
+
+    Args:
+        text (str): The text to split.
+
+    Returns:
+        list: The tokens, in order of appearance.
+    """
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKD', text)
+    text = text.encode('ascii', 'ignore').decode('ascii').lower()
+    return TOKEN_RE.findall(text)
+
+
+def trigrams(token):
+    """
+    Return the set of trigrams of a token padded with boundary markers.
+
+    Args:
+        token (str): A single token from `tokenize`.
+
+    Returns:
+        set: The trigrams, e.g. {'$ke', 'ken', ..., 'ya$'} for 'kenya'.
+    """
+    padded = '$' + token + '$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class UniversityIndex:
+    """
+    Inverted index with trigram fuzzy matching over university rows.
+
+    Postings map each token to the ids of the universities containing it,
+    weighted by the most important field it appears in. Fuzzy matching
+    works on the token vocabulary rather than on the rows, so a misspelt
+    query token is expanded into the few known tokens that share enough
+    trigrams with it before any posting list is read.
+
+    Attributes:
+        loaded (bool): Whether the index has been built from the database.
+        version (int): The catalog version it was built at.
+    """
+
+    def __init__(self, min_similarity=0.4, max_expansions=8):
+        self.min_similarity = min_similarity
+        self.max_expansions = max_expansions
+        self.loaded = False
+        self.version = None
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self._rows = {}
+        self._row_tokens = {}
+        self._postings = {}
+        self._grams = {}
+        self._gram_counts = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _row_weights(self, row):
+        weights = {}
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(row.get(field)):
+                if field == 'website' and token in WEBSITE_NOISE:
+                    continue
+                if weights.get(token, 0) < weight:
+                    weights[token] = weight
+        return weights
+
+    def add(self, row):
+        """
+        Add or replace a university in the index.
+
+        Args:
+            row (dict): The university as returned by `University.to_dict`.
+        """
+        with self._lock:
+            self.remove(row['id'])
+            weights = self._row_weights(row)
+            self._rows[row['id']] = row
+            self._row_tokens[row['id']] = weights
+            for token, weight in weights.items():
+                postings = self._postings.get(token)
+                if postings is None:
+                    postings = self._postings[token] = {}
+                    grams = trigrams(token)
+                    self._gram_counts[token] = len(grams)
+                    for gram in grams:
+                        self._grams.setdefault(gram, set()).add(token)
+                postings[row['id']] = weight
+
+    def remove(self, university_id):
+        """
+        Remove a university from the index if it is present.
+
+        Args:
+            university_id (str): The id of the university to remove.
+        """
+        with self._lock:
+            self._rows.pop(university_id, None)
+            for token in self._row_tokens.pop(university_id, {}):
+                postings = self._postings[token]
+                postings.pop(university_id, None)
+                if postings:
+                    continue
+                del self._postings[token]
+                del self._gram_counts[token]
+                for gram in trigrams(token):
+                    tokens = self._grams[gram]
+                    tokens.discard(token)
+                    if not tokens:
+                        del self._grams[gram]
+
+    def build(self, rows):
+        """
+        Replace the whole index with the given rows.
+
+        Args:
+            rows (iterable): Dictionaries as returned by `University.to_dict`.
+        """
+        with self._lock:
+            self._clear()
+            for row in rows:
+                self.add(row)
+            self.loaded = True
+
+    def apply(self, action, row=None, version=None):
+        """
+        Apply a catalog change notification to the index.
+
+        The index moves to the version of the change only if it was at the
+        version just before, or already there for an earlier row of the
+        same transaction; otherwise another process changed the catalog
+        in between and the next `ensure_loaded` rebuilds.
+
+        Args:
+            action (str): 'insert', 'update', 'delete' or 'reset'.
+            row (dict): The changed university.
+            version (int): The catalog version the change was committed at.
+        """
+        with self._lock:
+            if not self.loaded:
+                return
+            if action == 'reset':
+                self.loaded = False
+                return
+            if action == 'delete':
+                self.remove(row['id'])
+            else:
+                self.add(row)
+            if (version is not None and self.version is not None
+                    and self.version in (version - 1, version)):
+                self.version = version
+
+    def _expand(self, token):
+        """ Return the known tokens matching a query token, with similarity. """
+        matches = {}
+        if token in self._postings:
+            matches[token] = 1.0
+        grams = trigrams(token)
+        overlap = Counter()
+        for gram in grams:
+            overlap.update(self._grams.get(gram, ()))
+        candidates = []
+        for candidate, shared in overlap.items():
+            if candidate == token:
+                continue
+            similarity = shared / (
+                len(grams) + self._gram_counts[candidate] - shared
+                )
+            if similarity >= self.min_similarity:
+                candidates.append((similarity, candidate))
+        for similarity, candidate in heapq.nlargest(
+                self.max_expansions, candidates):
+            matches[candidate] = similarity * 0.9
+        return matches
+
+    def _term_scores(self, matches, candidates=None):
+        """ Return the best weighted score of each row for one query token. """
+        total = len(self._rows) or 1
+        scores = {}
+        for token, similarity in matches.items():
+            postings = self._postings[token]
+            idf = math.log(1 + total / len(postings))
+            if candidates is None:
+                items = postings.items()
+            else:
+                items = ((uid, postings[uid])
+                         for uid in candidates if uid in postings)
+            for uid, weight in items:
+                score = similarity * weight * idf
+                if scores.get(uid, 0) < score:
+                    scores[uid] = score
+        return scores
+
+    def search(self, query, limit=10):
+        """
+        Return the universities best matching a query.
+
+        Every query token must match, exactly or fuzzily; if no university
+        matches all of them the best partial matches are returned instead.
+
+        Args:
+            query (str): Free text such as 'univ nairobi'.
+            limit (int): The maximum number of results.
+
+        Returns:
+            list: Tuples of (score, row), best first.
+        """
+        tokens = [t for t in tokenize(query) if t not in STOPWORDS]
+        if not tokens:
+            tokens = tokenize(query)
+        with self._lock:
+            terms = [self._expand(token) for token in dict.fromkeys(tokens)]
+            terms = [t for t in terms if t]
+            if not terms:
+                return []
+            terms.sort(key=lambda m: sum(
+                len(self._postings[token]) for token in m))
+            scores = self._term_scores(terms[0])
+            for matches in terms[1:]:
+                term = self._term_scores(matches, scores)
+                scores = {uid: score + term[uid]
+                          for uid, score in scores.items() if uid in term}
+                if not scores:
+                    break
+            if not scores and len(terms) > 1:
+                for matches in terms:
+                    for uid, score in self._term_scores(matches).items():
+                        scores[uid] = scores.get(uid, 0) + score
+            best = heapq.nlargest(
+                limit, scores.items(),
+                key=lambda item: (item[1], self._rows[item[0]]['name'])
+                )
+            return [(score, self._rows[uid]) for uid, score in best]
+
+
+university_index = UniversityIndex()
+catalog.subscribe(university_index.apply)
+
+
+def ensure_loaded():
+    """
+    Build the index from the database, again whenever the catalog changed.
+
+    The catalog version is read on every call, one primary key lookup,
+    so changes committed by any process, the console or a bulk load
+    included, are searchable on the next call. Changes committed by this
+    process are applied row by row and move the index version along, so
+    only a version it did not see through `apply` causes a rebuild. Only the indexed columns
+    are selected, so no ORM objects are created. Must be called within
+    an application context.
+
+    Returns:
+        UniversityIndex: The shared index.
+    """
+    version = catalog.version()[0]
+    if university_index.loaded and university_index.version == version:
+        return university_index
+    with university_index._lock:
+        if not (university_index.loaded
+                and university_index.version == version):
+            rows = db.session.execute(db.select(
+                University.id, University.name, University.location,
+                University.website, University.status
+                ))
+            university_index.build(row._asdict() for row in rows)
+            university_index.version = version
+    return university_index
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+""" Module to serve university records from a cache of their dictionaries. """
+
+from app.cache import LRUCache
+from app.models import University, db
+
+
+class UniversityRecords:
+    """
+    Cache of `University.to_dict` results keyed by university id.
+
+    Every entry keeps the updated_at of its row, and is only served to a
+    request that read the same updated_at from the database. Edits from
+    another process, the console or a bulk load therefore make the
+    entries of the rows they change stale on the next request, without
+    any notification, while the entries of other rows, and of rows whose
+    like count changed, stay current. Misses are loaded together in a
+    single `IN` query; in process deletes also drop entries.
+
+    Attributes:
+        cache (LRUCache): (updated_at, record) tuples.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.cache = LRUCache(max_entries)
+
+    def _load(self, ids):
+        """ Return the updated_at and record of the universities found. """
+        rows = University.query.filter(University.id.in_(ids))
+        return {row.id: (row.updated_at, row.to_dict()) for row in rows}
+
+    def versions(self, ids):
+        """
+        Return the updated_at of several universities.
+
+        Reads two columns of the rows by primary key, so it is cheap
+        enough to run before every lookup.
+
+        Args:
+            ids (list): The university ids to look up.
+
+        Returns:
+            dict: The updated_at of the universities found, keyed by id.
+        """
+        return dict(db.session.execute(
+            db.select(University.id, University.updated_at)
+            .where(University.id.in_(ids))
+            ).all())
+
+    def get_many(self, ids, versions):
+        """
+        Return the records of several universities as of their updated_at.
+
+        Entries of rows whose updated_at moved are loaded again, along
+        with the misses. Must be called within an application context.
+
+        Args:
+            ids (list): The university ids to look up.
+            versions (dict): The updated_at read for this request, keyed
+                by id, as returned by `versions`; ids missing from it
+                are not found.
+
+        Returns:
+            tuple: The records of the universities found, keyed by id,
+            and whether they are those of `versions`; False when one of
+            the rows changed while they were loaded.
+        """
+        records = {}
+        missing = []
+        for university_id in ids:
+            if university_id not in versions:
+                continue
+            entry = self.cache.get(university_id)
+            if entry is not None and entry[0] == versions[university_id]:
+                records[university_id] = entry[1]
+            else:
+                missing.append(university_id)
+        if not missing:
+            return records, True
+        loaded = self._load(missing)
+        current = len(loaded) == len(missing)
+        for university_id, (updated_at, record) in loaded.items():
+            self.cache.set(university_id, (updated_at, record))
+            records[university_id] = record
+            current = current and updated_at == versions[university_id]
+        return records, current
+
+    def get(self, university_id, updated_at):
+        """
+        Return the record of one university as of its updated_at.
+
+        Args:
+            university_id (str): The id of the university.
+            updated_at (datetime): Its updated_at, read for this request.
+
+        Returns:
+            tuple: The updated_at of the row the record was built from,
+            newer than the one given if it changed meanwhile, and the
+            record; (None, None) if not found.
+        """
+        entry = self.cache.get(university_id)
+        if entry is not None and entry[0] == updated_at:
+            return updated_at, entry[1]
+        loaded = self._load([university_id]).get(university_id)
+        if loaded is None:
+            return None, None
+        self.cache.set(university_id, loaded)
+        return loaded
+
+    def apply(self, action, row=None, version=None):
+        """
+        Drop the entry of a university deleted in this process.
+
+        Updated entries are left for their updated_at to catch, so a
+        like count change keeps the record cached.
+
+        Args:
+            action (str): 'insert', 'update', 'delete' or 'reset'.
+            row (dict): The changed university.
+            version (int): The catalog version of the change, unused.
+        """
+        if action == 'reset':
+            self.cache.clear()
+        elif action == 'delete':
+            self.cache.delete(row['id'])
+
+
+def compare(records, fields=('name', 'location', 'website', 'status')):
+    """
+    Lay out university records side by side.
+
+    Args:
+        records (list): The records to compare, in display order.
+        fields (tuple): The fields to compare.
+
+    Returns:
+        dict: Maps each field to its values, aligned with `records`.
+    """
+    return {field: [record.get(field) for record in records]
+            for field in fields}
@@ -78,21 +78,56 @@ $(document).ready(function() {
     });
 
     // Adding the search button click handler
+    // The answer is streamed over Server-Sent Events and rendered
+    // token by token, falling back to a single request without EventSource.
     $('#search').click(function() {
         console.log('Search button clicked!')
         var question = $('#question').val();
         console.log('Question:', question);
-        $.ajax({
-            url: '/search',
-            data: { 'question': question },
-            type: 'GET',
-            success: function(response) {
-                if (response.success) {
-                    $('#answer').html(response.answer);
-                } else {
-                    $('#answer').html(`An error ocured while searching for the answer.${response.error}`);
+        var answer = $('#answer');
+        answer.text('');
+        if (!window.EventSource) {
+            $.ajax({
+                url: '/search',
+                data: { 'question': question },
+                type: 'GET',
+                success: function(response) {
+                    if (response.success) {
+                        answer.html(response.answer);
+                    } else {
+                        answer.html(`An error ocured while searching for the answer.${response.error}`);
+                    }
                 }
+            });
+            return;
+        }
+        var source = new EventSource('/search/stream?' + $.param({ 'question': question }));
+        source.onmessage = function(event) {
+            answer.append(document.createTextNode(JSON.parse(event.data).delta));
+        };
+        source.addEventListener('done', function(event) {
+            var sources = JSON.parse(event.data).sources || [];
+            if (sources.length) {
+                var list = $('<ul class="mt-2"></ul>');
+                $.each(sources, function(i, source) {
+                    list.append($('<li></li>').append(
+                        $('<a></a>').attr('href', '/api/universities/' + source.id).text(source.name)
+                    ));
+                });
+                answer.append(list);
             }
+            source.close();
         });
+        source.addEventListener('failed', function(event) {
+            answer.html(`An error ocured while searching for the answer.${JSON.parse(event.data).error}`);
+            source.close();
+        });
+        source.onerror = function() {
+            // Stop the browser from reconnecting and asking the question again.
+            source.close();
+            if (!answer.text()) {
+                answer.text('An error ocured while searching for the answer. Please try again.');
+            }
+        };
     });
 });
\ No newline at end of file
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+""" Module to estimate the number of model tokens in a piece of text. """
+
+import re
+
+
+PIECE_RE = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+# Tokens of framing the chat format adds to every message.
+MESSAGE_TOKENS = 4
+
+
+def count_tokens(text):
+    """
+    Estimate how many tokens the model will see for a piece of text.
+
+    Byte pair encoders use about one token per short word or symbol and
+    one more per extra four characters of a long word. The estimate is
+    close enough to budget prompts without shipping a tokenizer.
+
+    Args:
+        text (str): The text to measure.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    if not text:
+        return 0
+    return sum((len(piece) + 3) // 4 for piece in PIECE_RE.findall(text))
+
+
+def count_message_tokens(messages):
+    """
+    Estimate the prompt tokens of a list of chat messages.
+
+    Args:
+        messages (list): Dictionaries with 'role' and 'content' keys.
+
+    Returns:
+        int: The estimated number of tokens, including the few tokens of
+        framing the chat format adds to every message.
+    """
+    return sum(count_tokens(m['content']) + MESSAGE_TOKENS
+               for m in messages) + 2
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+""" Module to cache user rows between requests. """
+
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+from app.cache import LRUCache
+from app.models import User, db
+
+
+_caches = []
+
+
+class UserCache:
+    """
+    Cache of user column values keyed by user id.
+
+    Column values rather than User objects are cached, since an object
+    belongs to the session of the request that loaded it. A hit is
+    attached to the current session without a query. Entries of users
+    updated or deleted through the ORM are dropped when the change is
+    committed; the time to live bounds how long another process may
+    serve a row changed elsewhere.
+
+    Attributes:
+        cache (LRUCache): The cached column values.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60, clock=time.monotonic):
+        self.cache = LRUCache(max_entries, ttl, clock)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        Return a user attached to the current session, or None.
+
+        Must be called within an application context.
+
+        Args:
+            user_id (str): The id of the user.
+        """
+        values = self.cache.get(user_id)
+        if values is not None:
+            user = User(**values)
+            make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
+        with self._lock:
+            generation = self._generation
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        with self._lock:
+            # A change committed while loading may make this row stale.
+            if generation == self._generation:
+                self.cache.set(user_id, {
+                    column.key: getattr(user, column.key)
+                    for column in User.__mapper__.column_attrs
+                    })
+        return user
+
+    def invalidate(self, user_id):
+        """ Drop the cached row of a user. """
+        with self._lock:
+            self._generation += 1
+            self.cache.delete(user_id)
+
+    def clear(self):
+        """ Drop every cached row. """
+        with self._lock:
+            self._generation += 1
+            self.cache.clear()
+
+
+def track(cache):
+    """
+    Invalidate a cache whenever a user change is flushed and committed.
+
+    Args:
+        cache (UserCache): The cache to keep up to date.
+
+    Returns:
+        UserCache: The cache.
+    """
+    _caches.append(cache)
+    return cache
+
+
+def _record(target):
+    """ Remember a changed user on its session until commit. """
+    session = object_session(target)
+    if session is None:
+        return
+    session.info.setdefault('changed_users', set()).add(target.id)
+
+
+@event.listens_for(User, 'after_update')
+def _after_update(mapper, connection, target):
+    _record(target)
+
+
+@event.listens_for(User, 'after_delete')
+def _after_delete(mapper, connection, target):
+    _record(target)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _bulk_change(orm_execute_state):
+    # Query.update() and Query.delete() do not say which rows they change.
+    if ((orm_execute_state.is_update or orm_execute_state.is_delete)
+            and orm_execute_state.bind_mapper is User.__mapper__):
+        orm_execute_state.session.info['users_reset'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    if session.info.pop('users_reset', False):
+        for cache in _caches:
+            cache.clear()
+    for user_id in session.info.pop('changed_users', ()):
+        for cache in _caches:
+            cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('users_reset', None)
+    session.info.pop('changed_users', None)
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+"""
+ASGI entry point: /search and /search/stream run on the event loop with
+the async OpenAI client, every other route runs in threads as before.
+
+    uvicorn asgi:application --host 127.0.0.1 --port 5000
+"""
+
+from app import app, routes
+from app.asgi import SearchApp
+from app.llm_async import make_async_client, make_async_gateway
+
+
+application = SearchApp(app, make_async_gateway(
+    make_async_client(app.config), routes.llm_gateway, app.config
+    ))
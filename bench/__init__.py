@@ -0,0 +1,2 @@
+#!/usr/bin/env python3
+""" Package holding the load test and benchmark suite. """
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+""" A local stand-in for the OpenAI chat completions API. """
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Benchmarks open hundreds of connections at once.
+    request_queue_size = 1024
+
+
+class FakeOpenAIServer:
+    """
+    Serve /v1/chat/completions from a background thread.
+
+    Attributes:
+        chunks (list): The pieces of the answer, sent one per stream event.
+        latency (float): Seconds to wait before answering a request.
+        chunk_delay (float): Seconds to wait before each streamed chunk.
+        failures (list): HTTP error statuses to answer the next requests
+            with, one per request, before answering normally again.
+        record_requests (bool): Whether to keep the bodies received, which
+            long benchmark runs turn off.
+        requests (list): The JSON bodies received, in order.
+    """
+
+    def __init__(self, chunks=('Hello', ' there', '!'), chunk_delay=0.0,
+                 failures=(), latency=0.0, record_requests=True,
+                 host='127.0.0.1', port=0):
+        self.chunks = list(chunks)
+        self.record_requests = record_requests
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.failures = list(failures)
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                if server.record_requests:
+                    server.requests.append(body)
+                time.sleep(server.latency)
+                if server.failures:
+                    server.fail(self, server.failures.pop(0))
+                elif body.get('stream'):
+                    server.stream(self, body)
+                else:
+                    server.complete(self, body)
+
+        self.httpd = _HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}/v1'.format(host, port)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def fail(self, handler, status):
+        payload = json.dumps({'error': {
+            'message': 'fake failure', 'type': 'server_error',
+            'code': None}}).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def complete(self, handler, body):
+        payload = json.dumps({
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [{
+                'index': 0,
+                'finish_reason': 'stop',
+                'message': {'role': 'assistant',
+                            'content': ''.join(self.chunks)},
+            }],
+            'usage': {'prompt_tokens': 10,
+                      'completion_tokens': len(self.chunks),
+                      'total_tokens': 10 + len(self.chunks)},
+        }).encode('utf-8')
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def stream(self, handler, body):
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+        for index, piece in enumerate(self.chunks):
+            time.sleep(self.chunk_delay)
+            chunk = {
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'fake'),
+                'choices': [{
+                    'index': 0,
+                    'delta': {'content': piece},
+                    'finish_reason': None,
+                }],
+            }
+            handler.wfile.write('data: {}\n\n'.format(
+                json.dumps(chunk)).encode('utf-8'))
+            handler.wfile.flush()
+        handler.wfile.write(b'data: [DONE]\n\n')
+        handler.wfile.flush()
+        handler.close_connection = True
+
+
+def main():
+    """ Serve the stand-in until interrupted, e.g. for a live server run. """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='seconds before each answer starts')
+    parser.add_argument('--chunk-delay', type=float, default=0.02,
+                        help='seconds between streamed chunks')
+    args = parser.parse_args()
+    server = FakeOpenAIServer(
+        chunks=['Consider ', 'the ', 'University ', 'of ', 'Nairobi.'],
+        chunk_delay=args.chunk_delay, latency=args.latency,
+        record_requests=False, host=args.host, port=args.port
+        )
+    print('Serving the OpenAI stand-in at', server.base_url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Run load scenarios against the WSGI app and save the results as JSON.
+
+Each scenario sends --requests requests from --concurrency threads,
+each thread logged in as its own synthetic user, straight into the
+WSGI app (no network). Search is answered by a local OpenAI stand-in
+with a configurable latency. Unless --database is given the data lives
+in a fresh SQLite file, seeded the same way on every run.
+
+    python -m bench.run --universities 5000 --requests 500 \\
+        --concurrency 8 --baseline bench/results/previous.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUESTIONS = [
+    'Which universities in {} teach medicine?',
+    'What are affordable universities in {}?',
+    'Where can I study engineering in {}?',
+    'Which universities in {} offer scholarships?',
+    ]
+CITIES = ['Nairobi', 'Kampala', 'Kigali', 'Arusha', 'Mombasa', 'Gulu',
+          'Dodoma', 'Huye', 'Kisumu', 'Jinja']
+
+
+def scenario_login(client, rng, data):
+    from bench.seed import PASSWORD, user_email
+    return client.post('/login', data={
+        'email': user_email(rng.randrange(data['users'])),
+        'password': PASSWORD
+        })
+
+
+def scenario_listing(client, rng, data):
+    return client.get('/universities')
+
+
+def scenario_like(client, rng, data):
+    from bench.seed import university_id
+    action = rng.choice(['/like', '/dislike'])
+    return client.post(action, data={
+        'university_id': university_id(rng.randrange(data['universities']))
+        })
+
+
+def scenario_search(client, rng, data):
+    question = rng.choice(QUESTIONS).format(rng.choice(CITIES))
+    return client.get('/search', query_string={'question': question})
+
+
+def scenario_check_email(client, rng, data):
+    from bench.seed import user_email
+    return client.get('/check_email', query_string={
+        'email': user_email(rng.randrange(data['users'] * 2))
+        })
+
+
+SCENARIOS = {
+    'login': (scenario_login, {302}),
+    'listing': (scenario_listing, {200}),
+    'like': (scenario_like, {200}),
+    'search': (scenario_search, {200}),
+    'check_email': (scenario_check_email, {200}),
+    }
+
+
+def percentile(ordered, fraction):
+    """ Return the nearest rank percentile of a sorted list. """
+    if not ordered:
+        return None
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def summarize(latencies, statuses, wall):
+    """
+    Summarize one scenario run.
+
+    Args:
+        latencies (list): Seconds taken by each request.
+        statuses (Counter): Unexpected statuses and exceptions, by name.
+        wall (float): Seconds from the first request to the last.
+
+    Returns:
+        dict: Request count, errors, throughput and latency percentiles
+        in milliseconds.
+    """
+    ordered = sorted(latencies)
+    milliseconds = lambda value: None if value is None else round(
+        value * 1000, 3)
+    return {
+        'requests': len(ordered),
+        'errors': dict(statuses),
+        'throughput_rps': round(len(ordered) / wall, 2) if wall else None,
+        'latency_ms': {
+            'p50': milliseconds(percentile(ordered, 0.50)),
+            'p95': milliseconds(percentile(ordered, 0.95)),
+            'p99': milliseconds(percentile(ordered, 0.99)),
+            'mean': milliseconds(sum(ordered) / len(ordered)
+                                 if ordered else None),
+            'max': milliseconds(ordered[-1] if ordered else None),
+            },
+        }
+
+
+def run_scenario(app, name, requests, concurrency, data, seed=0):
+    """
+    Send one scenario's requests from concurrent threads.
+
+    Args:
+        app: The Flask app.
+        name (str): A key of SCENARIOS.
+        requests (int): Requests to send in total.
+        concurrency (int): Threads sending them.
+        data (dict): The seeded row counts, as returned by `seed`.
+        seed (int): Seed of the threads' random generators.
+
+    Returns:
+        dict: The summary of the run, see `summarize`.
+    """
+    send, expected = SCENARIOS[name]
+    tickets = itertools.count()
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def worker(number):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = 'bench-user-{:07d}'.format(
+                number % data['users'])
+            session['_fresh'] = True
+        rng = random.Random(seed * 1000 + number)
+        while next(tickets) < requests:
+            started = time.perf_counter()
+            try:
+                response = send(client, rng, data)
+                response.get_data()
+                response.close()
+                outcome = response.status_code
+            except Exception as error:
+                outcome = type(error).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if outcome not in expected:
+                    statuses[str(outcome)] += 1
+
+    threads = [threading.Thread(target=worker, args=(number,))
+               for number in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, statuses, time.perf_counter() - started)
+
+
+def compare(baseline, current):
+    """
+    Describe how each scenario changed against an earlier run.
+
+    Args:
+        baseline (dict): The results of the earlier run.
+        current (dict): The results of this run.
+
+    Returns:
+        list: One line of text per scenario present in both runs.
+    """
+    lines = []
+    for name, result in current['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        changes = []
+        for key in ('p50', 'p95', 'p99'):
+            old = before['latency_ms'][key]
+            new = result['latency_ms'][key]
+            if old and new is not None:
+                changes.append('{} {:.1f} -> {:.1f}ms ({:+.0%})'.format(
+                    key, old, new, new / old - 1))
+        old, new = before['throughput_rps'], result['throughput_rps']
+        if old and new is not None:
+            changes.append('{:.1f} -> {:.1f} rps ({:+.0%})'.format(
+                old, new, new / old - 1))
+        lines.append('{}: {}'.format(name, ', '.join(changes)))
+    return lines
+
+
+def git_commit():
+    """ Return the commit being benchmarked, or None outside a checkout. """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--database', help='SQLAlchemy URI to seed and use; '
+                        'default: a new SQLite file')
+    parser.add_argument('--reset', action='store_true',
+                        help='drop and recreate the tables of --database')
+    parser.add_argument('--universities', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--likes-per-user', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--openai-latency', type=float, default=0.2)
+    parser.add_argument('--chunk-delay', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='default: bench/results/'
+                        '<timestamp>.json')
+    parser.add_argument('--baseline', help='earlier results to compare with')
+    args = parser.parse_args(argv)
+    args.scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: ' + ', '.join(sorted(unknown)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from bench.fake_openai import FakeOpenAIServer
+
+    directory = None
+    if args.database is None:
+        directory = tempfile.mkdtemp(prefix='bench-')
+        args.database = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    upstream = FakeOpenAIServer(
+        chunks=['Consider ', 'the ', 'University ', 'of ', 'Nairobi.'],
+        latency=args.openai_latency, chunk_delay=args.chunk_delay,
+        record_requests=False
+        )
+    try:
+        results = run(args, upstream)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    output = args.output or os.path.join(
+        ROOT, 'bench', 'results', '{}.json'.format(
+            results['started_at'].replace(':', '')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print('Results saved to', output)
+    if args.baseline:
+        with open(args.baseline) as file:
+            for line in compare(json.load(file), results):
+                print(line)
+    return results
+
+
+def run(args, upstream):
+    """ Seed the database and run every scenario against the app. """
+    with upstream:
+        # The app reads its settings when it is imported.
+        os.environ.update({
+            'SQLALCHEMY_DATABASE_URI': args.database,
+            'OPENAI_API_KEY': 'bench',
+            'OPENAI_BASE_URL': upstream.base_url,
+            'SECRET_KEY': os.environ.get('SECRET_KEY', 'bench'),
+            'LLM_USER_RATE_PER_MINUTE': '1000000',
+            'LLM_USER_BURST': '1000000',
+            'LLM_GLOBAL_RATE_PER_MINUTE': '1000000',
+            'LLM_GLOBAL_BURST': '1000000',
+            })
+        from app import app, db
+        from app.models import University
+        from bench.seed import seed
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        with app.app_context():
+            if args.reset:
+                db.drop_all()
+            db.create_all()
+            if db.session.scalar(db.select(University.id).limit(1)):
+                sys.exit('{} already holds universities; use --reset or an '
+                         'empty database'.format(args.database))
+            started = time.perf_counter()
+            data = seed(args.universities, args.users, args.likes_per_user,
+                        args.seed)
+            seconds = time.perf_counter() - started
+            database = db.engine.url.render_as_string(hide_password=True)
+        print('Seeded {} in {:.1f}s'.format(data, seconds))
+
+        results = {
+            'started_at': datetime.datetime.now(
+                datetime.timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'config': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'baseline')},
+            'seed_seconds': round(seconds, 3),
+            'scenarios': {},
+            }
+        results['config']['database'] = database
+        for name in args.scenarios:
+            # Some routes print on every request.
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = run_scenario(app, name, args.requests,
+                                      args.concurrency, data, args.seed)
+            results['scenarios'][name] = result
+            print('{:12} {:8.1f} rps  p50 {}ms  p95 {}ms  p99 {}ms  '
+                  'errors {}'.format(
+                      name, result['throughput_rps'] or 0,
+                      result['latency_ms']['p50'],
+                      result['latency_ms']['p95'],
+                      result['latency_ms']['p99'], result['errors'] or 0))
+    return results
+
+
+if __name__ == '__main__':
+    main()
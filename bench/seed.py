@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+""" Module to seed the database with reproducible synthetic data. """
+
+import random
+from werkzeug.security import generate_password_hash
+from app import catalog
+from app.forms import COUNTRY_CHOICES
+from app.models import University, User, UserPreference, db
+
+
+PASSWORD = 'Benchmark1'
+CITIES = {
+    'KE': ['Nairobi', 'Mombasa', 'Kisumu', 'Eldoret'],
+    'TZ': ['Dar es Salaam', 'Arusha', 'Dodoma', 'Mwanza'],
+    'UG': ['Kampala', 'Gulu', 'Mbarara', 'Jinja'],
+    'RW': ['Kigali', 'Huye', 'Musanze', 'Rubavu'],
+    }
+WORDS = ['Technical', 'National', 'Catholic', 'Open', 'Christian',
+         'Agricultural', 'International', 'Polytechnic', 'Metropolitan',
+         'Pan-African', 'Science', 'Medical', 'Business', 'Teachers']
+
+
+def user_email(index):
+    """ Return the email of the index-th synthetic user. """
+    return 'bench{}@example.com'.format(index)
+
+
+def university_id(index):
+    """ Return the id of the index-th synthetic university. """
+    return 'bench-university-{:07d}'.format(index)
+
+
+def seed(universities=1000, users=100, likes_per_user=10, seed=0,
+         batch_size=1000):
+    """
+    Fill the database with synthetic universities, users and likes.
+
+    The same arguments always produce the same rows, so runs on
+    different commits compare like with like. Every user has the
+    password PASSWORD. Must be called within an application context,
+    on empty tables.
+
+    Args:
+        universities (int): Number of universities.
+        users (int): Number of users.
+        likes_per_user (int): Universities liked by each user.
+        seed (int): Seed of the random generator.
+        batch_size (int): Rows per insert statement.
+
+    Returns:
+        dict: The number of rows written per table.
+    """
+    rng = random.Random(seed)
+    countries = [code for code, _ in COUNTRY_CHOICES]
+    # Hashing is deliberately slow; one hash serves every user.
+    password_hash = generate_password_hash(PASSWORD)
+
+    likes = []
+    like_counts = [0] * universities
+    user_rows = []
+    for index in range(users):
+        user_id = 'bench-user-{:07d}'.format(index)
+        user_rows.append({
+            'id': user_id,
+            'username': 'bench{}'.format(index),
+            'email': user_email(index),
+            'password_hash': password_hash,
+            'firstname': 'Bench',
+            'lastname': 'User {}'.format(index),
+            'gender': rng.choice(['male', 'female']),
+            'location': rng.choice(countries),
+            })
+        liked = rng.sample(range(universities),
+                           min(likes_per_user, universities))
+        for university in liked:
+            like_counts[university] += 1
+            likes.append({
+                'id': 'bench-like-{:09d}'.format(len(likes)),
+                'user_id': user_id,
+                'university_id': university_id(university),
+                })
+
+    university_rows = []
+    for index in range(universities):
+        country = rng.choice(countries)
+        city = rng.choice(CITIES[country])
+        university_rows.append({
+            'id': university_id(index),
+            'name': '{} {} University {}'.format(
+                city, rng.choice(WORDS), index),
+            'location': '{}, {}'.format(city, dict(COUNTRY_CHOICES)[country]),
+            'website': 'https://u{}.example.ac'.format(index),
+            'status': rng.choice(['open', 'closed']),
+            'like_count': like_counts[index],
+            })
+
+    for model, rows in ((University, university_rows), (User, user_rows),
+                        (UserPreference, likes)):
+        for start in range(0, len(rows), batch_size):
+            db.session.execute(db.insert(model.__table__),
+                               rows[start:start + batch_size])
+            db.session.commit()
+    catalog.notify('reset')
+    return {'universities': len(university_rows), 'users': len(user_rows),
+            'preferences': len(likes)}
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Compare the threaded and the asyncio serving paths of /search over HTTP.
+
+Each path is served by uvicorn on a local port of this process: `sync`
+runs the Flask route in ASGI_THREADS threads, as a threaded WSGI server
+would, and `async` is the app of asgi.py. Both call a local OpenAI
+stand-in answering after --openai-latency seconds. An asyncio client
+keeps --concurrency requests open, each with its own question so no
+answer is cached or shared.
+
+    python -m bench.serving --concurrency 100 --requests 400 \\
+        --openai-latency 2 --threads 32
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from bench.run import ROOT, git_commit, summarize
+
+
+PATHS = ('sync', 'async')
+
+
+def serve(application):
+    """
+    Start uvicorn in a background thread.
+
+    Returns:
+        tuple: The server and its base URL.
+    """
+    import uvicorn
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(
+        application, log_level='warning', lifespan='on', backlog=4096,
+        timeout_keep_alive=30
+        ))
+    thread = threading.Thread(target=server.run,
+                              kwargs={'sockets': [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    server.thread = thread
+    return server, 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+
+
+async def load(base_url, route, requests, concurrency, name):
+    """
+    Send `requests` requests, `concurrency` at a time.
+
+    Returns:
+        dict: The summary of the run, see `bench.run.summarize`.
+    """
+    import httpx
+    tickets = iter(range(requests))
+    latencies = []
+    statuses = Counter()
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits,
+                                 timeout=None) as client:
+
+        async def worker():
+            for number in tickets:
+                started = time.perf_counter()
+                try:
+                    response = await client.get(route, params={
+                        'question': '{} question {}'.format(name, number)})
+                    outcome = response.status_code
+                except Exception as error:
+                    outcome = type(error).__name__
+                latencies.append(time.perf_counter() - started)
+                if outcome != 200:
+                    statuses[str(outcome)] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        wall = time.perf_counter() - started
+    return summarize(latencies, statuses, wall)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per path')
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help='requests open at once')
+    parser.add_argument('--threads', type=int, default=32,
+                        help='threads of the Flask app, on both paths')
+    parser.add_argument('--openai-latency', type=float, default=1.0)
+    parser.add_argument('--route', default='/search',
+                        choices=['/search', '/search/stream'])
+    parser.add_argument('--paths', default=','.join(PATHS))
+    parser.add_argument('--universities', type=int, default=200)
+    parser.add_argument('--output', help='default: bench/results/'
+                        'serving-<timestamp>.json')
+    args = parser.parse_args(argv)
+    args.paths = [name for name in args.paths.split(',') if name]
+    unknown = set(args.paths) - set(PATHS)
+    if unknown:
+        parser.error('unknown paths: ' + ', '.join(sorted(unknown)))
+    return args
+
+
+def run(args, upstream, database):
+    """ Seed the database and load each serving path in turn. """
+    with upstream:
+        # The app reads its settings when it is imported. The threaded
+        # executor may use every thread and queue every request, so
+        # the two paths differ only in how they wait on the model.
+        os.environ.update({
+            'SQLALCHEMY_DATABASE_URI': database,
+            'OPENAI_API_KEY': 'bench',
+            'OPENAI_BASE_URL': upstream.base_url,
+            'SECRET_KEY': os.environ.get('SECRET_KEY', 'bench'),
+            'SEARCH_CACHE_BACKEND': 'memory',
+            'ASGI_THREADS': str(args.threads),
+            'LLM_MAX_IN_FLIGHT': str(args.threads),
+            'LLM_MAX_QUEUED': str(args.requests),
+            'LLM_QUEUE_TIMEOUT': '600',
+            'LLM_WAIT_TIMEOUT': '600',
+            'LLM_ASYNC_MAX_IN_FLIGHT': str(args.concurrency),
+            'LLM_ASYNC_MAX_QUEUED': str(args.requests),
+            'LLM_ASYNC_MAX_CONNECTIONS': str(args.concurrency),
+            'LLM_USER_RATE_PER_MINUTE': '1000000',
+            'LLM_USER_BURST': '1000000',
+            'LLM_GLOBAL_RATE_PER_MINUTE': '1000000',
+            'LLM_GLOBAL_BURST': '1000000',
+            })
+        from app import app, db, routes
+        from app.asgi import SearchApp, WSGIBridge
+        from app.llm_async import make_async_client, make_async_gateway
+        from bench.seed import seed
+
+        with app.app_context():
+            db.create_all()
+            seed(args.universities, users=1, likes_per_user=0)
+
+        results = {
+            'started_at': datetime.datetime.now(
+                datetime.timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'cpus': os.cpu_count(),
+            'config': {key: value for key, value in vars(args).items()
+                       if key != 'output'},
+            'paths': {},
+            }
+        for name in args.paths:
+            bridge = WSGIBridge(app, args.threads)
+            if name == 'sync':
+                application = bridge
+            else:
+                application = SearchApp(app, make_async_gateway(
+                    make_async_client(app.config), routes.llm_gateway,
+                    app.config), bridge)
+            server, base_url = serve(application)
+            try:
+                result = asyncio.run(load(base_url, args.route,
+                                          args.requests, args.concurrency,
+                                          name))
+            finally:
+                server.should_exit = True
+                server.thread.join()
+                bridge.threads.shutdown()
+            results['paths'][name] = result
+            print('{:6} {:8.1f} rps  p50 {}ms  p95 {}ms  p99 {}ms  '
+                  'errors {}'.format(
+                      name, result['throughput_rps'] or 0,
+                      result['latency_ms']['p50'],
+                      result['latency_ms']['p95'],
+                      result['latency_ms']['p99'],
+                      result['errors'] or 0))
+        return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from bench.fake_openai import FakeOpenAIServer
+
+    directory = tempfile.mkdtemp(prefix='bench-')
+    upstream = FakeOpenAIServer(
+        chunks=['Consider ', 'the ', 'University ', 'of ', 'Nairobi.'],
+        latency=args.openai_latency, record_requests=False
+        )
+    try:
+        results = run(args, upstream, 'sqlite:///' + os.path.join(
+            directory, 'bench.db'))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    output = args.output or os.path.join(
+        ROOT, 'bench', 'results', 'serving-{}.json'.format(
+            results['started_at'].replace(':', '')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print('Results saved to', output)
+    return results
+
+
+if __name__ == '__main__':
+    main()
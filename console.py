@@ -2,9 +2,16 @@
 # This file universityConsole, which is a command-line console for managing universities.
 
 import cmd
+import gzip
+import shlex
+import time
 from app import db
 from app import app
+from app.bulk import BulkLoader
+from app.export import EXPORTS, iter_rows, ndjson
+from app.llm_accounting import report
 from app.models import University
+from app.outbox import outbox
 
 class UniversityConsole(cmd.Cmd):
     """
@@ -128,6 +135,134 @@ class UniversityConsole(cmd.Cmd):
                     university.status
                     ))
 
+    def do_import(self, line):
+        """
+        Method for adding universities in bulk from a file.
+
+        Arguments:
+        line -- the path of a CSV (with a name,location,website,status
+        header) or JSON lines file, optionally followed by a batch size
+        e.g. import universities.csv 2000
+        """
+
+        self._bulk_load(line, upsert=False)
+
+    def do_upsert(self, line):
+        """
+        Method for adding or updating universities in bulk from a file.
+        Universities are matched by name; existing ones get the location,
+        website and status of the file.
+
+        Arguments:
+        line -- the path of a CSV or JSON lines file, optionally followed
+        by a batch size
+        e.g. upsert universities.jsonl
+        """
+
+        self._bulk_load(line, upsert=True)
+
+    def _bulk_load(self, line, upsert):
+        """
+        Method running a bulk load and reporting its progress.
+        """
+
+        args = shlex.split(line)
+        if len(args) not in (1, 2) or (len(args) == 2 and not args[1].isdigit()):
+            print('Invalid input. Expected format: <file> [batch_size]')
+            return
+        batch_size = int(args[1]) if len(args) == 2 else app.config['IMPORT_BATCH_SIZE']
+        loader = BulkLoader(
+            upsert=upsert,
+            batch_size=max(batch_size, 1),
+            progress=lambda stats: print(
+                '{read} rows read, {rows_per_second} rows/s'.format(**stats)
+                )
+            )
+        try:
+            with app.app_context():
+                stats = loader.load(args[0])
+        except OSError as error:
+            print(f'Could not read {args[0]}: {error}')
+            return
+        print('Inserted {inserted}, updated {updated}, rejected {rejected} '
+              'of {read} rows in {seconds}s ({rows_per_second} rows/s)'.format(**stats))
+        if stats['rejects_path']:
+            print(f'Rejected rows written to {stats["rejects_path"]}')
+
+    def do_export(self, line):
+        """
+        Method for exporting universities or preferences as JSON lines.
+        Files ending in .gz are gzip compressed.
+
+        Arguments:
+        line -- the table (universities or preferences) and the path of
+        the file to write
+        e.g. export preferences preferences.ndjson.gz
+        """
+
+        args = shlex.split(line)
+        if len(args) != 2 or args[0] not in EXPORTS:
+            print('Invalid input. Expected format: universities|preferences <file>')
+            return
+        name, path = args
+        opener = gzip.open if path.endswith('.gz') else open
+        started = time.monotonic()
+        rows = 0
+        with app.app_context(), opener(path, 'wt', encoding='utf-8') as file:
+            for chunk in ndjson(iter_rows(name, app.config['EXPORT_BATCH_SIZE'])):
+                file.write(chunk)
+                rows += chunk.count('\n')
+        elapsed = max(time.monotonic() - started, 1e-9)
+        print(f'Exported {rows} {name} to {path} ({rows / elapsed:.1f} rows/s)')
+
+    def do_llm_report(self, line):
+        """
+        Method for reporting the tokens, cost and latency of language
+        model calls per day and model, and the costliest questions.
+
+        Arguments:
+        line -- the number of days to cover, today included (default 7)
+        e.g. llm_report 30
+        """
+
+        line = line.strip()
+        if line and not line.isdigit():
+            print('Invalid input. Expected format: llm_report [days]')
+            return
+        with app.app_context():
+            result = report(int(line or 7),
+                            sample=app.config['LLM_REPORT_SAMPLE'])
+        print('{:10}  {:20} {:>7} {:>6} {:>10} {:>10} {:>9} {:>8} {:>8} {:>8}'.format(
+            'day', 'model', 'calls', 'hits', 'prompt', 'output', 'cost',
+            'p50 ms', 'p95 ms', 'ttft p50'))
+        for row in result['days']:
+            print('{:10}  {:20} {:>7} {:>6} {:>10} {:>10} {:>9.4f} {:>8} {:>8} {:>8}'.format(
+                row['day'], row['model'][:20], row['calls'],
+                row['cache_hits'], row['prompt_tokens'],
+                row['completion_tokens'], row['cost'],
+                str(row['latency_ms']['p50']), str(row['latency_ms']['p95']),
+                str(row['first_token_ms']['p50'])))
+        print('Costliest questions:')
+        for row in result['costliest_questions']:
+            print(f'{row["cost"]:9.4f}  {row["calls"]:5} calls  {row["question"]}')
+
+    def do_outbox_drain(self, line):
+        """
+        Method for sending every due email of the outbox now, e.g. from
+        cron where no web worker runs the sender.
+
+        Arguments:
+        line -- ignored
+        e.g. outbox_drain
+        """
+
+        with app.app_context():
+            count = outbox.drain()
+        outbox.close()
+        stats = outbox.stats()
+        print('Attempted {} emails: {} sent, {} to retry, {} dead'.format(
+            count, stats['sent'], stats['retried'], stats['dead']))
+
     def do_quit(self, line):
         """
         Method for quitting the console
@@ -144,6 +279,11 @@ class UniversityConsole(cmd.Cmd):
         print("Available commands:")
         print("  add <name> <location> <website> <status> - Add a new university to the database")
         print("  list - List all universities in the database")
+        print("  import <file> [batch_size] - Add universities from a CSV or JSON lines file")
+        print("  upsert <file> [batch_size] - Add or update universities from a file, by name")
+        print("  export universities|preferences <file> - Write a table as JSON lines, gzipped for .gz files")
+        print("  llm_report [days] - Report model tokens, cost and latency per day and model")
+        print("  outbox_drain - Send every due email of the outbox now")
         print("  quit - Quit the console")
 
     def help_add(self):
@@ -0,0 +1,51 @@
+"""Unique user preference per university and denormalized like counts
+
+Revision ID: 5b1e7d2c9a40
+Revises: 0c56f7a55126
+Create Date: 2026-10-18 09:12:41.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1e7d2c9a40'
+down_revision = '0c56f7a55126'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('university', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('like_count', sa.Integer(),
+                                      server_default='0', nullable=False))
+        batch_op.create_index(batch_op.f('ix_university_like_count'),
+                              ['like_count'], unique=False)
+
+    # Keep one row per (user, university) before enforcing uniqueness.
+    op.execute(
+        'DELETE FROM user_preference WHERE id NOT IN ('
+        'SELECT keep_id FROM (SELECT MIN(id) AS keep_id '
+        'FROM user_preference GROUP BY user_id, university_id) AS keep)'
+    )
+    op.execute(
+        'UPDATE university SET like_count = ('
+        'SELECT COUNT(*) FROM user_preference '
+        'WHERE user_preference.university_id = university.id)'
+    )
+
+    with op.batch_alter_table('user_preference', schema=None) as batch_op:
+        batch_op.create_unique_constraint(
+            'uq_user_preference_user_university',
+            ['user_id', 'university_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('user_preference', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_user_preference_user_university',
+                                 type_='unique')
+
+    with op.batch_alter_table('university', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_university_like_count'))
+        batch_op.drop_column('like_count')
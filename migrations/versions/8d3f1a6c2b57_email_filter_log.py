@@ -0,0 +1,35 @@
+"""Log of registered emails for the Bloom filters of the workers
+
+Revision ID: 8d3f1a6c2b57
+Revises: 5b1e7d2c9a40
+Create Date: 2026-10-18 19:31:08.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d3f1a6c2b57'
+down_revision = '5b1e7d2c9a40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('email_filter_log',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('email', sa.String(length=60), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('email_filter_log', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_email_filter_log_created_at'),
+                              ['created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('email_filter_log', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_email_filter_log_created_at'))
+
+    op.drop_table('email_filter_log')
@@ -0,0 +1,36 @@
+"""Last hit of each cached answer, to evict the least recently used
+
+Revision ID: a3d7f1c9e546
+Revises: f4b8d2a6c917
+Create Date: 2026-10-20 10:27:31.604218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d7f1c9e546'
+down_revision = 'f4b8d2a6c917'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('llm_cache', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_used_at', sa.DateTime(),
+                                      nullable=True))
+
+    op.execute('UPDATE llm_cache SET last_used_at = CURRENT_TIMESTAMP')
+
+    with op.batch_alter_table('llm_cache', schema=None) as batch_op:
+        batch_op.alter_column('last_used_at', existing_type=sa.DateTime(),
+                              nullable=False)
+        batch_op.create_index(batch_op.f('ix_llm_cache_last_used_at'),
+                              ['last_used_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('llm_cache', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_llm_cache_last_used_at'))
+        batch_op.drop_column('last_used_at')
@@ -0,0 +1,31 @@
+"""Catalog version, bumped by every change to a university
+
+Revision ID: c4e2a9d7f013
+Revises: 8d3f1a6c2b57
+Create Date: 2026-10-18 20:02:51.730448
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e2a9d7f013'
+down_revision = '8d3f1a6c2b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    catalog_version = op.create_table('catalog_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute(catalog_version.insert().values(
+        id=1, version=0, updated_at=sa.func.current_timestamp()))
+
+
+def downgrade():
+    op.drop_table('catalog_version')
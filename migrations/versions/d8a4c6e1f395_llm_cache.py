@@ -0,0 +1,35 @@
+"""Cache of model answers shared by every backend
+
+Revision ID: d8a4c6e1f395
+Revises: b5d9e3f7a262
+Create Date: 2026-10-19 09:12:40.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8a4c6e1f395'
+down_revision = 'b5d9e3f7a262'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('llm_cache',
+    sa.Column('key', sa.String(length=64), nullable=False),
+    sa.Column('value', sa.Text(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    with op.batch_alter_table('llm_cache', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_llm_cache_expires_at'),
+                              ['expires_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('llm_cache', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_llm_cache_expires_at'))
+
+    op.drop_table('llm_cache')
@@ -0,0 +1,29 @@
+"""Likes version, bumped by every like and unlike
+
+Revision ID: e2a7c9d4b813
+Revises: d8a4c6e1f395
+Create Date: 2026-10-19 14:36:08.271905
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7c9d4b813'
+down_revision = 'd8a4c6e1f395'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    preference_version = op.create_table('preference_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute(preference_version.insert().values(id=1, version=0))
+
+
+def downgrade():
+    op.drop_table('preference_version')
@@ -0,0 +1,35 @@
+"""Last content change of each university
+
+Revision ID: e7b3c1f5a829
+Revises: c4e2a9d7f013
+Create Date: 2026-10-18 21:14:07.362915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b3c1f5a829'
+down_revision = 'c4e2a9d7f013'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    column_type = sa.DateTime().with_variant(mysql.DATETIME(fsp=6), 'mysql')
+    with op.batch_alter_table('university', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', column_type,
+                                      nullable=True))
+
+    op.execute('UPDATE university SET updated_at = CURRENT_TIMESTAMP')
+
+    with op.batch_alter_table('university', schema=None) as batch_op:
+        batch_op.alter_column('updated_at', existing_type=column_type,
+                              nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('university', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,45 @@
+"""Accounting of language model calls
+
+Revision ID: f1c6b8a2d437
+Revises: a3f8d2e6b194
+Create Date: 2026-10-18 22:48:12.903517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c6b8a2d437'
+down_revision = 'a3f8d2e6b194'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('llm_call',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('endpoint', sa.String(length=32), nullable=False),
+    sa.Column('model', sa.String(length=64), nullable=False),
+    sa.Column('user', sa.String(length=64), nullable=True),
+    sa.Column('question', sa.String(length=255), nullable=True),
+    sa.Column('cache', sa.String(length=10), nullable=False),
+    sa.Column('status', sa.String(length=10), nullable=False),
+    sa.Column('prompt_tokens', sa.Integer(), nullable=False),
+    sa.Column('completion_tokens', sa.Integer(), nullable=False),
+    sa.Column('cost', sa.Float(), nullable=False),
+    sa.Column('latency_ms', sa.Float(), nullable=False),
+    sa.Column('first_token_ms', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('llm_call', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_llm_call_created_at'),
+                              ['created_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('llm_call', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_llm_call_created_at'))
+
+    op.drop_table('llm_call')
@@ -0,0 +1,36 @@
+"""Rate limit buckets shared by every backend
+
+Revision ID: f4b8d2a6c917
+Revises: e2a7c9d4b813
+Create Date: 2026-10-19 16:05:52.903417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4b8d2a6c917'
+down_revision = 'e2a7c9d4b813'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('llm_bucket',
+    sa.Column('key', sa.String(length=100), nullable=False),
+    sa.Column('tokens', sa.Float(), nullable=False),
+    sa.Column('updated', sa.Float(), nullable=False),
+    sa.Column('full_at', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    with op.batch_alter_table('llm_bucket', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_llm_bucket_full_at'),
+                              ['full_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('llm_bucket', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_llm_bucket_full_at'))
+
+    op.drop_table('llm_bucket')
@@ -0,0 +1,279 @@
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+from app import app, db, routes
+from app.asgi import SearchApp
+from app.llm_async import AsyncLLMExecutor, make_async_gateway
+from app.llm_cache import MemoryBackend, ResponseCache
+from app.llm_executor import LLMExecutor, LLMOverloaded
+from app.llm_gateway import make_gateway
+from app.models import University
+from bench.fake_openai import FakeOpenAIServer
+from test_search_stream import parse_events
+
+
+class AsyncLLMExecutorTestCase(unittest.TestCase):
+    def test_identical_calls_are_merged(self):
+        executor = AsyncLLMExecutor()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'answer'
+
+        async def main():
+            return await asyncio.gather(*[
+                executor.run('key', call) for _ in range(5)])
+
+        self.assertEqual(asyncio.run(main()), ['answer'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(executor.stats(), {
+            'in_flight': 0, 'queued': 0, 'coalesced': 4, 'rejected': 0})
+
+    def test_full_queue_is_rejected(self):
+        executor = AsyncLLMExecutor(max_in_flight=1, max_queued=1,
+                                    queue_timeout=0.05)
+
+        async def main():
+            permit = await executor.acquire()
+            queued = asyncio.ensure_future(executor.acquire())
+            await asyncio.sleep(0)
+            with self.assertRaises(LLMOverloaded):
+                await executor.acquire()
+            with self.assertRaises(LLMOverloaded):
+                await queued
+            permit.release()
+            (await executor.acquire()).release()
+
+        asyncio.run(main())
+        self.assertEqual(executor.stats()['rejected'], 2)
+        self.assertEqual(executor.stats()['in_flight'], 0)
+
+    def test_call_is_cancelled_when_nobody_waits(self):
+        executor = AsyncLLMExecutor()
+        cancelled = []
+
+        async def call():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+
+        async def main():
+            waiters = [asyncio.ensure_future(executor.run('key', call))
+                       for _ in range(2)]
+            await asyncio.sleep(0.01)
+            waiters[0].cancel()
+            await asyncio.sleep(0.01)
+            self.assertEqual(cancelled, [])
+            waiters[1].cancel()
+            await asyncio.gather(*waiters, return_exceptions=True)
+            await asyncio.sleep(0.01)
+
+        asyncio.run(main())
+        self.assertEqual(cancelled, [1])
+        self.assertEqual(executor.stats()['in_flight'], 0)
+
+
+class SearchAppTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        self.server = FakeOpenAIServer(
+            chunks=['Try', ' Makerere', '.'], chunk_delay=0.05, latency=0.1)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        patcher = mock.patch.object(
+            routes, 'search_cache', ResponseCache(MemoryBackend(10, 60)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def application(self, **config):
+        gateway = make_gateway(
+            OpenAI(api_key='test', base_url=self.server.base_url),
+            LLMExecutor(), app)
+        with mock.patch.dict(app.config, config):
+            application = SearchApp(app, make_async_gateway(
+                AsyncOpenAI(api_key='test', base_url=self.server.base_url),
+                gateway, app.config))
+        self.addCleanup(application.wsgi.threads.shutdown)
+        return application
+
+    def run_client(self, application, requests):
+        async def main():
+            transport = httpx.ASGITransport(application,
+                                            client=('10.0.0.1', 1234))
+            async with httpx.AsyncClient(transport=transport,
+                                         base_url='http://test') as client:
+                try:
+                    return await requests(client)
+                finally:
+                    await application.gateway.client.close()
+        return asyncio.run(main())
+
+    def test_search(self):
+        async def requests(client):
+            first = await client.get('/search', params={'question': 'uganda'})
+            second = await client.get('/search',
+                                      params={'question': 'Uganda?'})
+            return first, second
+
+        first, second = self.run_client(self.application(), requests)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json(), {'success': True,
+                                        'answer': 'Try Makerere.',
+                                        'sources': [], 'cached': False})
+        self.assertTrue(second.json()['cached'])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_concurrent_questions_share_one_call(self):
+        application = self.application()
+
+        async def requests(client):
+            return await asyncio.gather(*[
+                client.get('/search', params={'question': 'kenya'})
+                for _ in range(5)])
+
+        responses = self.run_client(application, requests)
+        self.assertEqual({response.json()['answer']
+                          for response in responses}, {'Try Makerere.'})
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(application.gateway.executor.coalesced, 4)
+
+    def test_overloaded(self):
+        application = self.application(LLM_ASYNC_MAX_IN_FLIGHT=1,
+                                       LLM_ASYNC_MAX_QUEUED=0)
+
+        async def requests(client):
+            return await asyncio.gather(*[
+                client.get('/search', params={'question': question})
+                for question in ('kenya', 'rwanda')])
+
+        statuses = sorted((response.status_code,
+                           response.headers.get('Retry-After'))
+                          for response in self.run_client(application,
+                                                          requests))
+        self.assertEqual(statuses, [(200, None), (503, '5')])
+
+    def test_stream(self):
+        async def requests(client):
+            return await client.get('/search/stream',
+                                    params={'question': 'uganda'})
+
+        application = self.application()
+        response = self.run_client(application, requests)
+        self.assertEqual(response.headers['Content-Type'],
+                         'text/event-stream; charset=utf-8')
+        self.assertEqual(parse_events(response.text), [
+            ('message', {'delta': 'Try'}),
+            ('message', {'delta': ' Makerere'}),
+            ('message', {'delta': '.'}),
+            ('done', {'cached': False, 'sources': []}),
+        ])
+        self.assertTrue(self.server.requests[0]['stream'])
+        self.assertEqual(application.gateway.executor.in_flight, 0)
+
+    def test_caller_is_the_address_added_by_nginx(self):
+        application = self.application()
+        application.gateway.complete = mock.AsyncMock(
+            side_effect=LLMOverloaded('Too busy'))
+
+        async def requests(client):
+            return await client.get(
+                '/search', params={'question': 'uganda'},
+                headers={'X-Forwarded-For': '198.51.100.7, 203.0.113.5'})
+
+        self.run_client(application, requests)
+        self.assertEqual(application.gateway.complete.call_args.kwargs['user'],
+                         '203.0.113.5')
+
+    def test_refused_stream_is_a_failed_event(self):
+        application = self.application()
+        application.gateway.stream = mock.AsyncMock(
+            side_effect=LLMOverloaded('Too busy', 5))
+
+        async def requests(client):
+            return await client.get('/search/stream',
+                                    params={'question': 'uganda'})
+
+        response = self.run_client(application, requests)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(parse_events(response.text), [
+            ('failed', {'error': 'Too busy', 'status': 503,
+                        'retry_after': 5}),
+        ])
+
+    def test_disconnect_stops_stream(self):
+        application = self.application()
+        sent = []
+
+        async def main():
+            first_event = asyncio.Event()
+            messages = [{'type': 'http.request', 'body': b''}]
+
+            async def receive():
+                if messages:
+                    return messages.pop()
+                await first_event.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if message.get('body'):
+                    first_event.set()
+
+            scope = {'type': 'http', 'method': 'GET',
+                     'path': '/search/stream', 'root_path': '',
+                     'query_string': b'question=uganda', 'headers': [],
+                     'client': ('10.0.0.1', 1234)}
+            try:
+                await application(scope, receive, send)
+            finally:
+                await application.gateway.client.close()
+
+        asyncio.run(main())
+        bodies = [message['body'] for message in sent[1:]]
+        self.assertEqual(len(bodies), 1)
+        self.assertIn(b'Try', bodies[0])
+        self.assertEqual(application.gateway.executor.in_flight, 0)
+        self.assertIsNone(routes.search_cache.get(
+            'uganda', routes.search_prompt('uganda')[0],
+            app.config['SEARCH_MODEL']))
+
+    def test_other_routes_run_in_flask(self):
+        async def requests(client):
+            created = await client.post('/api/universities', json={
+                'name': 'Makerere University', 'location': 'Kampala'})
+            listed = await client.get('/api/universities')
+            metrics = await client.get('/metrics')
+            return created, listed, metrics
+
+        created, listed, metrics = self.run_client(self.application(),
+                                                   requests)
+        self.assertEqual(created.status_code, 201)
+        self.assertEqual(
+            [university['name']
+             for university in listed.json()['universities']],
+            ['Makerere University'])
+        self.assertIn('ETag', listed.headers)
+        self.assertEqual(University.query.count(), 1)
+        self.assertIn('http_requests_in_flight{endpoint="universities"} 0.0',
+                      metrics.text)
+
+
+if __name__ == '__main__':
+    unittest.main()
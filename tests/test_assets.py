@@ -0,0 +1,180 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import Flask, render_template_string
+from app import app
+from app.assets import StaticAssets, build, minify_css, minify_js
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STYLE = """
+/* The page */
+body  >  .card ,  .panel {
+    background: url("../img/logo.png") no-repeat;
+    width: calc(100% - 2px);
+}
+a :hover { content: "keep ;}  /* this */"; }
+""" + '.filler { margin: 0; }\n' * 40
+
+SCRIPT = """
+// Handlers
+var url = "http://example.com/a"; // trailing
+var pattern = /\\/\\//g;
+var half = total / 2 / 1;
+/* block */
+$('a').click(function() {
+    return `done: ${url}`;
+});
+""" + 'console.log(half);\n' * 40
+
+
+class MinifyTestCase(unittest.TestCase):
+    def test_css(self):
+        self.assertEqual(
+            minify_css(STYLE.split('.filler')[0]),
+            'body>.card,.panel{background:url("../img/logo.png") no-repeat;'
+            'width:calc(100% - 2px)}'
+            'a :hover{content:"keep ;}  /* this */"}')
+
+    def test_js(self):
+        lines = minify_js(SCRIPT).split('\n')
+        self.assertEqual(lines[:6], [
+            'var url = "http://example.com/a";',
+            'var pattern = /\\/\\//g;',
+            'var half = total / 2 / 1;',
+            "$('a').click(function() {",
+            'return `done: ${url}`;',
+            '});',
+            ])
+
+
+class StaticFolderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        for path, content in (('css/site.css', STYLE),
+                              ('js/site.js', SCRIPT),
+                              ('img/logo.png', '\x89PNG not really')):
+            os.makedirs(os.path.join(self.folder, os.path.dirname(path)),
+                        exist_ok=True)
+            with open(os.path.join(self.folder, path), 'w') as file:
+                file.write(content)
+
+    def read(self, path, mode='rb'):
+        with open(os.path.join(self.folder, path), mode) as file:
+            return file.read()
+
+
+class BuildTestCase(StaticFolderTestCase):
+    def test_manifest_and_variants(self):
+        manifest = build(self.folder)
+        self.assertEqual(sorted(manifest), ['css/site.css', 'img/logo.png',
+                                            'js/site.js'])
+        self.assertRegex(manifest['css/site.css'],
+                         r'^dist/css/site\.[0-9a-f]{12}\.css$')
+        self.assertEqual(json.loads(self.read('dist/manifest.json', 'r')),
+                         manifest)
+        css = self.read(manifest['css/site.css'])
+        self.assertEqual(gzip.decompress(
+            self.read(manifest['css/site.css'] + '.gz')), css)
+        if brotli is not None:
+            self.assertEqual(brotli.decompress(
+                self.read(manifest['css/site.css'] + '.br')), css)
+        # Images are not compressed, and stylesheets point at their copy.
+        self.assertFalse(os.path.exists(os.path.join(
+            self.folder, manifest['img/logo.png'] + '.gz')))
+        self.assertIn('url("../img/{}")'.format(
+            os.path.basename(manifest['img/logo.png'])), css.decode())
+
+    def test_rebuild_replaces_previous_build(self):
+        first = build(self.folder)
+        with open(os.path.join(self.folder, 'js/site.js'), 'a') as file:
+            file.write('var more = 1;\n')
+        second = build(self.folder)
+        self.assertNotEqual(first['js/site.js'], second['js/site.js'])
+        self.assertEqual(first['css/site.css'], second['css/site.css'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.folder, first['js/site.js'])))
+        self.assertNotIn('dist/', ''.join(second))
+
+
+class StaticAssetsTestCase(StaticFolderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = Flask(__name__, static_folder=self.folder,
+                         static_url_path='/static')
+        self.app.config.update(ASSETS_PREFIX='dist', ASSETS_MAX_AGE=3600)
+        self.assets = StaticAssets(self.app)
+        self.client = self.app.test_client()
+
+    def built_url(self, filename):
+        with self.app.test_request_context():
+            return render_template_string(
+                '{{ asset_url(filename) }}', filename=filename)
+
+    def test_without_build_uses_original_files(self):
+        self.assertEqual(self.built_url('js/site.js'), '/static/js/site.js')
+        response = self.client.get('/static/js/site.js')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response.headers['Cache-Control'])
+
+    def test_serves_precompressed_variants(self):
+        manifest = build(self.folder)
+        self.assets.load()
+        url = self.built_url('css/site.css')
+        self.assertEqual(url, '/static/' + manifest['css/site.css'])
+        css = self.read(manifest['css/site.css'])
+
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertEqual(gzip.decompress(response.get_data()), css)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        cache_control = response.headers['Cache-Control']
+        self.assertIn('immutable', cache_control)
+        self.assertIn('max-age=3600', cache_control)
+        etag = response.headers['ETag']
+        response.close()
+
+        revalidated = self.client.get(url, headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(revalidated.status_code, 304)
+
+        plain = self.client.get(url)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.get_data(), css)
+        self.assertNotEqual(plain.headers['ETag'], etag)
+
+        if brotli is not None:
+            response = self.client.get(
+                url, headers={'Accept-Encoding': 'gzip, br'})
+            self.assertEqual(response.headers['Content-Encoding'], 'br')
+            self.assertEqual(brotli.decompress(response.get_data()), css)
+
+    def test_missing_fingerprinted_file(self):
+        build(self.folder)
+        self.assertEqual(
+            self.client.get('/static/dist/css/gone.0123456789ab.css',
+                            headers={'Accept-Encoding': 'gzip'}).status_code,
+            404)
+
+    def test_app_templates_use_helper(self):
+        self.assertIn('asset_url', app.jinja_env.globals)
+        response = app.test_client().get('/static/css/style.css')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
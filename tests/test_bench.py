@@ -0,0 +1,75 @@
+import os
+import random
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from app import app, db
+from app.models import University, UserPreference
+from bench.run import (compare, percentile, run_scenario,
+                       scenario_search, summarize)
+from bench.seed import seed
+
+
+class BenchTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(app.config, {'SECRET_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+
+    def test_seed_is_reproducible(self):
+        data = seed(universities=30, users=5, likes_per_user=4, seed=3)
+        self.assertEqual(data, {'universities': 30, 'users': 5,
+                                'preferences': 20})
+        names = list(db.session.scalars(
+            db.select(University.name).order_by(University.id)))
+        likes = db.session.scalar(db.select(db.func.sum(
+            University.like_count)))
+        self.assertEqual(likes, UserPreference.query.count())
+        db.drop_all()
+        db.create_all()
+        seed(universities=30, users=5, likes_per_user=4, seed=3)
+        self.assertEqual(names, list(db.session.scalars(
+            db.select(University.name).order_by(University.id))))
+
+    def test_run_scenario(self):
+        data = seed(universities=20, users=3, likes_per_user=2)
+        result = run_scenario(app, 'check_email', 12, 1, data)
+        self.assertEqual(result['requests'], 12)
+        self.assertEqual(result['errors'], {})
+        self.assertLessEqual(result['latency_ms']['p50'],
+                             result['latency_ms']['p99'])
+        result = run_scenario(app, 'like', 6, 1, data)
+        self.assertEqual(result['errors'], {})
+
+    def test_search_asks_a_question(self):
+        client = mock.Mock()
+        scenario_search(client, random.Random(1), {})
+        path, = client.get.call_args.args
+        self.assertEqual(path, '/search')
+        self.assertEqual(list(client.get.call_args.kwargs['query_string']),
+                         ['question'])
+
+    def test_percentiles_and_compare(self):
+        ordered = [i / 1000 for i in range(1, 101)]
+        self.assertEqual(percentile(ordered, 0.5), 0.05)
+        self.assertEqual(percentile(ordered, 0.99), 0.099)
+        self.assertIsNone(percentile([], 0.5))
+        before = {'scenarios': {'listing': summarize(ordered, {}, 1.0)}}
+        after = {'scenarios': {'listing': summarize(
+            [value / 2 for value in ordered], {}, 0.5)}}
+        [line] = compare(before, after)
+        self.assertIn('p50 50.0 -> 25.0ms (-50%)', line)
+        self.assertIn('100.0 -> 200.0 rps (+100%)', line)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from app import app, db
+from app.bulk import BulkLoader
+from app.models import University
+from app.search_index import ensure_loaded, university_index
+from console import UniversityConsole
+
+
+CSV = '''name,location,website,status
+University of Nairobi,"Nairobi, Kenya",uonbi.ac.ke,open
+Makerere University,"Kampala, Uganda",mak.ac.ug,
+,"Kigali, Rwanda",missing.example.com,open
+University of Nairobi,"Nairobi, Kenya",again.example.com,open
+Strathmore University,"Nairobi, Kenya",,open
+'''
+
+
+class BulkImportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as file:
+            file.write(content)
+        return path
+
+    def rejects(self, path):
+        with open(path) as file:
+            return [json.loads(line) for line in file]
+
+    def test_import_csv_in_batches(self):
+        path = self.write('universities.csv', CSV)
+        progress = []
+        stats = BulkLoader(batch_size=2, progress=progress.append).load(path)
+        self.assertEqual((stats['read'], stats['inserted'], stats['rejected']),
+                         (5, 3, 2))
+        self.assertEqual(len(progress), 2)
+        self.assertEqual(
+            sorted(db.session.scalars(db.select(University.name))),
+            ['Makerere University', 'Strathmore University',
+             'University of Nairobi'])
+        makerere = University.query.filter_by(name='Makerere University').one()
+        self.assertEqual(makerere.status, 'closed')
+        self.assertEqual(
+            [(row['line'], row['error'])
+             for row in self.rejects(stats['rejects_path'])],
+            [(4, 'missing name'), (5, 'duplicate name in file')])
+
+    def test_import_rejects_existing_names(self):
+        db.session.add(University(name='Makerere University',
+                                  location='Kampala'))
+        db.session.commit()
+        path = self.write('universities.jsonl', '\n'.join([
+            json.dumps({'name': 'Makerere University', 'location': 'X'}),
+            'not json',
+            json.dumps({'name': 'Kenyatta University', 'location': 'Nairobi'})
+            ]))
+        stats = BulkLoader().load(path)
+        self.assertEqual((stats['inserted'], stats['rejected']), (1, 2))
+        self.assertEqual(
+            [row['error'] for row in self.rejects(stats['rejects_path'])],
+            ['unreadable line', 'name already exists'])
+        self.assertEqual(University.query.filter_by(
+            name='Makerere University').one().location, 'Kampala')
+
+    def test_upsert_updates_by_name(self):
+        university = University(id='mak', name='Makerere University',
+                                location='Kampala', like_count=4)
+        db.session.add(university)
+        db.session.commit()
+        created = university.updated_at
+        path = self.write('universities.jsonl', '\n'.join([
+            json.dumps({'name': 'Makerere University',
+                        'location': 'Kampala, Uganda', 'status': 'open'}),
+            json.dumps({'name': 'Kenyatta University', 'location': 'Nairobi'})
+            ]))
+        stats = BulkLoader(upsert=True).load(path)
+        self.assertEqual((stats['inserted'], stats['updated']), (1, 1))
+        self.assertIsNone(stats['rejects_path'])
+        db.session.expire_all()
+        university = db.session.get(University, 'mak')
+        self.assertEqual(university.location, 'Kampala, Uganda')
+        self.assertEqual(university.status, 'open')
+        self.assertEqual(university.like_count, 4)
+        self.assertGreater(university.updated_at, created)
+
+    def test_import_resets_search_index(self):
+        ensure_loaded()
+        path = self.write('universities.csv', CSV)
+        BulkLoader().load(path)
+        self.assertFalse(university_index.loaded)
+        results = ensure_loaded().search('strathmore', 5)
+        self.assertEqual(results[0][1]['name'], 'Strathmore University')
+
+    def test_console_reports_progress(self):
+        path = self.write('universities.csv', CSV)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            UniversityConsole().onecmd('import {} 10'.format(path))
+            UniversityConsole().onecmd('upsert')
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('5 rows read'))
+        self.assertTrue(lines[1].startswith(
+            'Inserted 3, updated 0, rejected 2 of 5 rows'))
+        self.assertIn('Expected format', lines[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import g, json
+from openai import OpenAI
+from app import app, chat, db, routes
+from app.llm_executor import LLMExecutor
+from app.llm_gateway import make_gateway
+from app.models import ChatMessage, ChatSession, User
+from app.tokens import count_message_tokens
+from bench.fake_openai import FakeOpenAIServer
+
+
+class ChatHistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        self.session = ChatSession(user_id='user-1')
+        db.session.add(self.session)
+        db.session.flush()
+        for number in range(6):
+            chat.add_message(self.session, 'user',
+                             'question {} about Kenya'.format(number))
+            chat.add_message(self.session, 'assistant',
+                             'answer {} naming Nairobi'.format(number))
+        db.session.commit()
+        self.turns = chat.unsummarized(self.session)
+
+    def test_recent_turns_fill_the_budget(self):
+        budget = sum(turn.tokens + 4 for turn in self.turns[-3:])
+        left_out, kept = chat.split_history(self.turns, budget)
+        self.assertEqual(kept, self.turns[-3:])
+        self.assertEqual(left_out, self.turns[:-3])
+        self.assertEqual(chat.split_history(self.turns, 0),
+                         (self.turns, []))
+
+    def test_turns_left_out_are_dropped_without_summarizer(self):
+        messages = chat.build_messages(self.session, 'Be brief.', 'And Kisumu?',
+                                       60)
+        self.assertLessEqual(count_message_tokens(messages), 60)
+        self.assertEqual(messages[0], {'role': 'system',
+                                       'content': 'Be brief.'})
+        self.assertEqual(messages[-1], {'role': 'user',
+                                        'content': 'And Kisumu?'})
+        self.assertEqual(messages[-2]['content'], 'answer 5 naming Nairobi')
+        self.assertIsNone(self.session.summary)
+        kept = len(messages) - 2
+        self.assertEqual(self.session.summarized_through,
+                         self.turns[-kept - 1].id)
+        self.assertEqual(len(chat.unsummarized(self.session)), kept)
+
+    def test_turns_left_out_are_summarized_once(self):
+        calls = []
+
+        def summarize(summary, turns):
+            calls.append((summary, [turn.content for turn in turns]))
+            return 'The user wants a university in Kenya.'
+
+        messages = chat.build_messages(self.session, 'Be brief.', 'And Kisumu?',
+                                       80, summarize, 20)
+        self.assertEqual(len(calls), 1)
+        self.assertIsNone(calls[0][0])
+        self.assertEqual(calls[0][1][0], 'question 0 about Kenya')
+        self.assertIn('The user wants a university in Kenya.',
+                      messages[0]['content'])
+        self.assertLessEqual(count_message_tokens(messages), 80)
+        db.session.commit()
+
+        again = chat.build_messages(self.session, 'Be brief.', 'And Kisumu?',
+                                    80, summarize, 20)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(again, messages)
+
+    def test_failed_summary_is_retried_later(self):
+        messages = chat.build_messages(self.session, 'Be brief.', 'And Kisumu?',
+                                       60, lambda summary, turns: None)
+        self.assertLessEqual(count_message_tokens(messages), 60)
+        self.assertEqual(self.session.summarized_through, 0)
+        self.assertIsNone(self.session.summary)
+
+
+class ChatRoutesTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        patcher = mock.patch.dict(app.config, {'SECRET_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        self.addCleanup(g.pop, '_login_user', None)
+        for name in ('alice', 'bob'):
+            db.session.add(User(id=name, username=name,
+                                email=name + '@example.com',
+                                password_hash='x', firstname=name,
+                                lastname='A'))
+        db.session.commit()
+        self.server = FakeOpenAIServer(chunks=['Try', ' Makerere', '.'])
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        with mock.patch.dict(app.config, {'LLM_USER_BURST': 100}):
+            gateway = make_gateway(
+                OpenAI(api_key='test', base_url=self.server.base_url),
+                LLMExecutor(), app)
+        patcher = mock.patch.object(routes, 'llm_gateway', gateway)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.login('alice')
+
+    def login(self, user_id):
+        g.pop('_login_user', None)
+        with self.client.session_transaction() as session:
+            session['_user_id'] = user_id
+            session['_fresh'] = True
+
+    def start(self):
+        response = self.client.post('/chat')
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.data)['session']['id']
+
+    def say(self, session_id, message):
+        return self.client.post('/chat/' + session_id,
+                                json={'message': message})
+
+    def test_conversation_keeps_context(self):
+        session_id = self.start()
+        first = json.loads(self.say(session_id, 'I like Uganda').data)
+        self.assertEqual(first['answer'], 'Try Makerere.')
+        self.say(session_id, 'Is it big?')
+        self.assertEqual(
+            [message['content']
+             for message in self.server.requests[1]['messages'][1:]],
+            ['I like Uganda', 'Try Makerere.', 'Is it big?'])
+
+        history = json.loads(self.client.get('/chat/' + session_id).data)
+        self.assertEqual([message['role'] for message in history['messages']],
+                         ['user', 'assistant', 'user', 'assistant'])
+        listed = json.loads(self.client.get('/chat').data)['sessions']
+        self.assertEqual([session['id'] for session in listed], [session_id])
+
+    def test_long_conversation_is_summarized(self):
+        session_id = self.start()
+        with mock.patch.dict(app.config, {'CHAT_PROMPT_TOKENS': 120,
+                                          'CHAT_SUMMARY_TOKENS': 30}):
+            for number in range(8):
+                response = json.loads(self.say(
+                    session_id, 'Question {} about Uganda'.format(number)
+                    ).data)
+                self.assertLessEqual(response['prompt_tokens'], 120)
+        summaries = [request for request in self.server.requests
+                     if request['messages'][0]['content']
+                     == chat.SUMMARY_PROMPT]
+        self.assertTrue(0 < len(summaries) < 8)
+        self.assertEqual(summaries[0]['max_tokens'], 30)
+        self.assertEqual(db.session.get(ChatSession, session_id).summary,
+                         'Try Makerere.')
+        self.assertEqual(ChatMessage.query.count(), 16)
+
+    def test_sessions_are_private(self):
+        session_id = self.start()
+        self.login('bob')
+        self.assertEqual(self.client.get('/chat/' + session_id).status_code,
+                         404)
+        self.assertEqual(self.say(session_id, 'Hello').status_code, 404)
+        self.assertEqual(json.loads(self.client.get('/chat').data)['sessions'],
+                         [])
+
+    def test_delete(self):
+        session_id = self.start()
+        self.say(session_id, 'I like Uganda')
+        response = self.client.delete('/chat/' + session_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ChatSession.query.count(), 0)
+        self.assertEqual(ChatMessage.query.count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import Flask
+from sqlalchemy import create_engine, text
+from app import app, db
+from app.db_metrics import QueryMonitor, QueryStats, statement_shape
+from app.models import University
+
+
+class StatementShapeTestCase(unittest.TestCase):
+    def test_parameters_and_literals_collapse(self):
+        self.assertEqual(
+            statement_shape('SELECT * FROM university\n'
+                            'WHERE id IN (?, ?, ?) AND name = ?'),
+            'SELECT * FROM university WHERE id IN (?) AND name = ?')
+        self.assertEqual(
+            statement_shape("SELECT * FROM t WHERE x = 'a''b' LIMIT 10"),
+            statement_shape("SELECT * FROM t WHERE x = 'c' LIMIT 20"))
+        self.assertEqual(
+            statement_shape('SELECT * FROM t WHERE id IN (%(id_1)s, %(id_2)s)'),
+            'SELECT * FROM t WHERE id IN (?)')
+
+    def test_repeated(self):
+        stats = QueryStats()
+        for i in range(3):
+            stats.record('SELECT * FROM t WHERE id = {}'.format(i), 0.001)
+        stats.record('SELECT 1', 0.005)
+        self.assertEqual(stats.count, 4)
+        self.assertEqual(stats.slowest_statement, 'SELECT 1')
+        self.assertEqual(stats.repeated(2),
+                         [('SELECT * FROM t WHERE id = ?', 3)])
+        self.assertEqual(stats.repeated(3), [])
+
+
+class QueryMonitorTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        for i in range(3):
+            db.session.add(University(id='u{}'.format(i),
+                                      name='University {}'.format(i),
+                                      location='Lagos, Nigeria'))
+        db.session.commit()
+
+    def test_headers(self):
+        response = self.client.get('/api/universities?limit=2')
+        # The catalog version for the ETag, then the page.
+        self.assertEqual(response.headers['X-DB-Queries'], '2')
+        self.assertGreater(float(response.headers['X-DB-Time-Ms']), 0)
+        self.assertTrue(response.headers['Server-Timing'].startswith('db;dur='))
+        with mock.patch.dict(app.config, {'DB_STATS_HEADERS': False}):
+            response = self.client.get('/api/universities')
+        self.assertNotIn('X-DB-Queries', response.headers)
+
+    def test_headers_are_off_in_production_by_default(self):
+        monitored = Flask(__name__)
+        QueryMonitor(monitored)
+        monitored.route('/')(lambda: 'ok')
+        response = monitored.test_client().get('/')
+        self.assertNotIn('X-DB-Queries', response.headers)
+        monitored.debug = True
+        response = monitored.test_client().get('/')
+        self.assertEqual(response.headers['X-DB-Queries'], '0')
+
+    def test_repeated_statement_warning(self):
+        monitored = Flask(__name__)
+        monitored.config['TESTING'] = True
+        monitored.config['DB_REPEATED_QUERY_WARNING'] = 2
+        QueryMonitor(monitored)
+        engine = create_engine('sqlite://')
+
+        @monitored.route('/n_plus_one')
+        def n_plus_one():
+            with engine.connect() as connection:
+                for i in range(3):
+                    connection.execute(text('SELECT :i'), {'i': i})
+                connection.execute(text('SELECT 1, 2'))
+            return 'ok'
+
+        with self.assertLogs(monitored.logger, 'WARNING') as logs:
+            response = monitored.test_client().get('/n_plus_one')
+        self.assertEqual(response.headers['X-DB-Queries'], '4')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('ran the same statement 3 times: SELECT ?',
+                      logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+import datetime
+import os
+import unittest
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from sqlalchemy import event
+from app import app, db
+from app.email_filter import CountingBloomFilter, EmailFilter, email_filter
+from app.models import EmailFilterLog, User
+
+
+def user(number, email=None):
+    return User(id='user-{}'.format(number), username='user{}'.format(number),
+                email=email or 'user{}@example.com'.format(number),
+                password_hash='x', firstname='User', lastname=str(number))
+
+
+class CountingBloomFilterTestCase(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = CountingBloomFilter(1000, 0.01)
+        keys = ['user{}@example.com'.format(number) for number in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        self.assertEqual(bloom.count, 1000)
+
+    def test_false_positive_rate_near_target(self):
+        bloom = CountingBloomFilter(1000, 0.01)
+        for number in range(1000):
+            bloom.add('user{}@example.com'.format(number))
+        false_positives = sum('other{}@example.com'.format(number) in bloom
+                              for number in range(10000))
+        self.assertLess(false_positives / 10000, 0.03)
+        self.assertAlmostEqual(bloom.false_positive_rate(), 0.01, delta=0.005)
+
+    def test_remove(self):
+        bloom = CountingBloomFilter(100, 0.01)
+        bloom.add('a@example.com')
+        bloom.add('b@example.com')
+        self.assertTrue(bloom.remove('a@example.com'))
+        self.assertNotIn('a@example.com', bloom)
+        self.assertIn('b@example.com', bloom)
+        self.assertFalse(bloom.remove('never@example.com'))
+        self.assertEqual(bloom.count, 1)
+
+    def test_saturated_counters_are_kept(self):
+        bloom = CountingBloomFilter(1, 0.5)
+        for _ in range(300):
+            bloom.add('a@example.com')
+        for _ in range(300):
+            bloom.remove('a@example.com')
+        self.assertIn('a@example.com', bloom)
+
+
+class EmailFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        email_filter.configure(1000, 0.01, 3600, 3600, 86400)
+        self.addCleanup(email_filter.configure, 1000, 0.01, 3600, 3600, 86400)
+        db.session.add(user(1))
+        db.session.commit()
+        # Another worker process, syncing on every lookup.
+        self.other = EmailFilter(1000, 0.01, sync_interval=0)
+
+    def count_queries(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                        listener)
+        return statements
+
+    def test_absent_email_needs_no_query(self):
+        self.assertTrue(email_filter.exists('user1@example.com'))
+        statements = self.count_queries()
+        self.assertFalse(email_filter.exists('nobody@example.com'))
+        self.assertEqual(statements, [])
+        self.assertFalse(email_filter.exists('USER1@example.com'))
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(email_filter.stats()['lookups'], {
+            'absent': 1, 'present': 1, 'false_positive': 1, 'unfiltered': 0})
+
+    def test_local_signup_is_seen_at_once(self):
+        email_filter.exists('user1@example.com')
+        db.session.add(user(2))
+        db.session.commit()
+        self.assertTrue(email_filter.might_exist('user2@example.com'))
+        self.assertEqual(email_filter.stats()['items'], 2)
+        # The next sync does not count it twice.
+        self.assertIs(email_filter.sync(), email_filter._filter)
+        self.assertEqual(email_filter.stats()['items'], 2)
+
+    def test_other_workers_sync_from_log(self):
+        self.assertFalse(self.other.might_exist('user2@example.com'))
+        db.session.add(user(2))
+        db.session.commit()
+        self.assertTrue(self.other.might_exist('user2@example.com'))
+        self.assertEqual(self.other.stats()['rebuilds'], {'missing': 1})
+
+    def test_log_rows_committed_out_of_order(self):
+        self.other.might_exist('user1@example.com')
+        newest = db.session.scalar(db.select(db.func.max(EmailFilterLog.id)))
+        # Row newest + 1 was taken first but commits after newest + 2.
+        db.session.add(EmailFilterLog(id=newest + 2, email='late@example.com'))
+        db.session.commit()
+        self.assertTrue(self.other.might_exist('late@example.com'))
+        db.session.add(EmailFilterLog(id=newest + 1, email='slow@example.com'))
+        db.session.commit()
+        self.assertTrue(self.other.might_exist('slow@example.com'))
+        # Rows read again within the window are only counted once.
+        self.other.sync()
+        self.assertEqual(self.other.stats()['items'], 3)
+        self.assertEqual(self.other.stats()['rebuilds'], {'missing': 1})
+
+    def test_rename(self):
+        self.other.might_exist('user1@example.com')
+        email_filter.might_exist('user1@example.com')
+        account = db.session.get(User, 'user-1')
+        account.email = 'renamed@example.com'
+        db.session.commit()
+        self.assertTrue(email_filter.might_exist('renamed@example.com'))
+        self.assertFalse(email_filter.might_exist('user1@example.com'))
+        self.assertTrue(self.other.might_exist('renamed@example.com'))
+
+    def test_delete(self):
+        email_filter.might_exist('user1@example.com')
+        db.session.delete(db.session.get(User, 'user-1'))
+        db.session.commit()
+        self.assertFalse(email_filter.might_exist('user1@example.com'))
+
+    def test_delete_route(self):
+        email_filter.might_exist('user1@example.com')
+        client = app.test_client()
+        self.assertEqual(client.delete('/api/users/user-1').status_code, 200)
+        db.session.remove()
+        self.assertIsNone(db.session.get(User, 'user-1'))
+        self.assertFalse(email_filter.might_exist('user1@example.com'))
+        self.assertEqual(client.delete('/api/users/user-1').status_code, 404)
+
+    def test_rollback_changes_nothing(self):
+        email_filter.might_exist('user1@example.com')
+        db.session.add(user(2))
+        db.session.flush()
+        db.session.rollback()
+        self.assertFalse(email_filter.might_exist('user2@example.com'))
+        self.assertFalse(self.other.might_exist('user2@example.com'))
+
+    def test_bulk_writes_trigger_rebuilds(self):
+        self.other.might_exist('user1@example.com')
+        email_filter.might_exist('user1@example.com')
+        db.session.execute(db.insert(User.__table__), [{
+            'id': 'user-2', 'username': 'user2', 'email': 'user2@example.com',
+            'password_hash': 'x', 'firstname': 'User', 'lastname': '2'}])
+        db.session.commit()
+        self.assertTrue(email_filter.exists('user2@example.com'))
+        self.assertTrue(self.other.might_exist('user2@example.com'))
+        db.session.execute(db.update(User).where(User.id == 'user-2')
+                           .values(email='bulk@example.com'))
+        db.session.commit()
+        self.assertTrue(email_filter.exists('bulk@example.com'))
+        self.assertTrue(self.other.might_exist('bulk@example.com'))
+        self.assertEqual(email_filter.stats()['rebuilds'], {'missing': 3})
+        self.assertEqual(self.other.stats()['rebuilds'],
+                         {'missing': 1, 'log': 2})
+
+    def test_grows_past_capacity(self):
+        email_filter.configure(2, 0.01, 3600, 3600, 86400)
+        email_filter.might_exist('user1@example.com')
+        for number in range(2, 5):
+            db.session.add(user(number))
+        db.session.commit()
+        self.assertTrue(email_filter.might_exist('user4@example.com'))
+        stats = email_filter.stats()
+        self.assertEqual(stats['rebuilds'], {'missing': 1, 'capacity': 1})
+        self.assertEqual(stats['capacity'], 8)
+
+    def test_rebuild_prunes_log_but_keeps_newest_row(self):
+        db.session.add(user(2))
+        db.session.commit()
+        db.session.execute(db.update(EmailFilterLog).values(
+            created_at=datetime.datetime(2000, 1, 1)))
+        db.session.commit()
+        email_filter.rebuild()
+        self.assertEqual(db.session.scalars(db.select(
+            EmailFilterLog.email)).all(), ['user2@example.com'])
+
+    def test_check_email_route(self):
+        client = app.test_client()
+        response = client.get('/check_email',
+                              query_string={'email': 'user1@example.com'})
+        self.assertEqual(response.get_json(), {'exists': True})
+        response = client.get('/check_email',
+                              query_string={'email': 'nobody@example.com'})
+        self.assertEqual(response.get_json(), {'exists': False})
+        metrics = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('email_filter_lookups_total{result="absent"}', metrics)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import contextlib
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import g
+from app import app, db
+from app.export import iter_rows, ndjson
+from app.models import University, User, UserPreference
+from console import UniversityConsole
+
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        patcher = mock.patch.dict(app.config, {'SECRET_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        db.session.add(User(id='user-1', username='alice',
+                            email='alice@example.com', password_hash='x',
+                            firstname='Alice', lastname='A'))
+        for i in range(25):
+            db.session.add(University(id='u{:02d}'.format(i),
+                                      name='University {}'.format(i),
+                                      location='Accra, Ghana'))
+            db.session.add(UserPreference(id='p{:02d}'.format(i),
+                                          user_id='user-1',
+                                          university_id='u{:02d}'.format(i)))
+        db.session.commit()
+        db.session.expunge_all()
+
+    def test_rows_are_not_hydrated(self):
+        rows = list(iter_rows('preferences', batch_size=4))
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[3], {'id': 'p03', 'user_id': 'user-1',
+                                   'university_id': 'u03'})
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_ndjson_chunks_hold_whole_lines(self):
+        chunks = list(ndjson(iter_rows('universities'), chunk_size=200))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertTrue(chunk.endswith('\n'))
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(json.loads(lines[-1])['id'], 'u24')
+        self.assertEqual(json.loads(lines[0])['like_count'], 0)
+
+    def test_api_export_gzip(self):
+        response = self.client.get('/api/export/universities.ndjson',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(response.data).decode().splitlines()
+        self.assertEqual(len(lines), 25)
+        response = self.client.get('/api/export/universities.ndjson')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(len(response.data.splitlines()), 25)
+
+    def test_api_preferences_export_needs_admin(self):
+        response = self.client.get('/api/export/preferences.ndjson')
+        self.assertEqual(response.status_code, 401)
+        # Requests share the pushed app context, and so the cached user.
+        g.pop('_login_user', None)
+        with self.client.session_transaction() as session:
+            session['_user_id'] = 'user-1'
+            session['_fresh'] = True
+        response = self.client.get('/api/export/preferences.ndjson')
+        self.assertEqual(response.status_code, 403)
+        with mock.patch.dict(app.config,
+                             {'ADMIN_EMAILS': {'alice@example.com'}}):
+            response = self.client.get('/api/export/preferences.ndjson')
+        self.assertEqual(len(response.data.splitlines()), 25)
+
+    def test_console_export(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'preferences.ndjson.gz')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            UniversityConsole().onecmd('export preferences ' + path)
+            UniversityConsole().onecmd('export users ' + path)
+        with gzip.open(path, 'rt') as file:
+            self.assertEqual(len(file.readlines()), 25)
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Exported 25 preferences'))
+        self.assertIn('Expected format', lines[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
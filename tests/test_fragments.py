@@ -0,0 +1,160 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import g
+from sqlalchemy import event
+from app import app, catalog, db
+from app.models import University, User, UserPreference
+from app.routes import change_like_count, fragment_cache
+
+
+class CatalogVersionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+
+    def version(self):
+        return catalog.version()[0]
+
+    def test_orm_changes_bump_once_per_transaction(self):
+        self.assertEqual(self.version(), 0)
+        db.session.add_all([
+            University(id='1', name='Makerere University', location='Kampala'),
+            University(id='2', name='University of Rwanda', location='Kigali'),
+            ])
+        db.session.commit()
+        self.assertEqual(self.version(), 1)
+        db.session.get(University, '1').status = 'open'
+        db.session.commit()
+        self.assertEqual(self.version(), 2)
+        db.session.delete(db.session.get(University, '2'))
+        db.session.commit()
+        self.assertEqual(self.version(), 3)
+
+    def test_counters_do_not_bump(self):
+        db.session.add(University(id='1', name='Makerere University',
+                                  location='Kampala'))
+        db.session.commit()
+        _, updated_at = catalog.version()
+        change_like_count('1', 1)
+        db.session.commit()
+        db.session.get(University, '1').like_count = 5
+        db.session.commit()
+        self.assertEqual(catalog.version(), (1, updated_at))
+
+    def test_bulk_statements_bump(self):
+        db.session.execute(db.insert(University.__table__), [
+            {'id': '1', 'name': 'Makerere University', 'location': 'Kampala'}])
+        db.session.commit()
+        self.assertEqual(self.version(), 1)
+        db.session.execute(db.update(University).values(status='open'))
+        db.session.execute(db.delete(University))
+        db.session.commit()
+        self.assertEqual(self.version(), 2)
+
+    def test_rollback_undoes_bump(self):
+        db.session.add(University(id='1', name='Makerere University',
+                                  location='Kampala'))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.version(), 0)
+        db.session.add(University(id='1', name='Makerere University',
+                                  location='Kampala'))
+        db.session.commit()
+        self.assertEqual(self.version(), 1)
+
+
+class UniversitiesPageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        self.addCleanup(g.pop, '_login_user', None)
+        patcher = mock.patch.dict(app.config, {'SECRET_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        fragment_cache.cache.clear()
+        db.session.add_all([
+            User(id='user-1', username='alice', email='alice@example.com',
+                 password_hash='x', firstname='Alice', lastname='A'),
+            University(id='1', name='Makerere University', location='Kampala',
+                       website='https://www.mak.ac.ug', status='open'),
+            University(id='2', name='University of Rwanda', location='Kigali',
+                       website='https://ur.ac.rw', status='closed'),
+            UserPreference(user_id='user-1', university_id='2'),
+            ])
+        db.session.commit()
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = 'user-1'
+            session['_fresh'] = True
+
+    def count_queries(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                        listener)
+        return statements
+
+    def get(self, **query):
+        response = self.client.get('/universities', query_string=query)
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True)
+
+    def test_second_request_reads_no_universities(self):
+        first = self.get()
+        statements = self.count_queries()
+        self.assertEqual(self.get(), first)
+        self.assertFalse([statement for statement in statements
+                          if 'FROM university' in statement])
+        self.assertIn('Makerere University', first)
+
+    def test_like_state_is_per_user(self):
+        page = self.get()
+        self.assertIn('like-btn active" aria-pressed="true" '
+                      'data-university-id="2"', page)
+        self.assertIn('like-btn" aria-pressed="false" '
+                      'data-university-id="1"', page)
+        self.client.post('/like', data={'university_id': '1'})
+        self.assertIn('data-university-id="1"', self.get())
+        self.assertIn('like-btn active" aria-pressed="true" '
+                      'data-university-id="1"', self.get())
+        # A like is not a catalog change.
+        self.assertEqual(catalog.version()[0], 1)
+
+    def test_catalog_change_renders_again(self):
+        self.get()
+        university = db.session.get(University, '1')
+        university.name = 'Makerere University Kampala'
+        db.session.commit()
+        self.assertIn('Makerere University Kampala', self.get())
+
+    def test_pages_are_cached_separately(self):
+        first = self.get(limit=1)
+        self.assertIn('Makerere University', first)
+        self.assertNotIn('University of Rwanda', first)
+        cursor = first.split('cursor=')[1].split('"')[0]
+        second = self.get(limit=1, cursor=cursor)
+        self.assertIn('University of Rwanda', second)
+        self.assertEqual(len(fragment_cache.cache), 2)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/universities',
+                                   query_string={'cursor': '!!'})
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+import contextlib
+import datetime
+import io
+import os
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import g, json
+from openai import OpenAI
+from app import app, db, routes
+from app.llm_accounting import LLMCallLog, _latencies, percentile, report
+from app.llm_cache import MemoryBackend, ResponseCache
+from app.llm_executor import LLMExecutor
+from app.llm_gateway import make_gateway
+from app.models import LLMCall, User
+from bench.fake_openai import FakeOpenAIServer
+from console import UniversityConsole
+
+
+def call_row(day, model='gpt-3.5-turbo', latency=100.0, question='q',
+             cache='miss', status='ok', cost=0.001):
+    return LLMCall(created_at=day, endpoint='search', model=model,
+                   user='u', question=question, cache=cache, status=status,
+                   prompt_tokens=100, completion_tokens=20, cost=cost,
+                   latency_ms=latency, first_token_ms=latency / 2)
+
+
+class LLMCallLogTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+
+    def test_rows_are_written_in_batches(self):
+        calls = LLMCallLog(app)
+        calls.batch_size = 2
+        for number in range(5):
+            calls.record('search', 'gpt-3.5-turbo', 'u', 'miss', 'ok',
+                         time.perf_counter(), question=str(number),
+                         prompt_tokens=1000, completion_tokens=1000)
+        self.assertEqual(LLMCall.query.count(), 0)
+        with mock.patch.object(db.session, 'execute',
+                               wraps=db.session.execute) as execute:
+            calls.flush()
+        self.assertEqual(execute.call_count, 3)
+        rows = LLMCall.query.order_by(LLMCall.id).all()
+        self.assertEqual([row.question for row in rows],
+                         ['0', '1', '2', '3', '4'])
+        self.assertAlmostEqual(rows[0].cost, 0.002)
+        self.assertEqual(rows[0].first_token_ms, rows[0].latency_ms)
+
+    def test_full_queue_drops_rows(self):
+        with mock.patch.dict(app.config, {'LLM_ACCOUNTING_MAX_QUEUED': 1}):
+            calls = LLMCallLog(app)
+        for _ in range(3):
+            calls.record('search', 'm', None, 'hit', 'ok', time.perf_counter())
+        self.assertEqual(calls.stats(), {'recorded': 1, 'queued': 1,
+                                         'dropped': 2, 'failed': 0})
+
+    def test_writer_thread(self):
+        calls = LLMCallLog(app)
+        with mock.patch.dict(app.config, {'TESTING': False}):
+            calls.record('search', 'm', None, 'hit', 'ok', time.perf_counter())
+            calls.flush()
+        self.assertTrue(calls._thread.is_alive())
+        self.assertEqual(LLMCall.query.count(), 1)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_report(self):
+        today = datetime.datetime.now(
+            datetime.timezone.utc).replace(tzinfo=None)
+        yesterday = today - datetime.timedelta(days=1)
+        for latency in range(1, 21):
+            db.session.add(call_row(today, latency=latency * 100.0))
+        db.session.add(call_row(today, cache='hit', latency=1.0, cost=0))
+        db.session.add(call_row(today, status='rejected', latency=1.0,
+                                cost=0))
+        db.session.add(call_row(today, model='gpt-4', question='costly',
+                                cost=0.5))
+        db.session.add(call_row(yesterday))
+        db.session.add(call_row(today - datetime.timedelta(days=10)))
+        db.session.commit()
+
+        result = report(days=2)
+        self.assertEqual([(row['day'], row['model'])
+                          for row in result['days']], [
+            (yesterday.date().isoformat(), 'gpt-3.5-turbo'),
+            (today.date().isoformat(), 'gpt-3.5-turbo'),
+            (today.date().isoformat(), 'gpt-4'),
+        ])
+        row = result['days'][1]
+        self.assertEqual((row['calls'], row['cache_hits'], row['rejected']),
+                         (22, 1, 1))
+        self.assertEqual(row['prompt_tokens'], 2200)
+        self.assertEqual(row['latency_ms'], {'p50': 1000.0, 'p95': 1900.0,
+                                             'p99': 2000.0})
+        self.assertEqual(row['first_token_ms']['p50'], 500.0)
+        self.assertEqual(result['costliest_questions'][0]['question'],
+                         'costly')
+        self.assertEqual(result['costliest_questions'][1]['calls'], 23)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            UniversityConsole().onecmd('llm_report 2')
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 1 + 3 + 1 + 2)
+        self.assertIn('gpt-4', lines[3])
+        self.assertTrue(lines[5].endswith('costly'))
+
+    def test_percentiles_are_sampled(self):
+        today = datetime.datetime.now(
+            datetime.timezone.utc).replace(tzinfo=None)
+        for latency in range(1, 101):
+            db.session.add(call_row(today, latency=float(latency)))
+        db.session.commit()
+        latencies, first_tokens = _latencies(
+            today.date().isoformat(), 'gpt-3.5-turbo', 100, 10)
+        self.assertEqual(len(latencies), 10)
+        self.assertEqual(len(first_tokens), 10)
+        row, = report(days=1, sample=10)['days']
+        self.assertEqual(row['calls'], 100)
+        self.assertAlmostEqual(row['latency_ms']['p50'], 50, delta=10)
+
+    def test_sample_is_spread_over_the_calls_of_the_model(self):
+        today = datetime.datetime.now(
+            datetime.timezone.utc).replace(tzinfo=None)
+        # The other model takes every other id.
+        for latency in range(1, 101):
+            db.session.add(call_row(today, latency=float(latency)))
+            db.session.add(call_row(today, model='gpt-4'))
+        db.session.commit()
+        latencies, _ = _latencies(
+            today.date().isoformat(), 'gpt-3.5-turbo', 100, 10)
+        self.assertEqual(latencies, [float(latency)
+                                     for latency in range(1, 101, 10)])
+
+
+class AccountedRoutesTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        self.server = FakeOpenAIServer(chunks=['Try', ' Makerere', '.'])
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.calls = LLMCallLog(app)
+        with mock.patch.dict(app.config, {'LLM_USER_BURST': 2}):
+            gateway = make_gateway(
+                OpenAI(api_key='test', base_url=self.server.base_url),
+                LLMExecutor(), app, self.calls)
+        for name, value in (
+                ('llm_gateway', gateway), ('llm_calls', self.calls),
+                ('search_cache', ResponseCache(MemoryBackend(10, 60)))):
+            patcher = mock.patch.object(routes, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def rows(self):
+        self.calls.flush()
+        return LLMCall.query.order_by(LLMCall.id).all()
+
+    def test_search_calls_are_recorded(self):
+        self.client.get('/search?question=uganda')
+        self.client.get('/search?question=Uganda')
+        miss, hit = self.rows()
+        self.assertEqual((miss.endpoint, miss.question, miss.cache,
+                          miss.status), ('search', 'uganda', 'miss', 'ok'))
+        self.assertEqual((miss.prompt_tokens, miss.completion_tokens),
+                         (10, 3))
+        self.assertEqual(miss.model, app.config['SEARCH_MODEL'])
+        self.assertGreater(miss.cost, 0)
+        self.assertEqual((hit.cache, hit.prompt_tokens, hit.cost),
+                         ('hit', 0, 0))
+
+    def test_stream_is_recorded_when_it_ends(self):
+        self.client.get('/search/stream?question=uganda').get_data()
+        response = self.client.get('/search/stream?question=kenya',
+                                   buffered=False)
+        next(iter(response.response))
+        response.close()
+        self.client.get('/search/stream?question=rwanda')
+        streamed, cancelled, rejected = self.rows()
+        self.assertEqual((streamed.endpoint, streamed.status),
+                         ('search_stream', 'ok'))
+        self.assertGreater(streamed.prompt_tokens, 0)
+        self.assertEqual(streamed.completion_tokens, 4)
+        self.assertEqual(cancelled.status, 'cancelled')
+        self.assertLessEqual(streamed.first_token_ms, streamed.latency_ms)
+        self.assertEqual((rejected.status, rejected.first_token_ms),
+                         ('rejected', None))
+
+    def test_report_endpoint(self):
+        self.client.get('/search?question=uganda')
+        self.calls.flush()
+        patcher = mock.patch.dict(app.config, {'SECRET_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.assertEqual(self.client.get('/llm/report').status_code, 401)
+        db.session.add(User(id='admin', username='admin',
+                            email='admin@example.com', password_hash='x',
+                            firstname='Ada', lastname='Admin'))
+        db.session.commit()
+        # Requests share the pushed app context, and so the cached user.
+        self.addCleanup(g.pop, '_login_user', None)
+        g.pop('_login_user', None)
+        with self.client.session_transaction() as session:
+            session['_user_id'] = 'admin'
+            session['_fresh'] = True
+        self.assertEqual(self.client.get('/llm/report').status_code, 403)
+        with mock.patch.dict(app.config,
+                             {'ADMIN_EMAILS': {'admin@example.com'}}):
+            response = json.loads(self.client.get('/llm/report?days=1').data)
+            self.assertEqual(
+                self.client.get('/llm/report?days=0').status_code, 400)
+        self.assertEqual(response['days'][0]['calls'], 1)
+        self.assertEqual(response['costliest_questions'][0]['question'],
+                         'uganda')
+        self.assertEqual(response['writer']['recorded'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
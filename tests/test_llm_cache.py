@@ -0,0 +1,196 @@
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import json
+from sqlalchemy import event
+from app import app, db, routes
+from app.cache import LRUCache
+from app.llm_cache import (DatabaseBackend, MemoryBackend, ResponseCache,
+                           SQLiteBackend, TieredBackend, normalize_question)
+from app.llm_executor import LLMExecutor
+from app.llm_gateway import make_gateway
+from app.models import LLMCacheEntry
+
+
+def completion(text):
+    message = SimpleNamespace(content=text)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_entries_expire(self):
+        now = [0]
+        cache = LRUCache(ttl=10, clock=lambda: now[0])
+        cache.set('a', 1)
+        now[0] = 11
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_bounded_in_bytes(self):
+        cache = LRUCache(max_entries=10, max_bytes=10)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'yyyy')
+        cache.set('a', 'xxx')
+        self.assertEqual(cache.size, 7)
+        cache.set('c', 'zzzz')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.size, 7)
+        cache.set('d', 'w' * 11)
+        self.assertIsNone(cache.get('d'))
+        cache.delete('a')
+        self.assertEqual(cache.stats()['size'], 4)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def test_normalization(self):
+        self.assertEqual(
+            normalize_question('  Best   universities in KENYA?? '),
+            'best universities in kenya'
+            )
+
+    def test_key_includes_prompt_and_model(self):
+        cache = ResponseCache(MemoryBackend(10, 60))
+        cache.set('q', 'prompt', 'model-a', {'answer': 'a'})
+        self.assertIsNone(cache.get('q', 'prompt', 'model-b'))
+        self.assertIsNone(cache.get('q', 'other prompt', 'model-a'))
+        self.assertEqual(cache.get('Q?', 'prompt', 'model-a'), {'answer': 'a'})
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_sqlite_backend_is_shared_and_bounded(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'cache.db')
+        first = ResponseCache(SQLiteBackend(path, 2, 60))
+        second = ResponseCache(SQLiteBackend(path, 2, 60))
+        first.set('one', 'p', 'm', {'answer': '1'})
+        self.assertEqual(second.get('one', 'p', 'm'), {'answer': '1'})
+        first.set('two', 'p', 'm', {'answer': '2'})
+        first.set('three', 'p', 'm', {'answer': '3'})
+        self.assertEqual(first.stats()['evictions'], 1)
+        self.assertEqual(first.stats()['entries'], 2)
+
+
+class DatabaseBackendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+
+    def test_shared_between_backends(self):
+        first = ResponseCache(DatabaseBackend(app, 10, 60))
+        second = ResponseCache(DatabaseBackend(app, 10, 60))
+        first.set('one', 'p', 'm', {'answer': '1'})
+        self.assertEqual(second.get('One?', 'p', 'm'), {'answer': '1'})
+        first.set('one', 'p', 'm', {'answer': 'again'})
+        self.assertEqual(second.get('one', 'p', 'm'), {'answer': 'again'})
+
+    def test_expired_and_surplus_entries_are_deleted(self):
+        for key, ttl in (('gone', -1), ('old', 10), ('a', 20), ('b', 30),
+                         ('c', 40)):
+            DatabaseBackend(app, 2, ttl).set(key, 'x')
+        backend = DatabaseBackend(app, 2, 60, prune_every=1)
+        self.assertIsNone(backend.get('gone'))
+        backend.prune()
+        self.assertEqual(len(backend), 2)
+        self.assertEqual(backend.evictions, 2)
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get('b'), 'x')
+        backend.set('d', 'x')
+        self.assertEqual(len(backend), 2)
+        # The hit keeps b; c, written after it but unused since, goes.
+        self.assertIsNone(backend.get('c'))
+        self.assertEqual(backend.get('b'), 'x')
+
+    def test_hits_are_written_in_batches(self):
+        backend = DatabaseBackend(app, 10, 60, touch_every=3)
+        for key in ('a', 'b', 'c'):
+            backend.set(key, 'x')
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                        listener)
+        for key in ('a', 'b', 'a', 'c'):
+            backend.get(key)
+        updates = [statement for statement in statements
+                   if statement.startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        used = dict(db.session.execute(db.select(
+            LLMCacheEntry.key, LLMCacheEntry.last_used_at)).all())
+        self.assertGreater(used['c'], used['b'])
+        self.assertGreater(used['a'], used['b'])
+
+    def test_local_tier_is_filled_from_shared(self):
+        shared = DatabaseBackend(app, 10, 60)
+        shared.set('key', 'value')
+        local = MemoryBackend(10, 60)
+        backend = TieredBackend(local, shared)
+        self.assertEqual(backend.name, 'memory+database')
+        self.assertEqual(backend.get('key'), 'value')
+        self.assertEqual(local.get('key'), 'value')
+        backend.set('other', 'x')
+        self.assertEqual(shared.get('other'), 'x')
+
+    def test_unavailable_database_is_a_miss(self):
+        db.drop_all()
+        backend = DatabaseBackend(app, 10, 60)
+        backend.set('key', 'value')
+        self.assertIsNone(backend.get('key'))
+        db.create_all()
+
+
+class SearchCacheRouteTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        self.create = mock.Mock(return_value=completion(' Try Makerere. '))
+        client = mock.Mock()
+        client.with_options.return_value.chat.completions.create = self.create
+        for name, value in (
+                ('llm_gateway', make_gateway(client, LLMExecutor(), app)),
+                ('search_cache', ResponseCache(MemoryBackend(10, 60)))):
+            patcher = mock.patch.object(routes, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_repeated_question_calls_model_once(self):
+        first = self.client.get('/search?question=Best in Uganda?')
+        second = self.client.get('/search?question=best in uganda')
+        self.assertEqual(self.create.call_count, 1)
+        self.assertFalse(json.loads(first.data)['cached'])
+        self.assertEqual(json.loads(second.data), {
+            'success': True, 'answer': 'Try Makerere.', 'sources': [],
+            'cached': True})
+        stats = json.loads(self.client.get('/search/cache').data)
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
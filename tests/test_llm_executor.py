@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import json
+from app import app, db, routes
+from app.llm_cache import MemoryBackend, ResponseCache
+from app.llm_executor import LLMExecutor, LLMOverloaded
+
+
+class LLMExecutorTestCase(unittest.TestCase):
+    def test_identical_calls_are_merged(self):
+        executor = LLMExecutor(max_in_flight=4)
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait(5)
+            return 'answer'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(executor.run('key', fn)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while executor.coalesced < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['answer'] * 5)
+
+    def test_errors_reach_every_waiter(self):
+        executor = LLMExecutor()
+
+        def fn():
+            raise ValueError('upstream')
+
+        with self.assertRaises(ValueError):
+            executor.run('key', fn)
+        self.assertEqual(executor.stats()['in_flight'], 0)
+
+    def test_full_queue_is_rejected(self):
+        executor = LLMExecutor(max_in_flight=1, max_queued=0)
+        with executor.slot():
+            with self.assertRaises(LLMOverloaded):
+                executor.acquire()
+        self.assertEqual(executor.rejected, 1)
+        executor.acquire().release()
+
+    def test_queue_deadline(self):
+        executor = LLMExecutor(max_in_flight=1, max_queued=1,
+                               queue_timeout=0.05)
+        permit = executor.acquire()
+        with self.assertRaises(LLMOverloaded):
+            executor.acquire()
+        permit.release()
+        permit.release()
+        self.assertEqual(executor.stats()['queued'], 0)
+        executor.acquire().release()
+
+
+class SearchLoadSheddingTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        executor = LLMExecutor(max_in_flight=1, max_queued=0)
+        for target, name, value in (
+                (routes.llm_gateway, 'executor', executor),
+                (routes, 'search_cache', ResponseCache(MemoryBackend(10, 60)))):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.permit = executor.acquire()
+        self.addCleanup(self.permit.release)
+
+    def test_search_returns_503_when_saturated(self):
+        response = self.client.get('/search?question=kenya')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        self.assertFalse(json.loads(response.data)['success'])
+
+    def test_stream_reports_503_before_streaming(self):
+        response = self.client.get('/search/stream?question=kenya')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'event: failed')
+        data = json.loads(lines[1][len('data: '):])
+        self.assertEqual(data['status'], 503)
+        self.assertEqual(data['retry_after'], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,293 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from openai import OpenAI
+from app import app, db, routes
+from app.llm_cache import MemoryBackend, ResponseCache
+from app.llm_executor import LLMExecutor
+from app.llm_gateway import (CircuitBreaker, DatabaseBucketStore,
+                             LLMCircuitOpen, LLMGateway, LLMRateLimited,
+                             LLMUpstreamError, MemoryBucketStore,
+                             RateLimiter, SQLiteBucketStore)
+from app.models import LLMBucket
+from bench.fake_openai import FakeOpenAIServer
+
+
+MESSAGES = [{'role': 'user', 'content': 'hi'}]
+
+
+def limiter(user_burst=100, global_burst=100, store=None, clock=None):
+    if store is None:
+        store = MemoryBucketStore()
+    return RateLimiter(store, user_rate=60,
+                       user_burst=user_burst, global_rate=60,
+                       global_burst=global_burst,
+                       clock=clock or (lambda: 0.0))
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_user_bucket_refills(self):
+        now = [0.0]
+        limits = limiter(user_burst=2, clock=lambda: now[0])
+        limits.check('alice')
+        limits.check('alice')
+        with self.assertRaises(LLMRateLimited) as caught:
+            limits.check('alice')
+        self.assertEqual(caught.exception.status, 429)
+        self.assertEqual(caught.exception.retry_after, 1)
+        limits.check('bob')
+        now[0] = 1.0
+        limits.check('alice')
+
+    def test_global_bucket(self):
+        limits = limiter(global_burst=1)
+        limits.check('alice')
+        with self.assertRaises(LLMRateLimited):
+            limits.check('bob')
+
+    def test_sqlite_store_is_shared(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'buckets.db')
+        first = limiter(user_burst=1, store=SQLiteBucketStore(path))
+        second = limiter(user_burst=1, store=SQLiteBucketStore(path))
+        first.check('alice')
+        with self.assertRaises(LLMRateLimited):
+            second.check('alice')
+
+    def test_database_store_is_shared(self):
+        app_context = app.app_context()
+        app_context.push()
+        db.create_all()
+        self.addCleanup(app_context.pop)
+        self.addCleanup(db.drop_all)
+        now = [0.0]
+        clock = lambda: now[0]
+        first = limiter(user_burst=1, global_burst=2, clock=clock,
+                        store=DatabaseBucketStore(app, prune_every=4))
+        second = limiter(user_burst=1, global_burst=2, clock=clock,
+                         store=DatabaseBucketStore(app, prune_every=4))
+        first.check('alice')
+        with self.assertRaises(LLMRateLimited) as caught:
+            second.check('alice')
+        self.assertEqual(caught.exception.retry_after, 1)
+        second.check('bob')
+        with self.assertRaises(LLMRateLimited):
+            first.check('carol')
+        now[0] = 3.0
+        # The fourth take of the store prunes the buckets full again.
+        second.check('alice')
+        self.assertEqual(db.session.scalars(
+            db.select(LLMBucket.key).order_by(LLMBucket.key)).all(),
+            ['global', 'user:alice'])
+
+    def test_memory_store_drops_full_buckets(self):
+        store = MemoryBucketStore(sweep_interval=10)
+        now = [0.0]
+        limits = limiter(user_burst=2, store=store, clock=lambda: now[0])
+        for user in ('alice', 'bob', 'carol'):
+            limits.check(user)
+        self.assertEqual(len(store), 4)
+        now[0] = 10.0
+        limits.check('alice')
+        self.assertEqual(len(store), 2)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def test_opens_then_half_opens(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10,
+                                 clock=lambda: now[0])
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        with self.assertRaises(LLMCircuitOpen):
+            breaker.before_call()
+        now[0] = 10.0
+        breaker.before_call()
+        with self.assertRaises(LLMCircuitOpen):
+            breaker.before_call()
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_interrupted_trial_lets_another_through(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10,
+                                 clock=lambda: now[0])
+        client = mock.Mock()
+        create = client.with_options.return_value.chat.completions.create
+        create.side_effect = [TimeoutError('pool timeout'), 'ok']
+        gateway = LLMGateway(client, limiter(), breaker, LLMExecutor())
+        breaker.record_failure()
+        now[0] = 10.0
+        with self.assertRaises(TimeoutError):
+            gateway.complete(MESSAGES, 'fake')
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertEqual(gateway._create(model='fake', messages=MESSAGES),
+                         'ok')
+        self.assertEqual(breaker.state, 'closed')
+
+
+class GatewayTestCase(unittest.TestCase):
+    def gateway(self, server, failures=5, max_retries=2):
+        self.delays = []
+        return LLMGateway(
+            OpenAI(api_key='test', base_url=server.base_url),
+            limiter(), CircuitBreaker(failure_threshold=failures),
+            LLMExecutor(), max_retries=max_retries, base_delay=0.1,
+            max_delay=1.0, sleep=self.delays.append)
+
+    def test_retries_retryable_errors_with_backoff(self):
+        with FakeOpenAIServer(chunks=['ok'], failures=[429, 503]) as server:
+            gateway = self.gateway(server)
+            response = gateway.complete(MESSAGES, 'fake')
+        self.assertEqual(response.choices[0].message.content, 'ok')
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(len(self.delays), 2)
+        self.assertTrue(0 <= self.delays[0] <= 0.1)
+        self.assertTrue(0 <= self.delays[1] <= 0.2)
+
+    def test_slot_is_given_back_while_waiting_to_retry(self):
+        in_flight = []
+        executor = LLMExecutor(max_in_flight=1)
+        with FakeOpenAIServer(chunks=['ok'], failures=[429, 429]) as server:
+            gateway = LLMGateway(
+                OpenAI(api_key='test', base_url=server.base_url),
+                limiter(), CircuitBreaker(), executor, base_delay=0.1,
+                sleep=lambda delay: in_flight.append(executor.in_flight))
+            gateway.complete(MESSAGES, 'fake', key='question')
+            permit, deltas = gateway.stream(MESSAGES, 'fake')
+            self.assertEqual(executor.in_flight, 1)
+            permit.release()
+        self.assertEqual(in_flight, [0, 0])
+        self.assertEqual(executor.in_flight, 0)
+
+    def merged_calls(self, store, release):
+        """ Ask the same question as alice, then as bob while it runs. """
+        client = mock.Mock()
+        message = SimpleNamespace(content='ok')
+        client.with_options.return_value.chat.completions.create = (
+            lambda **kwargs: release.wait(5) and SimpleNamespace(
+                choices=[SimpleNamespace(message=message)]))
+        executor = LLMExecutor()
+        gateway = LLMGateway(
+            client, RateLimiter(store, 60, 1, 60, 100), CircuitBreaker(),
+            executor)
+        results = {}
+
+        def ask(user):
+            try:
+                results[user] = gateway.complete(
+                    MESSAGES, 'fake', user=user, key='question')
+            except LLMRateLimited as error:
+                results[user] = error
+
+        threads = [threading.Thread(target=ask, args=(user,))
+                   for user in ('alice', 'bob')]
+        threads[0].start()
+        while 'question' not in executor._calls:
+            time.sleep(0.001)
+        threads[1].start()
+        while not executor.coalesced:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_merged_calls_are_charged_once(self):
+        store = mock.Mock(wraps=MemoryBucketStore())
+        results = self.merged_calls(store, threading.Event())
+        self.assertIs(results['alice'], results['bob'])
+        self.assertEqual([call.args[0] for call in store.take.call_args_list],
+                         ['user:alice', 'global'])
+
+    def test_merged_into_a_rate_limited_call(self):
+        release = threading.Event()
+        store = MemoryBucketStore()
+        store.take('user:alice', 1, 1, time.time())
+        take = store.take
+
+        def slow_take(key, *args):
+            if key == 'user:alice':
+                release.wait(5)
+            return take(key, *args)
+
+        store.take = slow_take
+        results = self.merged_calls(store, release)
+        self.assertIsInstance(results['alice'], LLMRateLimited)
+        self.assertEqual(results['bob'].choices[0].message.content, 'ok')
+
+    def test_gives_up_and_opens_breaker(self):
+        with FakeOpenAIServer(failures=[500] * 10) as server:
+            gateway = self.gateway(server, failures=3, max_retries=2)
+            with self.assertRaises(LLMUpstreamError):
+                gateway.complete(MESSAGES, 'fake')
+            with self.assertRaises(LLMCircuitOpen):
+                gateway.complete(MESSAGES, 'fake')
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(gateway.stats()['breaker'], 'open')
+
+    def test_client_errors_are_not_retried(self):
+        with FakeOpenAIServer(failures=[400]) as server:
+            gateway = self.gateway(server)
+            with self.assertRaises(LLMUpstreamError):
+                gateway.complete(MESSAGES, 'fake')
+        self.assertEqual(len(server.requests), 1)
+
+    def test_stream(self):
+        with FakeOpenAIServer(chunks=['a', 'b'], failures=[429]) as server:
+            gateway = self.gateway(server)
+            permit, deltas = gateway.stream(MESSAGES, 'fake')
+            self.assertEqual(list(deltas), ['a', 'b'])
+            permit.release()
+        self.assertEqual(gateway.executor.in_flight, 0)
+
+
+class ClientAddressTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        self.gateway = mock.Mock()
+        message = SimpleNamespace(content='ok')
+        self.gateway.complete.return_value = SimpleNamespace(
+            choices=[SimpleNamespace(message=message)])
+        for name, value in (
+                ('llm_gateway', self.gateway),
+                ('search_cache', ResponseCache(MemoryBackend(10, 60)))):
+            patcher = mock.patch.object(routes, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def user(self, question, forwarded=None):
+        headers = {'X-Forwarded-For': forwarded} if forwarded else {}
+        self.client.get('/search', query_string={'question': question},
+                        headers=headers,
+                        environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        return self.gateway.complete.call_args.kwargs['user']
+
+    def test_address_added_by_nginx_is_used(self):
+        self.assertEqual(self.user('kenya', '203.0.113.5'), '203.0.113.5')
+        # An X-Forwarded-For sent by the client only moves to the left.
+        self.assertEqual(self.user('uganda', '198.51.100.7, 203.0.113.5'),
+                         '203.0.113.5')
+        self.assertEqual(self.user('rwanda'), '10.0.0.2')
+
+
+if __name__ == '__main__':
+    unittest.main()
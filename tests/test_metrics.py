@@ -0,0 +1,123 @@
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from prometheus_client import REGISTRY
+from app import app, db
+from app.metrics import upstream_timer
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+
+    def test_requests_are_counted_by_endpoint(self):
+        labels = {'method': 'GET', 'endpoint': 'universities'}
+        before = sample('http_requests_total', status='200', **labels)
+        observed = sample('http_request_duration_seconds_count', **labels)
+        self.client.get('/api/universities', buffered=True)
+        missing = sample('http_requests_total', method='GET',
+                         endpoint='<unmatched>', status='404')
+        self.client.get('/no/such/page', buffered=True)
+        self.assertEqual(
+            sample('http_requests_total', status='200', **labels), before + 1)
+        self.assertEqual(
+            sample('http_request_duration_seconds_count', **labels),
+            observed + 1)
+        self.assertEqual(
+            sample('http_requests_total', method='GET',
+                   endpoint='<unmatched>', status='404'), missing + 1)
+
+    def test_streamed_request_is_in_flight_until_closed(self):
+        before = sample('http_requests_in_flight', endpoint='universities')
+        response = self.client.get('/api/universities?format=ndjson',
+                                   buffered=False)
+        self.assertEqual(
+            sample('http_requests_in_flight', endpoint='universities'),
+            before + 1)
+        response.close()
+        self.assertEqual(
+            sample('http_requests_in_flight', endpoint='universities'),
+            before)
+
+    def test_upstream_timer(self):
+        labels = {'upstream': 'smtp', 'operation': 'send'}
+        failed = sample('upstream_request_duration_seconds_count',
+                        outcome='error', **labels)
+        with self.assertRaises(OSError):
+            with upstream_timer('smtp', 'send'):
+                raise OSError('connection refused')
+        self.assertEqual(
+            sample('upstream_request_duration_seconds_count',
+                   outcome='error', **labels), failed + 1)
+
+    def test_exposition(self):
+        response = self.client.get('/metrics')
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn(b'# TYPE http_request_duration_seconds histogram',
+                      response.data)
+
+    def test_exposition_token(self):
+        with mock.patch.dict(app.config, METRICS_TOKEN='scrape'):
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            response = self.client.get('/metrics', headers={
+                'Authorization': 'Bearer wrong'})
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response.headers['WWW-Authenticate'], 'Bearer')
+            response = self.client.get('/metrics', headers={
+                'Authorization': 'Bearer scrape'})
+        self.assertEqual(response.status_code, 200)
+
+
+class MultiProcessMetricsTestCase(unittest.TestCase):
+    def run_worker(self, directory, script):
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory,
+                   SQLALCHEMY_DATABASE_URI='sqlite://', OPENAI_API_KEY='test')
+        result = subprocess.run(
+            [sys.executable, '-c', textwrap.dedent(script)], cwd=ROOT,
+            env=env, capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return result.stdout
+
+    def test_workers_are_added_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.run_worker(directory, '''
+                from app import app
+                client = app.test_client()
+                for _ in range(2):
+                    client.get('/about/missing', buffered=True)
+                ''')
+            output = self.run_worker(directory, '''
+                from app import app
+                client = app.test_client()
+                for _ in range(3):
+                    client.get('/about/missing', buffered=True)
+                print(client.get('/metrics').get_data(as_text=True))
+                ''')
+        self.assertIn('http_requests_total{endpoint="<unmatched>",'
+                      'method="GET",status="404"} 5.0', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import contextlib
+import datetime
+import io
+import os
+import socket
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from aiosmtpd.controller import Controller
+from flask_mailman import Mail
+from app import app, db, routes
+from app.models import EmailOutbox, User
+from app.outbox import OutboxSender, enqueue_email, outbox
+from console import UniversityConsole
+
+
+class Handler:
+    """ Record what the SMTP server receives, refusing some recipients. """
+
+    def __init__(self):
+        self.messages = []
+        self.sessions = []
+        self.refuse = {}
+
+    async def handle_RCPT(self, server, session, envelope, address,
+                          rcpt_options):
+        if address in self.refuse:
+            return self.refuse[address]
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        if session not in self.sessions:
+            self.sessions.append(session)
+        self.messages.append(envelope)
+        return '250 Message accepted for delivery'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class OutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        patcher = mock.patch.dict(app.config, {'SECRET_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+
+        self.handler = Handler()
+        port = free_port()
+        controller = Controller(self.handler, hostname='127.0.0.1',
+                                port=port)
+        controller.start()
+        self.addCleanup(controller.stop)
+        patcher = mock.patch.dict(app.extensions, {'mailman': Mail.init_mail(
+            {'MAIL_BACKEND': 'smtp', 'MAIL_SERVER': '127.0.0.1',
+             'MAIL_PORT': port, 'MAIL_TIMEOUT': 5})})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        with mock.patch.dict(app.config, {'OUTBOX_BATCH_SIZE': 10,
+                                          'OUTBOX_MAX_ATTEMPTS': 3}):
+            self.outbox = OutboxSender(app, Mail())
+        self.addCleanup(self.outbox.close)
+
+    def enqueue(self, count, to='student@example.com'):
+        for number in range(count):
+            enqueue_email('Hello {}'.format(number), 'Body', [to],
+                          from_email='noreply@example.com')
+        db.session.commit()
+
+    def test_reset_password_only_enqueues(self):
+        db.session.add(User(id='alice', username='alice',
+                            email='alice@example.com', password_hash='x',
+                            firstname='Alice', lastname='A'))
+        db.session.commit()
+        with mock.patch.object(routes, 'outbox', self.outbox):
+            response = app.test_client().post(
+                '/reset_password', data={'email': 'alice@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.handler.messages, [])
+        row = db.session.execute(db.select(EmailOutbox)).scalar_one()
+        self.assertEqual(row.status, 'pending')
+        self.assertIn('/reset_password/', row.body)
+
+        self.assertEqual(self.outbox.drain(), 1)
+        self.assertEqual(row.status, 'sent')
+        self.assertEqual(self.handler.messages[0].rcpt_tos,
+                         ['alice@example.com'])
+
+    def test_rolled_back_email_is_never_sent(self):
+        enqueue_email('Hello', 'Body', ['student@example.com'])
+        db.session.rollback()
+        self.assertEqual(self.outbox.drain(), 0)
+        self.assertEqual(self.handler.messages, [])
+
+    def test_batches_share_one_connection(self):
+        self.enqueue(25)
+        self.assertEqual(self.outbox.drain(), 25)
+        self.assertEqual(len(self.handler.messages), 25)
+        self.assertEqual(len(self.handler.sessions), 1)
+        self.assertEqual(self.outbox.stats()['connections'], 1)
+        self.assertEqual(EmailOutbox.query.filter_by(status='sent').count(),
+                         25)
+        self.assertEqual(self.outbox.drain(), 0)
+
+    def test_sends_outside_the_claiming_transaction(self):
+        self.enqueue(2)
+        seen = []
+        send = self.outbox._send
+
+        def recording_send(row):
+            in_transaction = db.session().in_transaction()
+            seen.append((in_transaction, db.session.scalar(
+                db.select(EmailOutbox.status)
+                .where(EmailOutbox.id == row.id))))
+            send(row)
+
+        with mock.patch.object(self.outbox, '_send', recording_send):
+            self.assertEqual(self.outbox.drain(), 2)
+        self.assertEqual(seen, [(False, 'sending'), (False, 'sending')])
+        self.assertEqual(EmailOutbox.query.filter_by(status='sent').count(),
+                         2)
+
+    def test_expired_lease_is_claimed_again(self):
+        self.enqueue(2)
+        rows = EmailOutbox.query.order_by(EmailOutbox.id).all()
+        # A worker died while sending the first; the second is still its.
+        rows[0].status = rows[1].status = 'sending'
+        rows[0].next_attempt_at = datetime.datetime.utcnow()
+        rows[1].next_attempt_at = (datetime.datetime.utcnow()
+                                   + datetime.timedelta(minutes=5))
+        db.session.commit()
+        self.assertEqual(self.outbox.drain(), 1)
+        self.assertEqual([row.status for row in rows], ['sent', 'sending'])
+
+    def test_temporary_failure_is_retried_later(self):
+        self.handler.refuse['busy@example.com'] = '451 Try again later'
+        self.enqueue(1, to='busy@example.com')
+        self.enqueue(1)
+        started = datetime.datetime.utcnow()
+        self.assertEqual(self.outbox.drain(), 2)
+        busy = EmailOutbox.query.filter_by(
+            recipients='busy@example.com').one()
+        self.assertEqual(busy.status, 'pending')
+        self.assertEqual(busy.attempts, 1)
+        self.assertIn('451', busy.last_error)
+        self.assertGreaterEqual(
+            busy.next_attempt_at,
+            started + datetime.timedelta(
+                seconds=app.config['OUTBOX_RETRY_BASE_DELAY']))
+        self.assertEqual(len(self.handler.messages), 1)
+        self.assertEqual(self.outbox.drain(), 0)
+
+        del self.handler.refuse['busy@example.com']
+        busy.next_attempt_at = datetime.datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(self.outbox.drain(), 1)
+        self.assertEqual(busy.status, 'sent')
+        self.assertEqual(busy.attempts, 2)
+
+    def test_permanent_failure_is_dead_lettered(self):
+        self.handler.refuse['gone@example.com'] = '550 No such user'
+        self.enqueue(1, to='gone@example.com')
+        self.outbox.drain()
+        row = EmailOutbox.query.one()
+        self.assertEqual(row.status, 'dead')
+        self.assertEqual(row.attempts, 1)
+        self.assertEqual(self.outbox.stats()['dead'], 1)
+
+    def test_gives_up_after_max_attempts(self):
+        self.handler.refuse['busy@example.com'] = '451 Try again later'
+        self.enqueue(1, to='busy@example.com')
+        row = EmailOutbox.query.one()
+        for _ in range(3):
+            row.next_attempt_at = datetime.datetime.utcnow()
+            db.session.commit()
+            self.assertEqual(self.outbox.drain(), 1)
+        self.assertEqual(row.status, 'dead')
+        self.assertEqual(row.attempts, 3)
+        self.assertEqual(self.outbox.stats()['retried'], 2)
+
+    def test_reconnects_after_disconnect(self):
+        self.enqueue(1)
+        self.outbox.drain()
+        self.outbox._connection.connection.close()
+        self.enqueue(2)
+        self.outbox.drain()
+        failed = EmailOutbox.query.filter_by(status='pending').all()
+        for row in failed:
+            row.next_attempt_at = datetime.datetime.utcnow()
+        db.session.commit()
+        self.outbox.drain()
+        self.assertEqual(EmailOutbox.query.filter_by(status='sent').count(),
+                         3)
+        self.assertEqual(self.outbox.stats()['connections'], 2)
+
+    def test_notify_wakes_the_sender_thread(self):
+        self.enqueue(3)
+        self.outbox.poll_interval = 3600
+        with mock.patch.dict(app.config, {'TESTING': False}):
+            self.outbox.notify()
+            # The thread shares the in memory database with the next
+            # tests; let it commit before they start.
+            self.addCleanup(self.outbox.stop, 5)
+            deadline = time.monotonic() + 5
+            while (len(self.handler.messages) < 3
+                   and time.monotonic() < deadline):
+                time.sleep(0.01)
+        self.assertEqual(len(self.handler.messages), 3)
+        thread = self.outbox._thread
+        self.outbox.stop(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(
+            EmailOutbox.query.filter_by(status='sent').count(), 3)
+
+    def test_requests_start_the_sender(self):
+        self.addCleanup(setattr, outbox, '_pid', outbox._pid)
+        outbox._pid = None
+        with mock.patch.object(OutboxSender, '_run') as run, \
+                mock.patch.dict(app.config, {'TESTING': False}):
+            for _ in range(2):
+                app.test_client().get('/api/universities').close()
+        self.assertEqual(outbox._pid, os.getpid())
+        self.assertEqual(run.call_count, 1)
+
+    def test_console_drain(self):
+        self.enqueue(2)
+        self.addCleanup(outbox.close)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            UniversityConsole().onecmd('outbox_drain')
+        self.assertTrue(output.getvalue().startswith('Attempted 2 emails'))
+        self.assertEqual(len(self.handler.messages), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
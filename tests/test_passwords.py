@@ -0,0 +1,189 @@
+import concurrent.futures
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import g
+from werkzeug.security import generate_password_hash
+from app import app, db
+from app.models import User
+from app.passwords import PasswordHasher, PasswordHashingBusy, hasher
+from app.routes import s
+
+
+FAST = 'pbkdf2:sha256:1000'
+
+
+class PasswordHasherTestCase(unittest.TestCase):
+    def test_hash_and_verify_inline(self):
+        passwords = PasswordHasher(FAST)
+        password_hash = passwords.hash('Secret123')
+        self.assertTrue(password_hash.startswith(FAST + '$'))
+        self.assertTrue(passwords.verify(password_hash, 'Secret123'))
+        self.assertFalse(passwords.verify(password_hash, 'secret123'))
+        self.assertFalse(passwords.verify('', 'Secret123'))
+        self.assertFalse(passwords.verify(password_hash, None))
+
+    def test_unreadable_hashes_never_match(self):
+        passwords = PasswordHasher(FAST)
+        self.assertFalse(passwords.verify('sha256$salt$abcdef', 'Secret123'))
+        self.assertFalse(passwords.verify('x', 'Secret123'))
+
+    def test_needs_rehash(self):
+        passwords = PasswordHasher(FAST)
+        self.assertFalse(passwords.needs_rehash(passwords.hash('Secret123')))
+        self.assertTrue(passwords.needs_rehash(
+            generate_password_hash('Secret123', 'pbkdf2:sha256:500')))
+        self.assertTrue(passwords.needs_rehash('sha256$salt$abcdef'))
+        self.assertTrue(passwords.needs_rehash(None))
+
+    def test_default_costs_are_filled_in(self):
+        passwords = PasswordHasher('pbkdf2')
+        self.assertFalse(passwords.needs_rehash(
+            'pbkdf2:sha256:600000$salt$abcdef'))
+        self.assertTrue(passwords.needs_rehash(
+            'pbkdf2:sha256:260000$salt$abcdef'))
+
+    def test_needs_rehash_does_not_hash(self):
+        passwords = PasswordHasher('scrypt')
+        with mock.patch('app.passwords.generate_password_hash',
+                        side_effect=AssertionError('hashed')):
+            self.assertFalse(passwords.needs_rehash(
+                'scrypt:32768:8:1$salt$abcdef'))
+            self.assertTrue(passwords.needs_rehash(
+                'scrypt:16384:8:1$salt$abcdef'))
+            self.assertTrue(passwords.needs_rehash(
+                'pbkdf2:sha256:600000$salt$abcdef'))
+
+    def test_slow_hash_is_refused(self):
+        passwords = PasswordHasher(FAST, workers=1)
+        executor = mock.Mock()
+        executor.submit.return_value.result.side_effect = (
+            concurrent.futures.TimeoutError())
+        with mock.patch.object(passwords, '_pool', return_value=executor):
+            with self.assertRaises(PasswordHashingBusy):
+                passwords.hash('Secret123')
+
+    def test_process_pool(self):
+        passwords = PasswordHasher(FAST, workers=1)
+        self.addCleanup(passwords.configure, FAST, 0, 16, 2, 30)
+        password_hash = passwords.hash('Secret123')
+        self.assertTrue(passwords.verify(password_hash, 'Secret123'))
+        self.assertFalse(passwords.verify(password_hash, 'Other123'))
+        self.assertFalse(passwords.verify('sha256$salt$abcdef', 'Secret123'))
+
+    def test_full_queue_is_refused(self):
+        passwords = PasswordHasher(FAST, workers=1, max_pending=1,
+                                   queue_timeout=0.01)
+        self.assertTrue(passwords._pending.acquire(blocking=False))
+        with self.assertRaises(PasswordHashingBusy) as raised:
+            passwords.hash('Secret123')
+        self.assertEqual(raised.exception.status, 503)
+        self.assertIsNone(passwords._executor)
+
+
+class PasswordRoutesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        self.addCleanup(g.pop, '_login_user', None)
+        patcher = mock.patch.dict(app.config, {'SECRET_KEY': 'test',
+                                               'WTF_CSRF_ENABLED': False})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings = (hasher.method, hasher.workers, hasher.max_pending,
+                    hasher.queue_timeout, hasher.timeout)
+        hasher.configure(FAST, 0, 16, 2, 30)
+        self.addCleanup(hasher.configure, *settings)
+        db.session.add(User(
+            id='user-1', username='alice', email='alice@example.com',
+            password_hash=generate_password_hash('Secret123',
+                                                 'pbkdf2:sha256:500'),
+            firstname='Alice', lastname='A'))
+        db.session.commit()
+        db.session.remove()
+        self.client = app.test_client()
+
+    def stored_hash(self):
+        db.session.remove()
+        return db.session.get(User, 'user-1').password_hash
+
+    def test_login_rehashes_outdated_hash(self):
+        response = self.client.post('/login', data={
+            'email': 'alice@example.com', 'password': 'Secret123'})
+        self.assertEqual(response.status_code, 302)
+        password_hash = self.stored_hash()
+        self.assertTrue(password_hash.startswith(FAST + '$'))
+        self.assertTrue(hasher.verify(password_hash, 'Secret123'))
+
+    def test_failed_login_keeps_hash(self):
+        before = self.stored_hash()
+        db.session.remove()
+        response = self.client.post('/login', data={
+            'email': 'alice@example.com', 'password': 'Wrong1234'})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.stored_hash(), before)
+
+    def test_busy_hasher_answers_503(self):
+        with mock.patch.object(User, 'check_password', side_effect=
+                               PasswordHashingBusy('busy', retry_after=2)):
+            response = self.client.post('/login', data={
+                'email': 'alice@example.com', 'password': 'Secret123'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '2')
+
+    def test_reset_password_with_token(self):
+        token = s.dumps('alice@example.com', salt='email-confirm')
+        response = self.client.post('/reset_password/' + token,
+                                    data={'password': 'Changed123'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith('/login'))
+        password_hash = self.stored_hash()
+        self.assertTrue(password_hash.startswith(FAST + '$'))
+        self.assertTrue(hasher.verify(password_hash, 'Changed123'))
+
+    def test_reset_password_for_deleted_user(self):
+        token = s.dumps('nobody@example.com', salt='email-confirm')
+        response = self.client.post('/reset_password/' + token,
+                                    data={'password': 'Changed123'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith('/reset_password'))
+
+    def test_api_signup_stores_hash(self):
+        response = self.client.post('/api/signup', json={
+            'email': 'bob@example.com', 'username': 'bob',
+            'password': 'Secret123', 'firstname': 'Bob', 'lastname': 'B'})
+        self.assertEqual(response.status_code, 201)
+        user = User.query.filter_by(username='bob').one()
+        self.assertEqual(user.lastname, 'B')
+        self.assertTrue(user.check_password('Secret123'))
+
+    def test_api_reset_password(self):
+        data = {'email': 'alice@example.com', 'password': 'Changed123'}
+        self.assertEqual(self.client.post('/api/reset_password',
+                                          json=data).status_code, 401)
+        # Requests share the pushed app context, and so the cached user.
+        g.pop('_login_user', None)
+        with self.client.session_transaction() as session:
+            session['_user_id'] = 'user-1'
+            session['_fresh'] = True
+        self.assertEqual(self.client.post('/api/reset_password', json=dict(
+            data, email='bob@example.com')).status_code, 404)
+        with mock.patch.object(hasher, 'hash', wraps=hasher.hash) as hash_:
+            response = self.client.post('/api/reset_password', json=data)
+        self.assertEqual(response.status_code, 200)
+        hash_.assert_called_once_with('Changed123')
+        user = db.session.get(User, 'user-1')
+        self.assertTrue(user.password_hash.startswith(FAST + '$'))
+        self.assertTrue(user.check_password('Changed123'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import json
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from app.models import University, User, UserPreference
+
+
+class PreferencesTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        patcher = mock.patch.dict(app.config, {'SECRET_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        for i in range(3):
+            db.session.add(University(id='u{}'.format(i),
+                                      name='University {}'.format(i),
+                                      location='Kigali'))
+        db.session.add(User(id='user-1', username='alice',
+                            email='alice@example.com', password_hash='x',
+                            firstname='Alice', lastname='A'))
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = 'user-1'
+            session['_fresh'] = True
+
+    def like_count(self, university_id):
+        db.session.expire_all()
+        return db.session.get(University, university_id).like_count
+
+    def test_like_is_idempotent(self):
+        first = self.client.post('/like', data={'university_id': 'u1'})
+        second = self.client.post('/like', data={'university_id': 'u1'})
+        self.assertTrue(json.loads(first.data)['success'])
+        self.assertFalse(json.loads(second.data)['success'])
+        self.assertEqual(UserPreference.query.count(), 1)
+        self.assertEqual(self.like_count('u1'), 1)
+
+    def test_like_unknown_university(self):
+        response = self.client.post('/like', data={'university_id': 'nope'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(UserPreference.query.count(), 0)
+
+    def test_dislike_removes_like(self):
+        self.client.post('/like', data={'university_id': 'u1'})
+        self.client.post('/dislike', data={'university_id': 'u1'})
+        self.client.post('/dislike', data={'university_id': 'u1'})
+        self.assertEqual(UserPreference.query.count(), 0)
+        self.assertEqual(self.like_count('u1'), 0)
+
+    def test_duplicate_rows_are_rejected(self):
+        db.session.add(UserPreference(user_id='user-1', university_id='u0'))
+        db.session.add(UserPreference(user_id='user-1', university_id='u0'))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+    def test_most_liked(self):
+        self.client.post('/like', data={'university_id': 'u2'})
+        response = self.client.get('/api/universities/most_liked?limit=2')
+        rows = json.loads(response.data)['universities']
+        self.assertEqual([row['id'] for row in rows], ['u2', 'u0'])
+        self.assertEqual(rows[0]['like_count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import os
+import random
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+import numpy as np
+from flask import g, json
+from app import app, db
+from app.models import University, User, UserPreference
+from app import recommendations
+from app.recommendations import ItemItemRecommender, recommender
+
+
+ITEMS = ['u{}'.format(i) for i in range(8)]
+
+
+def similarity_table(engine):
+    table = {}
+    for i, item in enumerate(engine._items):
+        for j, sim in zip(engine._neighbors[i], engine._similarities[i]):
+            if j >= 0:
+                table[(item, engine._items[j])] = round(float(sim), 9)
+    return table
+
+
+class ItemItemRecommenderTestCase(unittest.TestCase):
+    def test_cosine_neighbors(self):
+        engine = ItemItemRecommender(k=5)
+        engine.build([('a', 'u0'), ('a', 'u1'), ('b', 'u0'), ('b', 'u1'),
+                      ('c', 'u0'), ('c', 'u2')], ITEMS)
+        table = similarity_table(engine)
+        self.assertAlmostEqual(table[('u1', 'u0')], 2 / np.sqrt(2 * 3))
+        self.assertAlmostEqual(table[('u2', 'u0')], 1 / np.sqrt(1 * 3))
+        self.assertNotIn(('u0', 'u3'), table)
+        [(university_id, score)] = engine.recommend('c')
+        self.assertEqual(university_id, 'u1')
+        self.assertAlmostEqual(score, 2 / np.sqrt(6))
+        self.assertEqual(engine.recommend('nobody'), [])
+
+    def test_incremental_updates_match_rebuild(self):
+        rng = random.Random(7)
+        likes = {(user, rng.choice(ITEMS))
+                 for user in 'abcdefgh' for _ in range(3)}
+        changes = [(rng.choice('abcdefghij'), rng.choice(ITEMS + ['new']))
+                   for _ in range(30)]
+        engine = ItemItemRecommender(k=len(ITEMS) + 1)
+        engine.build(sorted(likes), ITEMS)
+        for pair in changes:
+            if pair in likes:
+                likes.discard(pair)
+                engine.remove_like(*pair)
+            else:
+                likes.add(pair)
+                engine.add_like(*pair)
+        rebuilt = ItemItemRecommender(k=len(ITEMS) + 1)
+        rebuilt.build(sorted(likes), engine._items)
+        self.assertEqual(similarity_table(engine), similarity_table(rebuilt))
+
+
+class RecommendationRouteTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        patcher = mock.patch.dict(app.config, {'SECRET_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        recommender.loaded = False
+        self.addCleanup(setattr, recommender, 'loaded', False)
+        for i, location in enumerate(['Nairobi, Kenya', 'Kampala, Uganda',
+                                      'Mombasa, Kenya', 'Kigali, Rwanda']):
+            db.session.add(University(id='u{}'.format(i),
+                                      name='University {}'.format(i),
+                                      location=location, like_count=i))
+        for user_id in ('alice', 'bob'):
+            db.session.add(User(id=user_id, username=user_id,
+                                email=user_id + '@example.com',
+                                password_hash='x', firstname=user_id,
+                                lastname=user_id, location='KE'))
+        db.session.commit()
+
+    def login(self, user_id):
+        # Requests share the pushed app context, and so the cached user.
+        g.pop('_login_user', None)
+        with self.client.session_transaction() as session:
+            session['_user_id'] = user_id
+            session['_fresh'] = True
+
+    def recommendations(self):
+        data = json.loads(self.client.get('/api/recommendations?limit=2').data)
+        return data['strategy'], [row['id'] for row in data['recommendations']]
+
+    def test_cold_start_uses_location(self):
+        self.login('alice')
+        self.assertEqual(self.recommendations(), ('location', ['u2', 'u0']))
+
+    def test_new_likes_are_applied_incrementally(self):
+        self.login('bob')
+        self.client.post('/like', data={'university_id': 'u1'})
+        self.recommendations()
+        self.assertTrue(recommender.loaded)
+        self.client.post('/like', data={'university_id': 'u3'})
+        self.login('alice')
+        self.client.post('/like', data={'university_id': 'u1'})
+        strategy, ids = self.recommendations()
+        self.assertEqual(strategy, 'item_item')
+        self.assertEqual(ids, ['u3', 'u2'])
+
+    def test_likes_of_other_processes_rebuild(self):
+        self.login('alice')
+        self.client.post('/like', data={'university_id': 'u1'})
+        self.assertEqual(self.recommendations()[0], 'location')
+        # Written without the route, like a like made by another process.
+        db.session.add(UserPreference(user_id='bob', university_id='u1'))
+        db.session.add(UserPreference(user_id='bob', university_id='u3'))
+        db.session.commit()
+        self.assertEqual(self.recommendations(), ('item_item', ['u3', 'u2']))
+
+    def test_own_likes_do_not_rebuild(self):
+        self.login('alice')
+        self.client.post('/like', data={'university_id': 'u1'})
+        self.recommendations()
+        with mock.patch('app.recommendations.load',
+                        wraps=recommendations.load) as load:
+            self.client.post('/like', data={'university_id': 'u3'})
+            self.client.post('/like', data={'university_id': 'u3'})
+            self.client.post('/dislike', data={'university_id': 'u1'})
+            self.login('bob')
+            self.client.post('/like', data={'university_id': 'u3'})
+            self.client.post('/like', data={'university_id': 'u2'})
+            self.login('alice')
+            self.assertEqual(self.recommendations(),
+                             ('item_item', ['u2', 'u0']))
+        self.assertEqual(load.call_count, 0)
+
+    def test_like_and_unlike_elsewhere_rebuild(self):
+        self.login('alice')
+        self.client.post('/like', data={'university_id': 'u1'})
+        self.login('bob')
+        self.client.post('/like', data={'university_id': 'u1'})
+        self.client.post('/like', data={'university_id': 'u3'})
+        self.login('alice')
+        self.assertEqual(self.recommendations(), ('item_item', ['u3', 'u2']))
+        # The number of likes stays the same.
+        db.session.execute(db.update(UserPreference)
+                           .where(UserPreference.user_id == 'alice')
+                           .values(university_id='u2'))
+        db.session.commit()
+        self.assertEqual(self.recommendations()[0], 'location')
+
+    def test_rebuilds_in_the_background(self):
+        self.login('alice')
+        self.client.post('/like', data={'university_id': 'u1'})
+        self.recommendations()
+        stale = recommender.version
+        db.session.add(UserPreference(user_id='bob', university_id='u1'))
+        db.session.add(UserPreference(user_id='bob', university_id='u3'))
+        db.session.commit()
+        with mock.patch.dict(app.config, {'TESTING': False}):
+            self.assertIs(recommendations.ensure_loaded(), recommender)
+            # The request is answered from the model it had.
+            self.assertEqual(recommender.version, stale)
+            recommender._thread.join(5)
+        self.assertEqual(recommender.version, recommendations.version())
+        self.assertEqual(recommender.recommend('alice'),
+                         [('u3', mock.ANY)])
+
+
+if __name__ == '__main__':
+    unittest.main()
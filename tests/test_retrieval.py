@@ -0,0 +1,89 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import json
+from openai import OpenAI
+from app import app, db, routes
+from app.llm_cache import MemoryBackend, ResponseCache
+from app.llm_executor import LLMExecutor
+from app.llm_gateway import make_gateway
+from app.models import University
+from app.retrieval import build_context, cited_sources
+from app.search_index import university_index
+from app.tokens import count_tokens
+from bench.fake_openai import FakeOpenAIServer
+
+
+ROWS = [
+    {'id': 'ke-1', 'name': 'University of Nairobi',
+     'location': 'Nairobi, Kenya', 'website': 'uonbi.ac.ke',
+     'status': 'open'},
+    {'id': 'ke-2', 'name': 'Kenyatta University',
+     'location': 'Nairobi, Kenya', 'website': 'ku.ac.ke', 'status': 'open'},
+    {'id': 'ug-1', 'name': 'Makerere University',
+     'location': 'Kampala, Uganda', 'website': 'mak.ac.ug',
+     'status': 'open'},
+]
+
+
+class ContextTestCase(unittest.TestCase):
+    def test_context_respects_budget(self):
+        context, rows = build_context(ROWS, 70)
+        self.assertLessEqual(count_tokens(context), 70)
+        self.assertEqual([row['id'] for row in rows], ['ke-1', 'ke-2'])
+        self.assertEqual(build_context(ROWS, 5), ('', []))
+
+    def test_only_given_rows_are_cited(self):
+        answer = 'Try [ke-2], then [xx-9] or [ke-2] and [ke-1].'
+        self.assertEqual(cited_sources(answer, ROWS), [
+            {'id': 'ke-2', 'name': 'Kenyatta University'},
+            {'id': 'ke-1', 'name': 'University of Nairobi'},
+        ])
+
+
+class GroundedSearchTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        for row in ROWS:
+            db.session.add(University(**row))
+        db.session.commit()
+        university_index.loaded = False
+        self.server = FakeOpenAIServer(chunks=['Consider [ke-1].'])
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        for name, value in (
+                ('llm_gateway', make_gateway(
+                    OpenAI(api_key='test', base_url=self.server.base_url),
+                    LLMExecutor(), app)),
+                ('search_cache', ResponseCache(MemoryBackend(10, 60)))):
+            patcher = mock.patch.object(routes, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_prompt_lists_relevant_rows_and_answer_cites_them(self):
+        response = self.client.get(
+            '/search?question=Best universities in Kenya?')
+        data = json.loads(response.data)
+        self.assertEqual(data['sources'], [
+            {'id': 'ke-1', 'name': 'University of Nairobi'}])
+        request = self.server.requests[0]
+        system = request['messages'][0]['content']
+        self.assertIn('[ke-1] University of Nairobi', system)
+        self.assertIn('[ke-2] Kenyatta University', system)
+        self.assertNotIn('Makerere', system)
+        self.assertEqual(request['max_tokens'], app.config['SEARCH_MAX_TOKENS'])
+
+
+if __name__ == '__main__':
+    unittest.main()
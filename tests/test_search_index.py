@@ -0,0 +1,136 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import json
+from app import app, db
+from app.models import University
+from app.search_index import UniversityIndex, university_index
+
+
+ROWS = [
+    {'id': '1', 'name': 'University of Nairobi', 'location': 'Nairobi, Kenya',
+     'website': 'https://www.uonbi.ac.ke', 'status': 'open'},
+    {'id': '2', 'name': 'Makerere University', 'location': 'Kampala, Uganda',
+     'website': 'https://www.mak.ac.ug', 'status': 'open'},
+    {'id': '3', 'name': 'University of Rwanda', 'location': 'Kigali, Rwanda',
+     'website': 'https://ur.ac.rw', 'status': 'closed'},
+]
+
+
+class UniversityIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = UniversityIndex()
+        self.index.build(ROWS)
+
+    def test_exact_match_ranks_name_first(self):
+        results = self.index.search('makerere')
+        self.assertEqual([row['id'] for _, row in results], ['2'])
+
+    def test_fuzzy_match(self):
+        results = self.index.search('nairobbi')
+        self.assertEqual(results[0][1]['id'], '1')
+
+    def test_all_terms_must_match(self):
+        results = self.index.search('university kigali')
+        self.assertEqual([row['id'] for _, row in results], ['3'])
+
+    def test_falls_back_to_partial_matches(self):
+        results = self.index.search('rwanda zanzibar')
+        self.assertEqual(results[0][1]['id'], '3')
+
+    def test_incremental_update_and_delete(self):
+        self.index.apply('update', dict(ROWS[1], name='Gulu University'))
+        self.assertEqual(self.index.search('makerere'), [])
+        self.assertEqual(self.index.search('gulu')[0][1]['id'], '2')
+        self.index.apply('delete', ROWS[1])
+        self.assertEqual(self.index.search('gulu'), [])
+        self.assertEqual(len(self.index), 2)
+
+
+class SearchRouteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app
+        self.app.config['TESTING'] = True
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        for row in ROWS:
+            db.session.add(University(**row))
+        db.session.commit()
+        university_index.loaded = False
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        university_index.loaded = False
+
+    def search(self, q):
+        response = self.client.get('/api/universities/search?q=' + q)
+        self.assertEqual(response.status_code, 200)
+        return [row['id'] for row in json.loads(response.data)['results']]
+
+    def test_index_follows_committed_writes(self):
+        self.assertEqual(self.search('kampala'), ['2'])
+        db.session.add(University(
+            id='4', name='Kampala International University',
+            location='Kampala, Uganda', website='kiu.ac.ug'))
+        db.session.commit()
+        self.assertEqual(sorted(self.search('kampala')), ['2', '4'])
+        db.session.delete(db.session.get(University, '2'))
+        db.session.commit()
+        self.assertEqual(self.search('kampala'), ['4'])
+
+    def test_own_writes_do_not_rebuild(self):
+        with mock.patch.object(university_index, 'build',
+                               wraps=university_index.build) as build:
+            self.assertEqual(self.search('kampala'), ['2'])
+            university = db.session.get(University, '2')
+            university.name = 'Makerere University Kampala'
+            db.session.commit()
+            self.assertEqual(self.search('makerere kampala'), ['2'])
+            db.session.add(University(
+                id='4', name='Kampala International University',
+                location='Kampala, Uganda', website='kiu.ac.ug'))
+            db.session.add(University(
+                id='5', name='Uganda Christian University',
+                location='Mukono, Uganda'))
+            db.session.commit()
+            self.assertEqual(self.search('mukono'), ['5'])
+            db.session.delete(db.session.get(University, '4'))
+            db.session.commit()
+            self.assertEqual(self.search('international'), [])
+            # A change this process was not told about still rebuilds.
+            db.session.execute(db.update(University)
+                               .where(University.id == '3')
+                               .values(name='Kigali University'))
+            db.session.commit()
+            self.assertEqual(self.search('kigali'), ['3'])
+        self.assertEqual(build.call_count, 2)
+
+    def test_index_follows_changes_of_other_processes(self):
+        self.assertEqual(self.search('makerere'), ['2'])
+        # A bulk statement sends no notification, like another process.
+        db.session.execute(db.update(University)
+                           .where(University.id == '2')
+                           .values(name='Beta University'))
+        db.session.commit()
+        self.assertEqual(self.search('beta'), ['2'])
+        self.assertEqual(self.search('makerere'), [])
+
+    def test_rolled_back_writes_are_not_indexed(self):
+        self.search('kampala')
+        db.session.add(University(
+            id='5', name='Uganda Christian University', location='Mukono'))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.search('mukono'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
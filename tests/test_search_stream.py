@@ -0,0 +1,97 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import json
+from openai import OpenAI
+from app import app, db, routes
+from app.llm_cache import MemoryBackend, ResponseCache
+from app.llm_executor import LLMExecutor, LLMOverloaded
+from app.llm_gateway import make_gateway
+from bench.fake_openai import FakeOpenAIServer
+
+
+def parse_events(body):
+    events = []
+    for block in body.strip().split('\n\n'):
+        event = 'message'
+        for line in block.splitlines():
+            if line.startswith('event: '):
+                event = line[len('event: '):]
+            elif line.startswith('data: '):
+                events.append((event, json.loads(line[len('data: '):])))
+    return events
+
+
+class SearchStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        self.server = FakeOpenAIServer(
+            chunks=['Try', ' Makerere', '.'], chunk_delay=0.05)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        for name, value in (
+                ('llm_gateway', make_gateway(
+                    OpenAI(api_key='test', base_url=self.server.base_url),
+                    LLMExecutor(), app)),
+                ('search_cache', ResponseCache(MemoryBackend(10, 60)))):
+            patcher = mock.patch.object(routes, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_tokens_are_forwarded_as_they_arrive(self):
+        started = time.monotonic()
+        response = self.client.get('/search/stream?question=uganda',
+                                   buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        body = iter(response.response)
+        first = next(body)
+        first_at = time.monotonic() - started
+        rest = b''.join(body)
+        total = time.monotonic() - started
+        response.close()
+        self.assertLess(first_at, total)
+        events = parse_events((first + rest).decode('utf-8'))
+        self.assertEqual(events, [
+            ('message', {'delta': 'Try'}),
+            ('message', {'delta': ' Makerere'}),
+            ('message', {'delta': '.'}),
+            ('done', {'cached': False, 'sources': []}),
+        ])
+        self.assertTrue(self.server.requests[0]['stream'])
+
+    def test_streamed_answer_is_cached(self):
+        self.client.get('/search/stream?question=uganda').get_data()
+        response = self.client.get('/search/stream?question=Uganda?')
+        events = parse_events(response.get_data(as_text=True))
+        self.assertEqual(events, [
+            ('message', {'delta': 'Try Makerere.'}),
+            ('done', {'cached': True, 'sources': []}),
+        ])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_refused_call_is_a_failed_event(self):
+        with mock.patch.object(routes.llm_gateway, 'stream',
+                               side_effect=LLMOverloaded('Too busy', 5)):
+            response = self.client.get('/search/stream?question=uganda')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(parse_events(response.get_data(as_text=True)), [
+            ('failed', {'error': 'Too busy', 'status': 503,
+                        'retry_after': 5}),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,284 @@
+import os
+import unittest
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import json
+from unittest import mock
+from sqlalchemy import event
+from werkzeug.http import http_date
+from api.routes_api import university_records
+from app import app, db
+from app.models import University
+
+
+class UniversitiesApiTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app
+        self.app.config['TESTING'] = True
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        for i in range(5):
+            db.session.add(University(
+                id='id-{}'.format(i),
+                name='University {}'.format(i),
+                location='Nairobi, Kenya',
+                website='u{}.example.com'.format(i),
+                status='open'
+                ))
+        db.session.commit()
+        university_records.cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_pages_follow_next_cursor(self):
+        seen = []
+        response = self.client.get('/api/universities?limit=2')
+        while True:
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            self.assertLessEqual(len(data['universities']), 2)
+            seen.extend(u['id'] for u in data['universities'])
+            if data['next'] is None:
+                break
+            response = self.client.get(
+                '/api/universities?limit=2&cursor=' + data['next']
+                )
+        self.assertEqual(seen, ['id-{}'.format(i) for i in range(5)])
+
+    def test_page_size_is_capped(self):
+        self.app.config['UNIVERSITIES_MAX_PAGE_SIZE'] = 3
+        try:
+            response = self.client.get('/api/universities?limit=1000')
+        finally:
+            self.app.config['UNIVERSITIES_MAX_PAGE_SIZE'] = 200
+        data = json.loads(response.data)
+        self.assertEqual(len(data['universities']), 3)
+        self.assertIsNotNone(data['next'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/universities?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+
+    def test_ndjson_stream(self):
+        response = self.client.get('/api/universities?format=ndjson')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json.loads(lines[0])['name'], 'University 0')
+
+    def test_get_university(self):
+        response = self.client.get('/api/universities/id-1')
+        self.assertEqual(json.loads(response.data)['name'], 'University 1')
+        response = self.client.get('/api/universities/nope')
+        self.assertEqual(response.status_code, 404)
+
+    def test_compare_side_by_side(self):
+        response = self.client.get(
+            '/api/universities/compare?ids=id-3,nope,id-1,id-3'
+            )
+        data = json.loads(response.data)
+        self.assertEqual(data['ids'], ['id-3', 'id-1'])
+        self.assertEqual(data['missing'], ['nope'])
+        self.assertEqual(data['fields']['name'],
+                         ['University 3', 'University 1'])
+        self.assertEqual(data['universities'][1]['website'],
+                         'u1.example.com')
+
+    def test_compare_uses_one_query_for_misses(self):
+        self.client.get('/api/universities/compare?ids=id-0')
+        with mock.patch.object(University, 'query') as query:
+            query.filter.return_value = [db.session.get(University, 'id-2')]
+            response = self.client.get(
+                '/api/universities/compare?ids=id-0,id-2'
+                )
+        self.assertEqual(query.filter.call_count, 1)
+        self.assertEqual(json.loads(response.data)['ids'], ['id-0', 'id-2'])
+
+    def test_compare_limits(self):
+        response = self.client.get('/api/universities/compare?ids=')
+        self.assertEqual(response.status_code, 400)
+        ids = ','.join('id-{}'.format(i) for i in range(21))
+        response = self.client.get('/api/universities/compare?ids=' + ids)
+        self.assertEqual(response.status_code, 400)
+
+    def test_update_refreshes_cached_record(self):
+        self.client.get('/api/universities/compare?ids=id-0')
+        self.client.put('/api/universities/id-0', json={
+            'name': 'Renamed', 'location': 'Kisumu, Kenya',
+            'website': None, 'status': 'open'
+            })
+        response = self.client.get('/api/universities/compare?ids=id-0')
+        self.assertEqual(json.loads(response.data)['fields']['name'],
+                         ['Renamed'])
+
+    def test_change_without_notification_refreshes_cached_record(self):
+        # Bulk statements reach the database but send no notification,
+        # like an edit made by another process.
+        self.client.get('/api/universities/compare?ids=id-0')
+        self.client.get('/api/universities/id-0')
+        db.session.execute(db.update(University)
+                           .where(University.id == 'id-0')
+                           .values(name='Beta'))
+        db.session.commit()
+        response = self.client.get('/api/universities/id-0')
+        self.assertEqual(json.loads(response.data)['name'], 'Beta')
+        response = self.client.get('/api/universities/compare?ids=id-0')
+        self.assertEqual(json.loads(response.data)['fields']['name'],
+                         ['Beta'])
+
+    def count_queries(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                        listener)
+        return statements
+
+    def revalidate(self, url, response, header='ETag'):
+        if header == 'ETag':
+            headers = {'If-None-Match': response.headers['ETag']}
+        else:
+            headers = {'If-Modified-Since': response.headers['Last-Modified']}
+        return self.client.get(url, headers=headers)
+
+    def test_list_not_modified(self):
+        url = '/api/universities?limit=2'
+        response = self.client.get(url)
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        self.assertFalse(response.headers['ETag'].startswith('W/'))
+        statements = self.count_queries()
+        revalidated = self.revalidate(url, response)
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated.data, b'')
+        self.assertEqual(revalidated.headers['ETag'], response.headers['ETag'])
+        self.assertEqual(len(statements), 1)
+        self.assertIn('catalog_version', statements[0])
+        self.assertEqual(self.revalidate(url, response, 'Last-Modified')
+                         .status_code, 304)
+        # Another page has another tag.
+        other = self.client.get('/api/universities?limit=3')
+        self.assertNotEqual(other.headers['ETag'], response.headers['ETag'])
+
+    def test_list_changes_with_catalog(self):
+        url = '/api/universities'
+        response = self.client.get(url)
+        university = db.session.get(University, 'id-4')
+        university.like_count += 1
+        db.session.commit()
+        self.assertEqual(self.revalidate(url, response).status_code, 304)
+        university.status = 'closed'
+        db.session.commit()
+        changed = self.revalidate(url, response)
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(json.loads(changed.data)['universities'][4]['status'],
+                         'closed')
+        # The only If-Modified-Since a client can send is too old now.
+        self.assertEqual(self.client.get(url, headers={
+            'If-Modified-Since': http_date(0)}).status_code, 200)
+
+    def test_detail_not_modified(self):
+        url = '/api/universities/id-1'
+        response = self.client.get(url)
+        statements = self.count_queries()
+        self.assertEqual(self.revalidate(url, response).status_code, 304)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('university.id = ', statements[0])
+        # Changes to other universities keep the tag.
+        db.session.get(University, 'id-2').status = 'closed'
+        db.session.commit()
+        self.assertEqual(self.revalidate(url, response).status_code, 304)
+        self.client.put(url, json={
+            'name': 'Renamed', 'location': 'Kisumu, Kenya',
+            'website': None, 'status': 'open'
+            })
+        changed = self.revalidate(url, response)
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(json.loads(changed.data)['name'], 'Renamed')
+        self.assertNotEqual(changed.headers['ETag'], response.headers['ETag'])
+
+    def test_compare_not_modified(self):
+        url = '/api/universities/compare?ids=id-3,id-1'
+        response = self.client.get(url)
+        self.assertEqual(self.revalidate(url, response).status_code, 304)
+        reordered = self.client.get('/api/universities/compare?ids=id-1,id-3')
+        self.assertNotEqual(reordered.headers['ETag'],
+                            response.headers['ETag'])
+        db.session.delete(db.session.get(University, 'id-3'))
+        db.session.commit()
+        changed = self.revalidate(url, response)
+        self.assertEqual(json.loads(changed.data)['missing'], ['id-3'])
+
+    def test_compare_changed_while_loading_has_no_validators(self):
+        load = university_records._load
+
+        def change_then_load(ids):
+            db.session.execute(db.update(University)
+                               .where(University.id == 'id-0')
+                               .values(name='Beta'))
+            db.session.commit()
+            return load(ids)
+
+        with mock.patch.object(university_records, '_load',
+                               side_effect=change_then_load):
+            response = self.client.get('/api/universities/compare?ids=id-0')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['fields']['name'],
+                         ['Beta'])
+        self.assertNotIn('ETag', response.headers)
+        response = self.client.get('/api/universities/compare?ids=id-0')
+        self.assertIn('ETag', response.headers)
+
+    def test_compare_reloads_only_changed_records(self):
+        url = '/api/universities/compare?ids=id-0,id-1'
+        response = self.client.get(url)
+        db.session.execute(db.update(University)
+                           .where(University.id == 'id-1')
+                           .values(name='Beta'))
+        # Likes leave the records, and their tags, alone.
+        db.session.get(University, 'id-0').like_count += 1
+        db.session.commit()
+        with mock.patch.object(university_records, '_load',
+                               wraps=university_records._load) as load:
+            changed = self.revalidate(url, response)
+            self.assertEqual(changed.status_code, 200)
+            self.assertEqual(json.loads(changed.data)['fields']['name'],
+                             ['University 0', 'Beta'])
+            load.assert_called_once_with(['id-1'])
+            self.assertEqual(self.revalidate(url, changed).status_code, 304)
+            self.client.get('/api/universities/compare?ids=id-1,id-0')
+            self.assertEqual(load.call_count, 1)
+
+    def test_detail_is_tagged_with_the_row_it_was_built_from(self):
+        university = db.session.get(University, 'id-0')
+        read = university.updated_at
+        university.name = 'Beta'
+        db.session.commit()
+        updated_at, record = university_records.get('id-0', read)
+        self.assertGreater(updated_at, read)
+        self.assertEqual(record['name'], 'Beta')
+
+    def test_updated_at_follows_content_changes(self):
+        university = db.session.get(University, 'id-0')
+        created = university.updated_at
+        university.like_count = 10
+        db.session.commit()
+        self.assertEqual(university.updated_at, created)
+        university.website = 'www.u0.example.com'
+        db.session.commit()
+        self.assertGreater(university.updated_at, created)
+        touched = university.updated_at
+        db.session.execute(db.update(University).values(status='closed'))
+        db.session.commit()
+        db.session.refresh(university)
+        self.assertGreater(university.updated_at, touched)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from flask import g
+from sqlalchemy import event
+from app import app, db
+from app.models import User
+from app.routes import user_cache
+from app.user_cache import UserCache, _caches, track
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class UserCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        db.session.add(User(id='user-1', username='alice',
+                            email='alice@example.com', password_hash='x',
+                            firstname='Alice', lastname='A', location='GH'))
+        db.session.commit()
+        db.session.remove()
+        self.clock = FakeClock()
+        self.cache = track(UserCache(ttl=30, clock=self.clock))
+        self.addCleanup(_caches.remove, self.cache)
+
+    def count_queries(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                        listener)
+        return statements
+
+    def test_hit_needs_no_query(self):
+        self.assertEqual(self.cache.get('user-1').username, 'alice')
+        db.session.remove()
+        statements = self.count_queries()
+        user = self.cache.get('user-1')
+        self.assertEqual(statements, [])
+        self.assertIn(user, db.session)
+        self.assertEqual(user.location, 'GH')
+        self.assertIsNone(self.cache.get('nobody'))
+
+    def test_ttl(self):
+        self.cache.get('user-1')
+        self.clock.now = 31
+        self.assertNotIn('user-1', self.cache.cache)
+
+    def test_commit_invalidates(self):
+        user = self.cache.get('user-1')
+        user.location = 'KE'
+        self.assertIn('user-1', self.cache.cache)
+        db.session.commit()
+        self.assertNotIn('user-1', self.cache.cache)
+        db.session.remove()
+        self.assertEqual(self.cache.get('user-1').location, 'KE')
+
+    def test_rollback_keeps_entry(self):
+        user = self.cache.get('user-1')
+        user.location = 'KE'
+        db.session.flush()
+        db.session.rollback()
+        self.assertIn('user-1', self.cache.cache)
+
+    def test_delete_invalidates(self):
+        self.cache.get('user-1')
+        User.query.filter_by(id='user-1').delete()
+        db.session.commit()
+        self.assertIsNone(self.cache.get('user-1'))
+
+
+class ProfileTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        patcher = mock.patch.dict(app.config, {'SECRET_KEY': 'test'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.addCleanup(self.app_context.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+        self.addCleanup(user_cache.clear)
+        db.session.add(User(id='user-1', username='alice',
+                            email='alice@example.com', password_hash='x',
+                            firstname='Alice', lastname='A',
+                            phonenumber='0700'))
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = 'user-1'
+            session['_fresh'] = True
+
+    def test_profile_uses_cached_user(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                        listener)
+        for _ in range(2):
+            # Requests share the pushed app context, and so the cached user.
+            g.pop('_login_user', None)
+            db.session.remove()
+            response = self.client.get('/profile')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'0700', response.data)
+        self.assertEqual(len(statements), 1)
+
+    def test_logout(self):
+        self.client.get('/logout')
+        g.pop('_login_user', None)
+        response = self.client.get('/profile')
+        self.assertEqual(response.status_code, 401)
+
+
+if __name__ == '__main__':
+    unittest.main()